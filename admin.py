@@ -1,12 +1,28 @@
 from django.contrib import admin
 from leaflet.admin import LeafletGeoAdmin, LeafletGeoAdminMixin
 
-from .models import Drawing, Dxf2Csv, Insertion, Layer
+from .models import (
+    AuthorSummary,
+    Drawing,
+    Dxf2Csv,
+    Entity,
+    ImportStats,
+    Insertion,
+    Layer,
+)
 
 
-class LayerInline(LeafletGeoAdminMixin, admin.TabularInline):
+class LayerInline(admin.TabularInline):
     model = Layer
-    fields = ("name", "color_field", "geom")
+    fields = ("name", "color_field", "linetype")
+    show_change_link = True
+    extra = 0
+
+
+class EntityInline(LeafletGeoAdminMixin, admin.TabularInline):
+    model = Entity
+    fields = ("geom_type", "handle", "geom")
+    readonly_fields = ("geom_type", "handle")
     extra = 0
 
 
@@ -17,11 +33,29 @@ class InsertionInline(LeafletGeoAdminMixin, admin.TabularInline):
     extra = 0
 
 
+class ImportStatsInline(admin.TabularInline):
+    model = ImportStats
+    fields = (
+        "created",
+        "duration",
+        "total_entities",
+        "total_vertices",
+        "dropped_polygons",
+        "peak_memory",
+    )
+    readonly_fields = fields
+    extra = 0
+    max_num = 0
+    can_delete = False
+
+
 class DrawingAdmin(LeafletGeoAdmin):
-    list_display = ("title", "user")
+    list_display = ("title", "user", "truncated")
+    readonly_fields = ("truncation_reason",)
     exclude = ("image",)
     inlines = [
         LayerInline,
+        ImportStatsInline,
     ]
 
 
@@ -31,6 +65,7 @@ admin.site.register(Drawing, DrawingAdmin)
 class LayerAdmin(LeafletGeoAdmin):
     list_display = ("__str__", "drawing")
     inlines = [
+        EntityInline,
         InsertionInline,
     ]
 
@@ -44,3 +79,53 @@ class Dxf2CsvAdmin(admin.ModelAdmin):
         "__str__",
         "intro",
     )
+
+
+@admin.register(AuthorSummary)
+class AuthorSummaryAdmin(admin.ModelAdmin):
+    list_display = (
+        "username",
+        "public_drawings",
+        "private_drawings",
+        "last_update",
+    )
+    readonly_fields = (
+        "user",
+        "username",
+        "public_drawings",
+        "private_drawings",
+        "last_update",
+        "extent",
+    )
+
+
+@admin.register(ImportStats)
+class ImportStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        "drawing",
+        "created",
+        "duration",
+        "file_size",
+        "total_entities",
+        "total_vertices",
+        "dropped_polygons",
+        "peak_memory",
+    )
+    list_select_related = ("drawing",)
+    date_hierarchy = "created"
+    readonly_fields = (
+        "drawing",
+        "created",
+        "duration",
+        "file_size",
+        "timings",
+        "entities",
+        "vertices",
+        "total_entities",
+        "total_vertices",
+        "dropped_polygons",
+        "peak_memory",
+    )
+
+    def has_add_permission(self, request):
+        return False
@@ -36,6 +36,6 @@ class DjeocadConfig(AppConfig):
     name = "djeocad"
 
     def ready(self):
-        #  import djeocad.signals  # noqa
+        import djeocad.signals  # noqa
 
         post_migrate.connect(create_djeocad_group, sender=self)
@@ -0,0 +1,331 @@
+import gc
+import json
+import platform
+import tracemalloc
+from math import cos, pi, sin
+from pathlib import Path
+from statistics import mean
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import uuid4
+
+import ezdxf
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+"""
+    Synthetic DXF generators and timings of the geometry pipeline
+"""
+
+CASES = {
+    "small": {
+        "lines": 100,
+        "polylines": 50,
+        "arcs": 50,
+        "hatches": 20,
+        "blocks": 5,
+        "instances": 10,
+        "rooms": 20,
+    },
+    "medium": {
+        "lines": 2000,
+        "polylines": 1000,
+        "arcs": 1000,
+        "hatches": 200,
+        "blocks": 20,
+        "instances": 50,
+        "rooms": 200,
+    },
+    "large": {
+        "lines": 20000,
+        "polylines": 10000,
+        "arcs": 10000,
+        "hatches": 2000,
+        "blocks": 50,
+        "instances": 200,
+        "rooms": 1000,
+    },
+}
+
+# drawing location and geodata for generated files
+LOCATION = {"type": "Point", "coordinates": [12.493652, 41.866288]}
+
+# curve tolerances in meters compared by flattening measurements
+SAGITTAS = [0.001, 0.01, 0.1, 0.5]
+
+# coordinate decimals compared by encoding measurements, None is full precision
+PRECISIONS = [None, 7, 6]
+
+
+def grid(n, step=10):
+    """Spreads n items on a square grid of step meters"""
+    side = max(int(n**0.5), 1)
+    for i in range(n):
+        yield (i % side) * step, (i // side) * step
+
+
+def make_dxf(
+    path,
+    lines=0,
+    polylines=0,
+    arcs=0,
+    hatches=0,
+    blocks=0,
+    instances=0,
+    rooms=0,
+    vertices=20,
+):
+    """
+    Writes a DXF with given number of entities, each kind on its own layer.
+    Instances of every block are inserted on layer 0 (layers without
+    entities are not extracted, neither their insertions), rooms are adjacent
+    closed polylines with a "plan/id/intervention" text inside, as expected by
+    Dxf2Csv.
+    """
+    doc = ezdxf.new()
+    msp = doc.modelspace()
+    for i, name in enumerate(["lines", "polylines", "arcs", "hatches", "rooms"]):
+        doc.layers.add(name, color=i + 1)
+    for x, y in grid(lines):
+        msp.add_line((x, y), (x + 8, y + 3), dxfattribs={"layer": "lines"})
+    for x, y in grid(polylines):
+        points = [
+            (
+                x + 4 + 4 * cos(2 * pi * v / vertices),
+                y + 4 + 4 * sin(2 * pi * v / vertices),
+            )
+            for v in range(vertices)
+        ]
+        msp.add_lwpolyline(points, dxfattribs={"layer": "polylines"})
+    for x, y in grid(arcs):
+        msp.add_arc((x + 4, y + 4), 4, 0, 270, dxfattribs={"layer": "arcs"})
+    for x, y in grid(hatches):
+        hatch = msp.add_hatch(dxfattribs={"layer": "hatches"})
+        hatch.paths.add_polyline_path(
+            [(x, y), (x + 8, y), (x + 8, y + 8), (x, y + 8)], is_closed=True
+        )
+    for b in range(blocks):
+        block = doc.blocks.new(name="BLOCK%d" % b)
+        block.add_line((0, 0), (2, 0))
+        block.add_line((0, 0), (0, 2))
+        block.add_circle((1, 1), 1)
+        for i, (x, y) in enumerate(grid(instances)):
+            msp.add_blockref(
+                block.name,
+                (x + b, y),
+                dxfattribs={"layer": "0", "rotation": i % 360},
+            )
+    # rooms share walls, as in floor plans
+    for i, (x, y) in enumerate(grid(rooms, step=8)):
+        msp.add_lwpolyline(
+            [(x, y), (x + 8, y), (x + 8, y + 8), (x, y + 8)],
+            close=True,
+            dxfattribs={"layer": "rooms", "thickness": 3},
+        )
+        msp.add_text(
+            "P1/%d/new" % i, dxfattribs={"layer": "rooms", "insert": (x + 4, y + 4)}
+        )
+    doc.saveas(path)
+    return path
+
+
+def measure(func, setup=None, repeat=3):
+    """
+    Times func repeat times, then runs it once more under tracemalloc to get
+    peak memory, so tracing doesn't slow down timings. Setup runs before
+    each call and isn't timed.
+    """
+    timings = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "min": min(timings),
+        "mean": mean(timings),
+        "repeat": repeat,
+        "peak_kb": round(peak / 1024),
+    }
+
+
+def payload_kb(drawing):
+    from .payloads import build_map_payload
+
+    payload = build_map_payload(drawing)
+    return round(sum(len(data.encode()) for data in payload.values()) / 1024, 1)
+
+
+def measure_flattening(drawing, sagittas=SAGITTAS):
+    """
+    Extracts drawing with each curve tolerance, returns stored vertices
+    and size of map payload
+    """
+    from .models import ImportStats
+
+    sizes = []
+    for sagitta in sagittas:
+        drawing.related_layers.all().delete()
+        drawing.max_sagitta = sagitta
+        drawing.extract_dxf()
+        stats = ImportStats.objects.filter(drawing_id=drawing.id).first()
+        sizes.append(
+            {
+                "max_sagitta": sagitta,
+                "vertices": stats.total_vertices,
+                "payload_kb": payload_kb(drawing),
+            }
+        )
+    drawing.max_sagitta = None
+    return sizes
+
+
+def measure_encoding(drawing, precisions=PRECISIONS):
+    """
+    Extracts drawing with each coordinate precision, returns size of stored
+    layers and of map payload, plain, delta and TopoJSON encoded
+    """
+    from .models import Entity
+
+    sizes = []
+    for precision in precisions:
+        with override_settings(DJEOCAD_COORDINATE_PRECISION=precision):
+            drawing.related_layers.all().delete()
+            drawing.extract_dxf()
+            entities = Entity.objects.filter(layer__drawing_id=drawing.id)
+            stored = sum(
+                len(json.dumps(geom))
+                for geom in entities.values_list("geom", flat=True)
+            )
+            size = {
+                "precision": precision,
+                "stored_kb": round(stored / 1024, 1),
+                "payload_kb": payload_kb(drawing),
+            }
+            with override_settings(DJEOCAD_DELTA_ENCODING=True):
+                size["delta_kb"] = payload_kb(drawing)
+            with override_settings(DJEOCAD_TOPOJSON=True):
+                size["topojson_kb"] = payload_kb(drawing)
+        sizes.append(size)
+    return sizes
+
+
+def run_case(params, repeat=3):
+    """
+    Benchmarks the pipeline on a generated DXF, then measures vertices and
+    payload size by curve tolerance and by coordinate precision. Everything
+    runs in a transaction that is rolled back and files live in a temporary
+    MEDIA_ROOT.
+    """
+    from .documents import clear_documents
+    from .models import Drawing, Dxf2Csv, Insertion, Layer
+    from .utils import transform_geometries
+
+    User = get_user_model()
+
+    results = {}
+    flattening = encoding = []
+    with TemporaryDirectory() as tmp, override_settings(MEDIA_ROOT=tmp):
+        path = make_dxf(Path(tmp).joinpath("benchmark.dxf"), **params)
+        with transaction.atomic():
+            username = "djeocad_benchmark_" + uuid4().hex[:8]
+            user = User.objects.create(**{User.USERNAME_FIELD: username})
+            drawing = Drawing(user=user, title="Benchmark", geom=LOCATION, private=True)
+            with open(path, "rb") as f:
+                drawing.dxf.save(path.name, File(f), save=False)
+            drawing.save()
+            # before download replaces curves with polylines
+            flattening = measure_flattening(drawing)
+            encoding = measure_encoding(drawing)
+
+            def clear_layers():
+                drawing.related_layers.all().delete()
+
+            def cold_start():
+                # time parsing too, not just cached documents
+                clear_layers()
+                clear_documents()
+
+            results["extract_dxf"] = measure(
+                drawing.extract_dxf, setup=cold_start, repeat=repeat
+            )
+            results["get_file_to_download"] = measure(
+                drawing.get_file_to_download, repeat=repeat
+            )
+            # file was replaced by download, extract it again
+            clear_layers()
+            drawing.extract_dxf()
+            block = drawing.related_layers.filter(is_block=True).first()
+            if block:
+
+                def change_block():
+                    # a moved entity makes Layer.save update instances
+                    nonlocal block
+                    block = Layer.objects.get(id=block.id)
+                    geometries = block.geom["geometries"]
+                    geometries[0] = transform_geometries(
+                        geometries[:1], lambda xs, ys: (xs + 0.00001, ys)
+                    )[0]
+                    block.geom = {
+                        "geometries": geometries,
+                        "type": "GeometryCollection",
+                    }
+
+                results["layer_save_block"] = measure(
+                    lambda: block.save(), setup=change_block, repeat=repeat
+                )
+            insertion = Insertion.objects.filter(block__drawing=drawing).first()
+            if insertion:
+
+                def rotate_insertion():
+                    nonlocal insertion
+                    insertion = Insertion.objects.get(id=insertion.id)
+                    insertion.rotation += 10
+
+                results["insertion_save"] = measure(
+                    lambda: insertion.save(), setup=rotate_insertion, repeat=repeat
+                )
+            csv = Dxf2Csv()
+            with open(path, "rb") as f:
+                csv.dxf.save(path.name, File(f), save=False)
+            results["dxf2csv_extract_data"] = measure(csv.extract_data, repeat=repeat)
+            transaction.set_rollback(True)
+    return {"results": results, "flattening": flattening, "encoding": encoding}
+
+
+def run_benchmarks(cases, repeat=3):
+    return {
+        "timestamp": timezone.now().isoformat(),
+        "python": platform.python_version(),
+        "ezdxf": ezdxf.__version__,
+        "repeat": repeat,
+        "cases": {
+            name: dict(params=params, **run_case(params, repeat=repeat))
+            for name, params in cases.items()
+        },
+    }
+
+
+def compare_benchmarks(previous, current):
+    """Yields (case, operation, previous, current, ratio) of minimum timings"""
+    for name, case in current["cases"].items():
+        if name not in previous["cases"]:
+            continue
+        old_results = previous["cases"][name]["results"]
+        for operation, result in case["results"].items():
+            if operation not in old_results:
+                continue
+            old = old_results[operation]["min"]
+            yield name, operation, old, result["min"], result["min"] / old
@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import ezdxf
+from django.conf import settings
+
+"""
+    Process local LRU cache of parsed ezdxf documents, so that a file is
+    parsed at most once per worker while it is hot. Cached documents are
+    shared: callers must not modify them.
+"""
+
+# parsed documents retain about six times the size of ASCII files and
+# peak near ten while parsing, binary files are about twice as dense
+SIZE_FACTOR = 10
+BINARY_SIZE_FACTOR = 20
+
+_documents = OrderedDict()
+_lock = threading.Lock()
+_total_size = 0
+
+
+def get_cache_limit():
+    """Memory ceiling of cached documents in bytes, 0 disables the cache"""
+    try:
+        megabytes = settings.DJEOCAD_DOCUMENT_CACHE_MB
+    except AttributeError:
+        megabytes = 128
+    return int(megabytes * 1024 * 1024)
+
+
+def is_binary_dxf(path):
+    with open(path, "rb") as f:
+        return f.read(18) == b"AutoCAD Binary DXF"
+
+
+def _discard(key):
+    global _total_size
+    doc, size = _documents.pop(key)
+    _total_size -= size
+
+
+def read_document(path):
+    """
+    Returns parsed DXF document at path, from cache if the file didn't
+    change (same modification time and size) since it was parsed
+    """
+    global _total_size
+    path = Path(path)
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if key in _documents:
+            _documents.move_to_end(key)
+            return _documents[key][0]
+    doc = ezdxf.readfile(path)
+    limit = get_cache_limit()
+    size = stat.st_size * (BINARY_SIZE_FACTOR if is_binary_dxf(path) else SIZE_FACTOR)
+    if size > limit:
+        return doc
+    with _lock:
+        # older versions of the same file won't be requested again
+        for old in [k for k in _documents if k[0] == key[0]]:
+            _discard(old)
+        _documents[key] = (doc, size)
+        _total_size += size
+        while _total_size > limit:
+            _discard(next(iter(_documents)))
+    return doc
+
+
+def clear_documents():
+    global _total_size
+    with _lock:
+        _documents.clear()
+        _total_size = 0
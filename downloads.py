@@ -0,0 +1,117 @@
+import gzip
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+import ezdxf
+from django.conf import settings
+
+from .documents import is_binary_dxf
+
+"""
+    Downloadable variants of drawing DXF files, ASCII or binary, gzip or
+    zip compressed. Variants are written once for every stored file, so
+    they are served again until the drawing changes.
+"""
+
+# format: suffix of downloaded file, content type
+FORMATS = {
+    "asc": (".dxf", "text/plain"),
+    "bin": (".dxf", "application/octet-stream"),
+    "gzip": (".dxf.gz", "application/gzip"),
+    "zip": (".zip", "application/zip"),
+}
+
+
+def get_download_dir():
+    return Path(settings.MEDIA_ROOT).joinpath("djeocad/downloads")
+
+
+def get_file_version(drawing):
+    """
+    Hash of stored file (a new file is stored when drawing changes), files
+    stored before hashing are told apart by modification time
+    """
+    if drawing.dxf_hash:
+        return drawing.dxf_hash
+    path = Path(settings.MEDIA_ROOT).joinpath(str(drawing.dxf))
+    return "m%d" % path.stat().st_mtime_ns
+
+
+def get_download_path(drawing, fmt):
+    return get_download_dir().joinpath(
+        "%(id)d-%(version)s-%(fmt)s%(suffix)s"
+        % {
+            "id": drawing.id,
+            "version": get_file_version(drawing),
+            "fmt": fmt,
+            "suffix": FORMATS[fmt][0],
+        }
+    )
+
+
+def get_archive_name(drawing):
+    return "%s.dxf" % drawing.title
+
+
+def is_current(path, drawing, fmt):
+    if not path.exists():
+        return False
+    if fmt != "zip":
+        return True
+    # archived file is named after drawing title
+    with zipfile.ZipFile(path) as archive:
+        return archive.namelist() == [get_archive_name(drawing)]
+
+
+def write_download(drawing, fmt, path):
+    # a temporary file of its own for every writer, renamed when complete
+    # so readers never get partial files (leading dot keeps it out of globs)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix="." + path.name, suffix=".tmp", delete=False
+    ) as file:
+        temp = Path(file.name)
+    try:
+        if fmt in ("asc", "bin"):
+            stored = Path(settings.MEDIA_ROOT).joinpath(str(drawing.dxf))
+            ezdxf.readfile(stored).saveas(temp, fmt=fmt)
+        elif fmt == "gzip":
+            with open(get_download(drawing, "asc"), "rb") as source:
+                with gzip.open(temp, "wb") as target:
+                    shutil.copyfileobj(source, target)
+        else:
+            with zipfile.ZipFile(temp, "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.write(
+                    get_download(drawing, "asc"), arcname=get_archive_name(drawing)
+                )
+        temp.replace(path)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+
+
+def get_download(drawing, fmt):
+    """
+    Returns path of DXF file of drawing in format (asc, bin, gzip or zip),
+    writing it if missing. Stored file is returned if already in format.
+    Variants of previous files of drawing are removed.
+    """
+    stored = Path(settings.MEDIA_ROOT).joinpath(str(drawing.dxf))
+    if fmt in ("asc", "bin") and is_binary_dxf(stored) == (fmt == "bin"):
+        return stored
+    directory = get_download_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = get_download_path(drawing, fmt)
+    if not is_current(path, drawing, fmt):
+        write_download(drawing, fmt, path)
+    version = get_file_version(drawing)
+    for old in directory.glob("%d-*" % drawing.id):
+        if old.name.split("-")[1] != version:
+            old.unlink(missing_ok=True)
+    return path
+
+
+def delete_downloads(drawing_id):
+    for path in get_download_dir().glob("%d-*" % drawing_id):
+        path.unlink(missing_ok=True)
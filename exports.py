@@ -0,0 +1,578 @@
+import json
+import sqlite3
+import struct
+import tempfile
+from math import ceil
+from pathlib import Path
+
+import numpy as np
+import shapely
+from django.conf import settings
+from pyproj import CRS
+
+"""
+    Exports of drawing layers and insertions, one feature for every entity:
+    GeoJSON text sequences are streamed, GeoPackage and FlatGeobuf files
+    are written incrementally once for every map version
+"""
+
+# format: suffix of exported file, content type
+FORMATS = {
+    "geojsonseq": (".geojsonl", "application/geo+json-seq"),
+    "gpkg": (".gpkg", "application/geopackage+sqlite3"),
+    "fgb": (".fgb", "application/flatgeobuf"),
+}
+
+# feature properties, exported in this order
+COLUMNS = ["layer", "block", "color", "linetype"]
+
+# features are read and written in batches
+BATCH_SIZE = 500
+
+
+def iter_features(drawing):
+    """
+    Yields (geometry, properties) of entities of drawing layers and block
+    insertions, as shown on the map. Querysets are iterated in chunks.
+    """
+    from .models import Entity, Insertion
+
+    layers = drawing.related_layers.filter(is_block=False)
+    entities = Entity.objects.filter(layer__in=layers).select_related("layer")
+    for entity in entities.iterator(chunk_size=BATCH_SIZE):
+        properties = {
+            "layer": entity.layer.name,
+            "block": None,
+            "color": entity.layer.color_field,
+            "linetype": entity.layer.linetype,
+        }
+        yield entity.geom, properties
+    insertions = Insertion.objects.filter(layer__in=layers).select_related(
+        "layer", "block"
+    )
+    for insertion in insertions.iterator(chunk_size=BATCH_SIZE):
+        properties = {
+            "layer": insertion.layer.name,
+            "block": insertion.block.name,
+            "color": insertion.layer.color_field,
+            "linetype": insertion.layer.linetype,
+        }
+        for geometry in insertion.geom["geometries"]:
+            yield geometry, properties
+
+
+def iter_batches(features):
+    """
+    Groups features in lists of GeoJSON geometries, shapely geometries and
+    properties. Empty geometries are left out.
+    """
+    batch = []
+    for feature in features:
+        batch.append(feature)
+        if len(batch) == BATCH_SIZE:
+            yield read_batch(batch)
+            batch = []
+    if batch:
+        yield read_batch(batch)
+
+
+def read_batch(batch):
+    geometries = shapely.from_geojson([json.dumps(g) for g, p in batch])
+    keep = ~shapely.is_empty(geometries)
+    return (
+        [g for (g, p), k in zip(batch, keep) if k],
+        geometries[keep],
+        [p for (g, p), k in zip(batch, keep) if k],
+    )
+
+
+def iter_geojsonseq(drawing):
+    """Yields features of drawing as GeoJSON text sequence (RFC 8142)"""
+    for geometry, properties in iter_features(drawing):
+        feature = {"type": "Feature", "geometry": geometry, "properties": properties}
+        yield ("\x1e" + json.dumps(feature) + "\n").encode()
+
+
+GPKG_TABLES = """
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL,
+    srs_id INTEGER PRIMARY KEY,
+    organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL,
+    description TEXT
+);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    data_type TEXT NOT NULL,
+    identifier TEXT UNIQUE,
+    description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL
+        DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE,
+    min_y DOUBLE,
+    max_x DOUBLE,
+    max_y DOUBLE,
+    srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id)
+);
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL REFERENCES gpkg_spatial_ref_sys (srs_id),
+    z TINYINT NOT NULL,
+    m TINYINT NOT NULL,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE gpkg_extensions (
+    table_name TEXT,
+    column_name TEXT,
+    extension_name TEXT NOT NULL,
+    definition TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    UNIQUE (table_name, column_name, extension_name)
+);
+CREATE TABLE entities (
+    fid INTEGER PRIMARY KEY AUTOINCREMENT,
+    geom GEOMETRY,
+    layer TEXT,
+    block TEXT,
+    color TEXT,
+    linetype BOOLEAN
+);
+CREATE VIRTUAL TABLE rtree_entities_geom USING rtree(id, minx, maxx, miny, maxy);
+"""
+
+
+def gpkg_geometry(wkb, bounds):
+    """GeoPackage binary: header with SRS and envelope, then WKB"""
+    # little endian, envelope is [minx, maxx, miny, maxy]
+    header = b"GP\x00\x03" + struct.pack(
+        "<i4d", 4326, bounds[0], bounds[2], bounds[1], bounds[3]
+    )
+    return header + wkb
+
+
+def write_geopackage(drawing, path):
+    """
+    Writes entities of drawing in a GeoPackage at path, in a single table
+    with R-tree spatial index. Rows are inserted batch by batch.
+    """
+    db = sqlite3.connect(path)
+    try:
+        # "GPKG" application id, version 1.3
+        db.execute("PRAGMA application_id = 1196444487")
+        db.execute("PRAGMA user_version = 10300")
+        db.executescript(GPKG_TABLES)
+        db.executemany(
+            "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+                ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+                (
+                    "WGS 84 geodetic",
+                    4326,
+                    "EPSG",
+                    4326,
+                    CRS.from_epsg(4326).to_wkt("WKT1_GDAL"),
+                    None,
+                ),
+            ],
+        )
+        db.execute(
+            "INSERT INTO gpkg_geometry_columns VALUES "
+            "('entities', 'geom', 'GEOMETRY', 4326, 0, 0)"
+        )
+        db.execute(
+            "INSERT INTO gpkg_extensions VALUES ('entities', 'geom', "
+            "'gpkg_rtree_index', 'http://www.geopackage.org/spec120/"
+            "#extension_rtree', 'write-only')"
+        )
+        extent = [np.inf, np.inf, -np.inf, -np.inf]
+        fid = 0
+        for raw, geometries, properties in iter_batches(iter_features(drawing)):
+            if not len(geometries):
+                continue
+            wkbs = shapely.to_wkb(geometries, byte_order=1)
+            bounds = shapely.bounds(geometries)
+            rows = []
+            boxes = []
+            for wkb, box, props in zip(wkbs, bounds, properties):
+                fid += 1
+                rows.append(
+                    [fid, gpkg_geometry(wkb, box)] + [props[c] for c in COLUMNS]
+                )
+                boxes.append((fid, box[0], box[2], box[1], box[3]))
+            db.executemany("INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?)", rows)
+            db.executemany(
+                "INSERT INTO rtree_entities_geom VALUES (?, ?, ?, ?, ?)", boxes
+            )
+            extent[:2] = np.minimum(extent[:2], bounds[:, :2].min(axis=0))
+            extent[2:] = np.maximum(extent[2:], bounds[:, 2:].max(axis=0))
+        extent = [float(v) for v in extent] if fid else [None] * 4
+        db.execute(
+            "INSERT INTO gpkg_contents (table_name, data_type, identifier, "
+            "min_x, min_y, max_x, max_y, srs_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ["entities", "features", drawing.title] + extent + [4326],
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+# FlatBuffers scalar types of FlatGeobuf schema, struct format and dtype
+SCALARS = {
+    "bool": ("<B", "u1"),
+    "ubyte": ("<B", "u1"),
+    "ushort": ("<H", "<u2"),
+    "int": ("<i", "<i4"),
+    "uint": ("<I", "<u4"),
+    "ulong": ("<Q", "<u8"),
+    "double": ("<d", "<f8"),
+}
+
+
+class FlatBufferBuilder:
+    """
+    Minimal FlatBuffers encoder, writes front to back: every table follows
+    its vtable and precedes strings, vectors and tables it refers to.
+    Tables are dicts of field id: (type, value), types are scalars, string,
+    table, [table] or vectors of scalars like [double].
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def pad(self, alignment, extra=0):
+        """Aligns position after extra bytes"""
+        self.buf += bytes(-(len(self.buf) + extra) % alignment)
+
+    def finish(self, fields):
+        self.buf += bytes(4)
+        struct.pack_into("<I", self.buf, 0, self.table(fields))
+        return bytes(self.buf)
+
+    def table(self, fields):
+        inline = []
+        for field, (kind, value) in fields.items():
+            width = struct.calcsize(SCALARS[kind][0]) if kind in SCALARS else 4
+            inline.append((field, width, kind, value))
+        # biggest first, less padding
+        inline.sort(key=lambda f: -f[1])
+        offsets = {}
+        size = 4
+        for field, width, kind, value in inline:
+            size += -size % width
+            offsets[field] = size
+            size += width
+        count = max(fields) + 1 if fields else 0
+        self.pad(2)
+        vtable = len(self.buf)
+        self.buf += struct.pack("<HH", 4 + 2 * count, size)
+        self.buf += struct.pack(
+            "<%dH" % count, *[offsets.get(f, 0) for f in range(count)]
+        )
+        self.pad(max([4] + [f[1] for f in inline]))
+        table = len(self.buf)
+        self.buf += bytes(size)
+        struct.pack_into("<i", self.buf, table, table - vtable)
+        for field, width, kind, value in inline:
+            if kind in SCALARS:
+                struct.pack_into(
+                    SCALARS[kind][0], self.buf, table + offsets[field], value
+                )
+        # referred objects follow the table
+        for field, width, kind, value in inline:
+            if kind not in SCALARS:
+                position = table + offsets[field]
+                target = self.reference(kind, value)
+                struct.pack_into("<I", self.buf, position, target - position)
+        return table
+
+    def reference(self, kind, value):
+        if kind == "table":
+            return self.table(value)
+        self.pad(4)
+        position = len(self.buf)
+        if kind == "string":
+            data = value.encode()
+            self.buf += struct.pack("<I", len(data)) + data + b"\x00"
+        elif kind == "[table]":
+            self.buf += struct.pack("<I", len(value)) + bytes(4 * len(value))
+            for i, fields in enumerate(value):
+                slot = position + 4 + 4 * i
+                struct.pack_into("<I", self.buf, slot, self.table(fields) - slot)
+        else:
+            dtype = np.dtype(SCALARS[kind[1:-1]][1])
+            # elements are aligned, length prefix comes just before them
+            self.pad(max(dtype.itemsize, 4), extra=4)
+            position = len(self.buf)
+            self.buf += struct.pack("<I", len(value))
+            if isinstance(value, bytes):
+                self.buf += value
+            else:
+                self.buf += np.asarray(value, dtype=dtype).tobytes()
+        return position
+
+
+# FlatGeobuf geometry types
+FGB_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+    "GeometryCollection": 7,
+}
+
+
+def fgb_sequences(sequences):
+    """Flat xy of a list of point sequences, with ends if more than one"""
+    fields = {}
+    ends = np.cumsum([len(s) for s in sequences])
+    if len(sequences) > 1:
+        fields[0] = ("[uint]", ends)
+    xy = [c for s in sequences for p in s for c in p[:2]]
+    fields[1] = ("[double]", xy)
+    return fields
+
+
+def fgb_geometry(geometry):
+    """FlatGeobuf Geometry table of GeoJSON geometry"""
+    kind = geometry["type"]
+    if kind == "GeometryCollection":
+        fields = {7: ("[table]", [fgb_geometry(g) for g in geometry["geometries"]])}
+    elif kind == "MultiPolygon":
+        parts = [{"type": "Polygon", "coordinates": p} for p in geometry["coordinates"]]
+        fields = {7: ("[table]", [fgb_geometry(p) for p in parts])}
+    elif kind == "Point":
+        fields = fgb_sequences([[geometry["coordinates"]]])
+    elif kind in ("LineString", "MultiPoint"):
+        fields = fgb_sequences([geometry["coordinates"]])
+    else:
+        fields = fgb_sequences(geometry["coordinates"])
+    fields[6] = ("ubyte", FGB_TYPES[kind])
+    return fields
+
+
+def fgb_properties(properties):
+    data = bytearray()
+    for i, column in enumerate(COLUMNS):
+        value = properties[column]
+        if value is None:
+            continue
+        data += struct.pack("<H", i)
+        if isinstance(value, bool):
+            data += struct.pack("<B", value)
+        else:
+            encoded = value.encode()
+            data += struct.pack("<I", len(encoded)) + encoded
+    return bytes(data)
+
+
+def hilbert(x, y):
+    """
+    Hilbert curve index of arrays of 16 bit coordinates, see
+    https://github.com/rawrunprotected/hilbert_curves
+    """
+    x = x.astype(np.uint32)
+    y = y.astype(np.uint32)
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+    for shift in (2, 4):
+        a, b, c, d = A, B, C, D
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333)):
+        i0 = (i0 | (i0 << shift)) & mask
+        i1 = (i1 | (i1 << shift)) & mask
+    i0 = (i0 | (i0 << 1)) & 0x55555555
+    i1 = (i1 | (i1 << 1)) & 0x55555555
+    return (i1 << 1) | i0
+
+
+NODE = np.dtype(
+    [
+        ("minx", "<f8"),
+        ("miny", "<f8"),
+        ("maxx", "<f8"),
+        ("maxy", "<f8"),
+        ("offset", "<u8"),
+    ]
+)
+
+
+def packed_rtree(bounds, offsets, node_size=16):
+    """
+    Static packed R-tree of FlatGeobuf, levels from root to leaves. Leaves
+    refer to feature offsets, nodes to index of their first child.
+    """
+    count = len(bounds)
+    levels = [count]
+    n = count
+    while True:
+        n = ceil(n / node_size)
+        levels.append(n)
+        if n == 1:
+            break
+    total = sum(levels)
+    # level bounds, leaves are at the end
+    starts = []
+    for size in levels:
+        total -= size
+        starts.append(total)
+    nodes = np.zeros(sum(levels), dtype=NODE)
+    leaves = nodes[starts[0] :]
+    leaves["minx"], leaves["miny"] = bounds[:, 0], bounds[:, 1]
+    leaves["maxx"], leaves["maxy"] = bounds[:, 2], bounds[:, 3]
+    leaves["offset"] = offsets
+    for level in range(len(levels) - 1):
+        start, end = starts[level], starts[level] + levels[level]
+        children = nodes[start:end]
+        first = np.arange(0, end - start, node_size)
+        parents = nodes[starts[level + 1] : starts[level + 1] + levels[level + 1]]
+        parents["minx"] = np.minimum.reduceat(children["minx"], first)
+        parents["miny"] = np.minimum.reduceat(children["miny"], first)
+        parents["maxx"] = np.maximum.reduceat(children["maxx"], first)
+        parents["maxy"] = np.maximum.reduceat(children["maxy"], first)
+        parents["offset"] = first + start
+    return nodes
+
+
+def write_flatgeobuf(drawing, path, node_size=16):
+    """
+    Writes entities of drawing as FlatGeobuf at path, with packed Hilbert
+    R-tree. Features are encoded one by one in a spool file, then copied
+    in Hilbert order after header and index.
+    """
+    boxes = []
+    sizes = []
+    with tempfile.TemporaryFile() as spool:
+        for raw, geometries, properties in iter_batches(iter_features(drawing)):
+            for geometry, box, props in zip(
+                raw, shapely.bounds(geometries), properties
+            ):
+                feature = FlatBufferBuilder().finish(
+                    {
+                        0: ("table", fgb_geometry(geometry)),
+                        1: ("[ubyte]", fgb_properties(props)),
+                    }
+                )
+                spool.write(struct.pack("<I", len(feature)) + feature)
+                boxes.append(box)
+                sizes.append(len(feature) + 4)
+        count = len(sizes)
+        bounds = np.array(boxes, dtype=float).reshape(count, 4)
+        header = {
+            0: ("string", drawing.title),
+            2: ("ubyte", 0),
+            7: (
+                "[table]",
+                [
+                    {0: ("string", "layer"), 1: ("ubyte", 11)},
+                    {0: ("string", "block"), 1: ("ubyte", 11)},
+                    {0: ("string", "color"), 1: ("ubyte", 11)},
+                    {0: ("string", "linetype"), 1: ("ubyte", 2)},
+                ],
+            ),
+            8: ("ulong", count),
+            9: ("ushort", node_size if count else 0),
+            10: ("table", {0: ("string", "EPSG"), 1: ("int", 4326)}),
+        }
+        order = np.arange(count)
+        if count:
+            extent = np.concatenate(
+                [bounds[:, :2].min(axis=0), bounds[:, 2:].max(axis=0)]
+            )
+            header[1] = ("[double]", extent)
+            # hilbert index of box centers on a 16 bit grid
+            width, height = extent[2] - extent[0], extent[3] - extent[1]
+            centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+            x = np.zeros(count)
+            y = np.zeros(count)
+            if width:
+                x = np.floor(0xFFFF * (centers[:, 0] - extent[0]) / width)
+            if height:
+                y = np.floor(0xFFFF * (centers[:, 1] - extent[1]) / height)
+            order = np.argsort(-hilbert(x, y).astype(np.int64), kind="stable")
+        sizes = np.array(sizes, dtype=np.uint64)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.uint64)
+        header = FlatBufferBuilder().finish(header)
+        with open(path, "wb") as f:
+            f.write(b"fgb\x03fgb\x00")
+            f.write(struct.pack("<I", len(header)) + header)
+            if count:
+                offsets = np.concatenate([[0], np.cumsum(sizes[order])[:-1]]).astype(
+                    np.uint64
+                )
+                f.write(packed_rtree(bounds[order], offsets, node_size).tobytes())
+            for i in order:
+                spool.seek(int(starts[i]))
+                f.write(spool.read(int(sizes[i])))
+
+
+WRITERS = {"gpkg": write_geopackage, "fgb": write_flatgeobuf}
+
+
+def get_export_dir():
+    return Path(settings.MEDIA_ROOT).joinpath("djeocad/exports")
+
+
+def get_export(drawing, fmt):
+    """
+    Returns path of drawing exported as GeoPackage or FlatGeobuf, writing
+    it if missing for current map version. Exports of older versions are
+    removed, newer ones may be written concurrently.
+    """
+    directory = get_export_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory.joinpath(
+        "%(id)d-%(version)d%(suffix)s"
+        % {"id": drawing.id, "version": drawing.map_version, "suffix": FORMATS[fmt][0]}
+    )
+    if not path.exists():
+        # a temporary file of its own for every writer, renamed when complete
+        # so readers never get partial files (leading dot keeps it out of globs)
+        with tempfile.NamedTemporaryFile(
+            dir=directory, prefix="." + path.name, suffix=".tmp", delete=False
+        ) as file:
+            temp = Path(file.name)
+        try:
+            WRITERS[fmt](drawing, temp)
+            temp.replace(path)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+    for old in directory.glob("%d-*" % drawing.id):
+        if get_export_version(old) < drawing.map_version:
+            old.unlink(missing_ok=True)
+    return path
+
+
+def get_export_version(path):
+    """Map version from "<id>-<version>.<suffix>" """
+    try:
+        return int(path.name.split("-")[1].split(".")[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def delete_exports(drawing_id):
+    for path in get_export_dir().glob("%d-*" % drawing_id):
+        path.unlink(missing_ok=True)
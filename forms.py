@@ -1,4 +1,6 @@
 from django.forms import ModelForm
+from django.utils.translation import gettext_lazy as _
+from djgeojson.fields import GeoJSONFormField
 from leaflet.forms.widgets import LeafletWidget
 
 from .models import Drawing, Dxf2Csv, Insertion, Layer
@@ -38,6 +40,7 @@ class DrawingUpdateForm(ModelForm):
             "designx",
             "designy",
             "rotation",
+            "max_sagitta",
             "private",
         ]
         widgets = {
@@ -56,16 +59,29 @@ class DrawingSimpleCreateForm(ModelForm):
 
 
 class LayerCreateForm(ModelForm):
+    # entities are stored one by one, but edited as a collection
+    geom = GeoJSONFormField(
+        label=_("Entities"),
+        geom_type="GEOMETRYCOLLECTION",
+        widget=LeafletWidget(
+            attrs={
+                "geom_type": "GeometryCollection",
+            }
+        ),
+    )
+
+    def __init__(self, *args, **kwargs):
+        super(LayerCreateForm, self).__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial.setdefault("geom", self.instance.geom)
+
+    def save(self, commit=True):
+        self.instance.geom = self.cleaned_data["geom"]
+        return super(LayerCreateForm, self).save(commit=commit)
+
     class Meta:
         model = Layer
         fields = ["name", "color_field", "linetype", "geom"]
-        widgets = {
-            "geom": LeafletWidget(
-                attrs={
-                    "geom_type": "GeometryCollection",
-                }
-            )
-        }
 
     class Media:
         js = ("djeocad/js/locate_drawing.js",)
@@ -77,7 +93,7 @@ class InsertionCreateForm(ModelForm):
         # filter layer queryset
         layer = Layer.objects.get(id=self.initial["layer"])
         self.fields["layer"].queryset = Layer.objects.filter(
-            drawing_id=layer.drawing.id, is_block=False
+            drawing_id=layer.drawing_id, is_block=False
         )
 
     class Meta:
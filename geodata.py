@@ -0,0 +1,117 @@
+from ezdxf.entities import GeoData
+
+from .documents import is_binary_dxf, read_document
+
+"""
+    Streaming scan of DXF files for the GEODATA object, so that drawings
+    can be georeferenced without loading the whole document
+"""
+
+# last digit of point group codes in AcDbGeoData subclass (10, 20, 30 etc.)
+POINTS = {0: "design_point", 1: "reference_point", 2: "north_direction"}
+
+
+def iter_tags(stream):
+    """Yields (code, value) pairs of an ASCII DXF, values keep their spaces"""
+    for code, value in zip(stream, stream):
+        yield int(code), value.rstrip("\r\n")
+
+
+def is_modelspace_geodata(tags, modelspace):
+    """
+    True if GEODATA tags belong to modelspace, owned by the extension
+    dictionary of its block record or pointing to the block record as host
+    """
+    if not modelspace:
+        # no block records to tell, i.e. R12 files
+        return True
+    subclass = False
+    for code, value in tags:
+        if code == 100 and value == "AcDbGeoData":
+            subclass = True
+        elif code == 330 and value in modelspace:
+            # owner in common tags, host block record in AcDbGeoData
+            if not subclass or value == modelspace[0]:
+                return True
+    return False
+
+
+def scan_geodata_tags(path):
+    """
+    Returns tags of the GEODATA object of modelspace in the OBJECTS
+    section, None if there is none. GEODATA of other blocks are skipped.
+    Stops reading the file as soon as the object ends.
+    """
+    section = None
+    tags = None
+    # handles of modelspace block record and of its extension dictionary
+    modelspace = ()
+    record = None
+    with open(path, encoding="utf-8", errors="ignore") as stream:
+        previous = None
+        for code, value in iter_tags(stream):
+            if tags is not None:
+                if code != 0:
+                    tags.append((code, value))
+                    continue
+                if is_modelspace_geodata(tags, modelspace):
+                    return tags
+                tags = None
+            if record is not None:
+                if code == 0:
+                    if record.get(2, "").upper() == "*MODEL_SPACE":
+                        modelspace = (record.get(5), record.get(360))
+                    record = None
+                else:
+                    record.setdefault(code, value)
+            if code == 0 and value == "BLOCK_RECORD" and section == "TABLES":
+                record = {}
+            elif code == 0 and value == "GEODATA" and section == "OBJECTS":
+                tags = []
+            elif code == 0 and value == "ENDSEC" and section == "OBJECTS":
+                return None
+            elif code == 2 and previous == (0, "SECTION"):
+                section = value
+            previous = (code, value)
+    if tags is not None and is_modelspace_geodata(tags, modelspace):
+        return tags
+    return None
+
+
+def build_geodata(tags):
+    """Builds a GeoData entity (not bound to any document) from tags"""
+    # skip tags of the common object subclass
+    for i, (code, value) in enumerate(tags):
+        if code == 100 and value == "AcDbGeoData":
+            tags = tags[i + 1 :]
+            break
+    version = int(dict(tags).get(90, 2))
+    points = {}
+    chunks = []
+    for code, value in tags:
+        if code in (301, 303):
+            chunks.append(value.replace("^J", "\n"))
+            continue
+        axis, base = divmod(code, 10)
+        # version 1 uses group code 12 for mesh points
+        if base in POINTS and axis in (1, 2, 3) and (version > 1 or base != 2):
+            points.setdefault(POINTS[base], [0.0, 0.0, 0.0])[axis - 1] = float(value)
+    geodata = GeoData.new(dxfattribs={"version": version})
+    for name, point in points.items():
+        geodata.dxf.set(name, point[:2] if name == "north_direction" else point)
+    geodata.coordinate_system_definition = "".join(chunks)
+    return geodata
+
+
+def read_geodata(path):
+    """
+    Returns GEODATA of DXF file at path, None if missing. ASCII files are
+    scanned tag by tag, binary ones are loaded (through the document
+    cache, extraction will need them next).
+    """
+    if is_binary_dxf(path):
+        return read_document(path).modelspace().get_geodata()
+    tags = scan_geodata_tags(path)
+    if tags is None:
+        return None
+    return build_geodata(tags)
@@ -0,0 +1,336 @@
+import json
+import logging
+import random
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from math import acos, atan, ceil, pi, radians
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.translation import gettext as _
+from ezdxf.math import Vec2
+
+"""
+    Optional timing of djeocad views: SQL, named stages and total time,
+    exposed as Server-Timing header and log lines
+"""
+
+logger = logging.getLogger("djeocad.instrumentation")
+
+_current = ContextVar("djeocad_timings", default=None)
+
+
+def get_sample_rate():
+    try:
+        return settings.DJEOCAD_INSTRUMENTATION_SAMPLE_RATE
+    except AttributeError:
+        return 1.0
+
+
+def trace_import_memory():
+    try:
+        return settings.DJEOCAD_IMPORT_TRACE_MEMORY
+    except AttributeError:
+        return False
+
+
+def get_import_budgets():
+    """
+    Wall-clock seconds, vertices and traced bytes an import may use, all
+    unlimited unless set
+    """
+    budgets = {"time": None, "vertices": None, "memory": None}
+    for key, name in [
+        ("time", "DJEOCAD_IMPORT_TIME_LIMIT"),
+        ("vertices", "DJEOCAD_IMPORT_MAX_VERTICES"),
+        ("memory", "DJEOCAD_IMPORT_MAX_MEMORY"),
+    ]:
+        try:
+            budgets[key] = getattr(settings, name)
+        except AttributeError:
+            pass
+    return budgets
+
+
+def is_enabled():
+    try:
+        return settings.DJEOCAD_INSTRUMENTATION
+    except AttributeError:
+        return False
+
+
+class RequestTimings:
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.stages = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        # database execute wrapper
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.sql_time += perf_counter() - start
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    """Times a block of code if current request is instrumented"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, perf_counter() - start)
+
+
+class TimingMiddleware:
+    """
+    Records SQL count and time, stages and total time of sampled requests
+    to djeocad views. Enabled by DJEOCAD_INSTRUMENTATION = True, sample
+    with DJEOCAD_INSTRUMENTATION_SAMPLE_RATE (0 to 1).
+    """
+
+    def __init__(self, get_response):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= get_sample_rate():
+            return self.get_response(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = perf_counter() - start
+        match = request.resolver_match
+        if not match or match.app_name != "djeocad":
+            return response
+        metrics = [
+            'sql;dur=%.1f;desc="%d queries"'
+            % (timings.sql_time * 1000, timings.sql_count)
+        ]
+        metrics += [
+            "%s;dur=%.1f" % (name, seconds * 1000)
+            for name, seconds in timings.stages.items()
+        ]
+        metrics.append("total;dur=%.1f" % (total * 1000))
+        response["Server-Timing"] = ", ".join(metrics)
+        logger.info(
+            json.dumps(
+                {
+                    "view": match.view_name,
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "sql_count": timings.sql_count,
+                    "sql_ms": round(timings.sql_time * 1000, 1),
+                    "stages_ms": {
+                        name: round(seconds * 1000, 1)
+                        for name, seconds in timings.stages.items()
+                    },
+                    "total_ms": round(total * 1000, 1),
+                }
+            )
+        )
+        return response
+
+
+def count_positions(coordinates):
+    """Counts positions in GeoJSON coordinates of any depth"""
+    if not coordinates:
+        return 0
+    if isinstance(coordinates[0], (int, float)):
+        return 1
+    return sum(count_positions(c) for c in coordinates)
+
+
+def count_vertices(geometry):
+    if geometry["type"] == "GeometryCollection":
+        return sum(count_vertices(g) for g in geometry["geometries"])
+    return count_positions(geometry["coordinates"])
+
+
+def arc_vertices(radius, angle, sagitta):
+    """Vertices of arc of radius and angle (radians) flattened within sagitta"""
+    if radius <= sagitta:
+        return 2
+    step = 2 * acos(1 - sagitta / radius)
+    return ceil(abs(angle) / step) + 1
+
+
+def bulge_vertices(start, end, bulge, sagitta):
+    """Vertices of polyline arc segment from start to end with bulge"""
+    chord = start.distance(end)
+    if not bulge or not chord:
+        return 1
+    radius = chord * (1 + bulge**2) / (4 * abs(bulge))
+    return arc_vertices(radius, 4 * atan(bulge), sagitta) - 1
+
+
+def frame_vertices(points, sagitta):
+    """
+    Vertices of a curve following a frame of points (spline control or
+    fit points): frame turning angle over its length gives mean radius
+    """
+    points = [Vec2(p) for p in points]
+    segments = [b - a for a, b in zip(points, points[1:]) if not a.isclose(b)]
+    length = sum(segment.magnitude for segment in segments)
+    turning = sum(a.angle_between(b) for a, b in zip(segments, segments[1:]))
+    if not turning:
+        return len(points)
+    return max(len(points), arc_vertices(length / turning, turning, sagitta))
+
+
+def edge_vertices(edge, sagitta):
+    kind = type(edge).__name__
+    if kind == "ArcEdge":
+        angle = radians((edge.end_angle - edge.start_angle) % 360 or 360)
+        return arc_vertices(edge.radius, angle, sagitta)
+    if kind == "EllipseEdge":
+        angle = radians((edge.end_angle - edge.start_angle) % 360 or 360)
+        return arc_vertices(Vec2(edge.major_axis).magnitude, angle, sagitta)
+    if kind == "SplineEdge":
+        return frame_vertices(edge.control_points or edge.fit_points, sagitta)
+    return 2
+
+
+def path_vertices(path, sagitta):
+    if hasattr(path, "edges"):
+        return sum(edge_vertices(edge, sagitta) for edge in path.edges)
+    vertices = [(v[0], v[1], v[2] if len(v) > 2 else 0) for v in path.vertices]
+    return len(vertices) + sum(
+        bulge_vertices(Vec2(a[:2]), Vec2(b[:2]), a[2], sagitta) - 1
+        for a, b in zip(vertices, vertices[1:])
+        if a[2]
+    )
+
+
+def estimate_vertices(entity, sagitta):
+    """
+    Vertices entity is expected to have once curves are flattened within
+    sagitta, without flattening it. Upper bound for arcs and circles, a
+    rough guess for splines.
+    """
+    kind = entity.dxftype()
+    if kind == "CIRCLE":
+        return arc_vertices(entity.dxf.radius, 2 * pi, sagitta)
+    if kind == "ARC":
+        angle = (entity.dxf.end_angle - entity.dxf.start_angle) % 360 or 360
+        return arc_vertices(entity.dxf.radius, radians(angle), sagitta)
+    if kind == "ELLIPSE":
+        angle = (entity.dxf.end_param - entity.dxf.start_param) % (2 * pi) or 2 * pi
+        return arc_vertices(Vec2(entity.dxf.major_axis).magnitude, angle, sagitta)
+    if kind == "SPLINE":
+        if entity.control_point_count():
+            return frame_vertices(entity.control_points, sagitta)
+        return frame_vertices(entity.fit_points, sagitta)
+    if kind == "LWPOLYLINE":
+        points = list(entity.get_points("xyb"))
+        return len(points) + sum(
+            bulge_vertices(Vec2(a[:2]), Vec2(b[:2]), a[2], sagitta) - 1
+            for a, b in zip(points, points[1:])
+            if a[2]
+        )
+    if kind == "HATCH":
+        return sum(path_vertices(path, sagitta) for path in entity.paths)
+    return 0
+
+
+class ImportBudgetExceeded(Exception):
+    pass
+
+
+class ExtractionStats:
+    """
+    Stage timings, entity and vertex counts by DXF type, dropped invalid
+    polygons and peak memory of a DXF import. Plain data, so it can travel
+    back from worker processes.
+    """
+
+    def __init__(self):
+        self.timings = Counter()
+        self.entities = Counter()
+        self.vertices = Counter()
+        self.dropped_polygons = 0
+        self.peak_memory = None
+        self.file_size = None
+        self.truncated = None
+        self._start = None
+        self._tracing = False
+        self._budgets = None
+
+    def start(self):
+        """Starts total time, memory tracing and import budgets"""
+        self._start = perf_counter()
+        self._budgets = get_import_budgets()
+        # tracing slows allocations down, it's off by default
+        if trace_import_memory() or self._budgets["memory"]:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+
+    def stop(self):
+        if self._start is not None:
+            self.timings["total"] += perf_counter() - self._start
+            self._start = None
+        if self._tracing:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self._tracing = False
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += perf_counter() - start
+
+    def check_budgets(self, entity=None, sagitta=None):
+        """
+        Raises ImportBudgetExceeded if started import is over budget, or
+        would be after converting entity: once started, flattening of a
+        huge curve can't be interrupted, so its vertices are estimated
+        """
+        if not self._budgets or self._start is None:
+            return
+        limit = self._budgets["time"]
+        if limit and perf_counter() - self._start > limit:
+            raise ImportBudgetExceeded(_("time limit of %ss exceeded") % limit)
+        limit = self._budgets["vertices"]
+        if limit:
+            vertices = sum(self.vertices.values())
+            if entity is not None and vertices <= limit:
+                vertices += estimate_vertices(entity, sagitta)
+            if vertices > limit:
+                raise ImportBudgetExceeded(_("limit of %d vertices exceeded") % limit)
+        limit = self._budgets["memory"]
+        if limit and tracemalloc.is_tracing():
+            if tracemalloc.get_traced_memory()[0] > limit:
+                raise ImportBudgetExceeded(
+                    _("memory limit of %d bytes exceeded") % limit
+                )
+
+    def count(self, dxftype, geo_interface):
+        self.entities[dxftype] += 1
+        self.vertices[dxftype] += count_vertices(geo_interface)
@@ -0,0 +1,100 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...benchmark import CASES, compare_benchmarks, make_dxf, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Times and memory-profiles the geometry pipeline on synthetic DXF files, "
+        "writes results as JSON. Database changes are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--case",
+            action="append",
+            choices=list(CASES),
+            help="Size of generated DXF, may be repeated (default: small)",
+        )
+        for name in CASES["small"]:
+            parser.add_argument(
+                "--" + name,
+                type=int,
+                help="Custom case: number of %s" % name,
+            )
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="Timed runs per operation"
+        )
+        parser.add_argument(
+            "--output", default="djeocad-benchmark.json", help="JSON results file"
+        )
+        parser.add_argument("--compare", help="Previous JSON results file")
+        parser.add_argument(
+            "--generate",
+            help="Only write DXF of first case to this path, for external tools",
+        )
+
+    def handle(self, *args, **options):
+        custom = {
+            name: options[name] for name in CASES["small"] if options[name] is not None
+        }
+        cases = {name: CASES[name] for name in options["case"] or []}
+        if custom:
+            cases["custom"] = dict(CASES["small"], **custom)
+        if not cases:
+            cases["small"] = CASES["small"]
+        if options["generate"]:
+            path = make_dxf(options["generate"], **next(iter(cases.values())))
+            self.stdout.write("Written %s" % path)
+            return
+        previous = None
+        if options["compare"]:
+            try:
+                previous = json.loads(Path(options["compare"]).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError("Can't read %s: %s" % (options["compare"], e))
+        results = run_benchmarks(cases, repeat=options["repeat"])
+        Path(options["output"]).write_text(json.dumps(results, indent=2))
+        for name, case in results["cases"].items():
+            for operation, result in case["results"].items():
+                self.stdout.write(
+                    "%s %s: %.4fs (mean %.4fs), peak %d KiB"
+                    % (
+                        name,
+                        operation,
+                        result["min"],
+                        result["mean"],
+                        result["peak_kb"],
+                    )
+                )
+            for size in case["flattening"]:
+                self.stdout.write(
+                    "%s max sagitta %sm: %d vertices, payload %.1f KiB"
+                    % (name, size["max_sagitta"], size["vertices"], size["payload_kb"])
+                )
+            for size in case["encoding"]:
+                self.stdout.write(
+                    "%s precision %s: stored %.1f KiB, payload %.1f KiB, "
+                    "delta encoded %.1f KiB, TopoJSON %.1f KiB"
+                    % (
+                        name,
+                        size["precision"],
+                        size["stored_kb"],
+                        size["payload_kb"],
+                        size["delta_kb"],
+                        size["topojson_kb"],
+                    )
+                )
+        if previous:
+            for name, operation, old, new, ratio in compare_benchmarks(
+                previous, results
+            ):
+                self.stdout.write(
+                    "%s %s: %.4fs -> %.4fs (x%.2f)" % (name, operation, old, new, ratio)
+                )
+        self.stdout.write(
+            self.style.SUCCESS("Results written to %s" % options["output"])
+        )
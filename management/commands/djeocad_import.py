@@ -0,0 +1,245 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from time import perf_counter
+
+import django
+import ezdxf
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from ...instrumentation import ExtractionStats
+from ...models import AuthorSummary, Drawing
+
+User = get_user_model()
+
+
+def parse_file(job):
+    """Georeferences and extracts a DXF file, runs in worker processes"""
+    start = perf_counter()
+    drawing = Drawing(
+        title=job["title"],
+        private=job["private"],
+        geom=job["geom"],
+        designx=job["designx"],
+        designy=job["designy"],
+        rotation=job["rotation"],
+    )
+    stats = ExtractionStats()
+    stats.start()
+    # a broken file must not stop the whole import
+    try:
+        stats.file_size = Path(job["path"]).stat().st_size
+        with stats.timer("read"):
+            doc = ezdxf.readfile(job["path"])
+        if not drawing.georeference(doc.modelspace().get_geodata()):
+            return dict(job, error="missing location or invalid geodata")
+        data = drawing.parse_dxf(doc, stats)
+    except Exception as e:
+        return dict(job, error=repr(e))
+    finally:
+        stats.stop()
+    return dict(
+        job,
+        geom=drawing.geom,
+        designx=drawing.designx,
+        designy=drawing.designy,
+        rotation=drawing.rotation,
+        epsg=drawing.epsg,
+        data=data,
+        seconds=perf_counter() - start,
+    )
+
+
+def count_geometries(data):
+    count = sum(len(layer["geometries"]) for layer in data["layers"].values())
+    count += sum(len(block["geometries"]) for block in data["blocks"].values())
+    return count + sum(len(ins["geometries"]) for ins in data["insertions"])
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports DXF files of a directory, or listed in a manifest CSV with "
+        "columns file, title, owner, lon, lat, designx, designy, rotation "
+        "(optional: private, intro). Files are parsed by a pool of processes "
+        "and stored in batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="Directory of DXF files or CSV manifest")
+        parser.add_argument(
+            "--owner", help="Username of the author, if missing from manifest"
+        )
+        parser.add_argument("--lon", type=float, help="Default location longitude")
+        parser.add_argument("--lat", type=float, help="Default location latitude")
+        parser.add_argument(
+            "--private", action="store_true", help="Import as private drawings"
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=20,
+            help="Number of drawings stored per transaction",
+        )
+
+    def handle(self, *args, **options):
+        source = Path(options["source"])
+        if source.is_dir():
+            jobs = self.jobs_from_directory(source, options)
+        elif source.is_file():
+            jobs = self.jobs_from_manifest(source, options)
+        else:
+            raise CommandError("%s does not exist" % source)
+        if not jobs:
+            raise CommandError("No DXF files to import")
+        owners = self.get_owners(jobs)
+        start = perf_counter()
+        imported = failed = geometries = size = 0
+        batch = []
+        for result in self.parse_files(jobs, options["workers"]):
+            if "error" in result:
+                failed += 1
+                self.stderr.write("%s: %s" % (result["path"], result["error"]))
+                continue
+            self.stdout.write("%s: %.2fs" % (result["path"], result["seconds"]))
+            geometries += count_geometries(result["data"])
+            size += Path(result["path"]).stat().st_size
+            batch.append(result)
+            if len(batch) >= options["batch_size"]:
+                imported += self.persist(batch, owners)
+                batch = []
+        if batch:
+            imported += self.persist(batch, owners)
+        for user in {owners[job["owner"]] for job in jobs}:
+            AuthorSummary.refresh_for(user.pk)
+        elapsed = perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Imported %d drawings (%d failed) in %.1fs: %.2f drawings/s, "
+                "%.0f entities/s, %.2f MB/s"
+                % (
+                    imported,
+                    failed,
+                    elapsed,
+                    imported / elapsed,
+                    geometries / elapsed,
+                    size / elapsed / 1024**2,
+                )
+            )
+        )
+
+    def parse_files(self, jobs, workers):
+        """Yields parsed files as soon as they are ready"""
+        if workers <= 1:
+            yield from map(parse_file, jobs)
+            return
+        # forked workers must not share database connections
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=django.setup
+        ) as executor:
+            futures = [executor.submit(parse_file, job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def jobs_from_directory(self, source, options):
+        if not options["owner"]:
+            raise CommandError("--owner is required when importing a directory")
+        geom = self.get_point(options["lon"], options["lat"])
+        return [
+            {
+                "path": str(path),
+                "title": path.stem[:50],
+                "owner": options["owner"],
+                "intro": None,
+                "private": options["private"],
+                "geom": geom,
+                "designx": 0,
+                "designy": 0,
+                "rotation": 0,
+            }
+            for path in sorted(source.iterdir())
+            if path.suffix.lower() == ".dxf"
+        ]
+
+    def jobs_from_manifest(self, source, options):
+        jobs = []
+        with open(source, newline="") as f:
+            for row in csv.DictReader(f):
+                path = source.parent.joinpath(row["file"])
+                lon = row.get("lon") or options["lon"]
+                lat = row.get("lat") or options["lat"]
+                private = row.get("private", "").lower() in ("1", "true", "yes")
+                jobs.append(
+                    {
+                        "path": str(path),
+                        "title": (row.get("title") or path.stem)[:50],
+                        "owner": row.get("owner") or options["owner"],
+                        "intro": row.get("intro") or None,
+                        "private": private or options["private"],
+                        "geom": self.get_point(lon, lat),
+                        "designx": float(row.get("designx") or 0),
+                        "designy": float(row.get("designy") or 0),
+                        "rotation": float(row.get("rotation") or 0),
+                    }
+                )
+        return jobs
+
+    def get_point(self, lon, lat):
+        if lon is None or lat is None:
+            return None
+        return {"type": "Point", "coordinates": [float(lon), float(lat)]}
+
+    def get_owners(self, jobs):
+        usernames = {job["owner"] for job in jobs}
+        if None in usernames:
+            raise CommandError("Drawings without owner, use --owner")
+        owners = {
+            getattr(user, User.USERNAME_FIELD): user
+            for user in User.objects.filter(**{User.USERNAME_FIELD + "__in": usernames})
+        }
+        missing = usernames - set(owners)
+        if missing:
+            raise CommandError("Unknown owners: %s" % ", ".join(sorted(missing)))
+        return owners
+
+    def persist(self, batch, owners):
+        with transaction.atomic():
+            drawings = []
+            for result in batch:
+                drawing = Drawing(
+                    user=owners[result["owner"]],
+                    title=result["title"],
+                    intro=result["intro"],
+                    private=result["private"],
+                    geom=result["geom"],
+                    designx=result["designx"],
+                    designy=result["designy"],
+                    rotation=result["rotation"],
+                    epsg=result["epsg"],
+                )
+                path = Path(result["path"])
+                with open(path, "rb") as f:
+                    drawing.dxf = File(f, name=path.name)
+                    drawing.store_dxf()
+                # identical imports may clone extracted layers
+                result["data"]["signature"] = drawing.get_import_signature()
+                drawings.append(drawing)
+            if connection.features.can_return_rows_from_bulk_insert:
+                Drawing.objects.bulk_create(drawings)
+            else:
+                for drawing in drawings:
+                    super(Drawing, drawing).save()
+            Drawing.persist_extracted(
+                [(drawing, result["data"]) for drawing, result in zip(drawings, batch)]
+            )
+        return len(drawings)
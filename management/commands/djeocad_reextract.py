@@ -0,0 +1,218 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from pathlib import Path
+from time import perf_counter
+
+import django
+import ezdxf
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from ...instrumentation import ExtractionStats
+from ...models import Drawing, Layer
+from .djeocad_import import count_geometries
+
+
+def parse_drawing(job):
+    """Extracts DXF file of an existing drawing, runs in worker processes"""
+    start = perf_counter()
+    drawing = Drawing(
+        id=job["id"],
+        private=job["private"],
+        geom=job["geom"],
+        designx=job["designx"],
+        designy=job["designy"],
+        rotation=job["rotation"],
+        epsg=job["epsg"],
+        max_sagitta=job["max_sagitta"],
+        dxf_hash=job["dxf_hash"],
+    )
+    stats = ExtractionStats()
+    stats.start()
+    # a broken file must not stop the whole run
+    try:
+        stats.file_size = Path(job["path"]).stat().st_size
+        with stats.timer("read"):
+            doc = ezdxf.readfile(job["path"])
+        data = drawing.parse_dxf(doc, stats)
+    except Exception as e:
+        return dict(job, error=repr(e))
+    finally:
+        stats.stop()
+    return dict(job, data=data, seconds=perf_counter() - start)
+
+
+class Command(BaseCommand):
+    help = (
+        "Extracts again DXF files of existing drawings, replacing their layers, "
+        "blocks and insertions. Useful after upgrading ezdxf or changing "
+        "extraction settings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Drawing ids")
+        parser.add_argument("--author", help="Only drawings of this username")
+        parser.add_argument(
+            "--modified-before",
+            type=date.fromisoformat,
+            help="Only drawings last modified before date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--private", action="store_true", help="Only private drawings"
+        )
+        parser.add_argument(
+            "--public", action="store_true", help="Only public drawings"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List drawings without extracting them",
+        )
+        parser.add_argument(
+            "--state-file",
+            help="File recording extracted drawings, they are skipped on rerun",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=20,
+            help="Number of drawings stored per transaction",
+        )
+
+    def handle(self, *args, **options):
+        drawings = self.get_queryset(options)
+        done = set()
+        state = None
+        if options["state_file"]:
+            state = Path(options["state_file"])
+            if state.exists():
+                done = {int(line) for line in state.read_text().split()}
+        jobs = [
+            {
+                "id": id,
+                "path": str(Path(settings.MEDIA_ROOT).joinpath(dxf)),
+                "private": private,
+                "geom": geom,
+                "designx": designx,
+                "designy": designy,
+                "rotation": rotation,
+                "epsg": epsg,
+                "max_sagitta": max_sagitta,
+                "dxf_hash": dxf_hash,
+            }
+            for (
+                id,
+                dxf,
+                private,
+                geom,
+                designx,
+                designy,
+                rotation,
+                epsg,
+                max_sagitta,
+                dxf_hash,
+            ) in (
+                drawings.values_list(
+                    "id",
+                    "dxf",
+                    "private",
+                    "geom",
+                    "designx",
+                    "designy",
+                    "rotation",
+                    "epsg",
+                    "max_sagitta",
+                    "dxf_hash",
+                )
+            )
+            if id not in done
+        ]
+        if done:
+            self.stdout.write("Skipping %d drawings already extracted" % len(done))
+        if options["dry_run"]:
+            for job in jobs:
+                self.stdout.write("%d: %s" % (job["id"], job["path"]))
+            self.stdout.write("%d drawings would be extracted" % len(jobs))
+            return
+        start = perf_counter()
+        extracted = failed = 0
+        batch = []
+        for result in self.parse_drawings(jobs, options["workers"]):
+            if "error" in result:
+                failed += 1
+                self.stderr.write("%d: %s" % (result["id"], result["error"]))
+                continue
+            self.stdout.write(
+                "%d: %d entities in %.2fs"
+                % (result["id"], count_geometries(result["data"]), result["seconds"])
+            )
+            batch.append(result)
+            if len(batch) >= options["batch_size"]:
+                extracted += self.persist(batch, state)
+                batch = []
+        if batch:
+            extracted += self.persist(batch, state)
+        elapsed = perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Extracted %d drawings (%d failed) in %.1fs"
+                % (extracted, failed, elapsed)
+            )
+        )
+
+    def get_queryset(self, options):
+        if options["private"] and options["public"]:
+            raise CommandError("--private and --public are mutually exclusive")
+        # without location and CRS drawings can't be extracted
+        drawings = Drawing.objects.exclude(geom=None).exclude(epsg=None)
+        if options["ids"]:
+            drawings = drawings.filter(id__in=options["ids"])
+        if options["author"]:
+            drawings = drawings.filter(user__username=options["author"])
+        if options["modified_before"]:
+            drawings = drawings.filter(modified__date__lt=options["modified_before"])
+        if options["private"]:
+            drawings = drawings.filter(private=True)
+        if options["public"]:
+            drawings = drawings.filter(private=False)
+        return drawings.order_by("id")
+
+    def parse_drawings(self, jobs, workers):
+        """Yields parsed drawings as soon as they are ready"""
+        if workers <= 1:
+            yield from map(parse_drawing, jobs)
+            return
+        # forked workers must not share database connections
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=django.setup
+        ) as executor:
+            futures = [executor.submit(parse_drawing, job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def persist(self, batch, state):
+        start = perf_counter()
+        ids = [result["id"] for result in batch]
+        with transaction.atomic():
+            Layer.objects.filter(drawing_id__in=ids).delete()
+            Drawing.persist_extracted(
+                [(Drawing(id=result["id"]), result["data"]) for result in batch]
+            )
+            # flag drawings as refreshable
+            Drawing.objects.filter(id__in=ids).update(needs_refresh=True)
+        if state:
+            with open(state, "a") as f:
+                f.write("".join("%d\n" % id for id in ids))
+        self.stdout.write(
+            "Stored %d drawings in %.2fs" % (len(batch), perf_counter() - start)
+        )
+        return len(batch)
@@ -0,0 +1,99 @@
+# Generated by Django 4.1.1 on 2026-10-19 09:12
+
+import json
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.utils import timezone
+
+
+def populate_author_summaries(apps, schema_editor):
+    Drawing = apps.get_model("djeocad", "Drawing")
+    AuthorSummary = apps.get_model("djeocad", "AuthorSummary")
+    authors = Drawing.objects.values("user_id", "user__username").annotate(
+        public=Count("id", filter=Q(private=False)),
+        private=Count("id", filter=Q(private=True)),
+    )
+    now = timezone.now()
+    for author in authors:
+        extent = None
+        geoms = Drawing.objects.filter(user_id=author["user_id"]).exclude(geom=None)
+        for geom in geoms.values_list("geom", flat=True):
+            if isinstance(geom, str):
+                geom = json.loads(geom)
+            if not geom:
+                continue
+            lon, lat = geom["coordinates"][0], geom["coordinates"][1]
+            if not extent:
+                extent = [lon, lat, lon, lat]
+                continue
+            extent = [
+                min(extent[0], lon),
+                min(extent[1], lat),
+                max(extent[2], lon),
+                max(extent[3], lat),
+            ]
+        AuthorSummary.objects.create(
+            user_id=author["user_id"],
+            username=author["user__username"],
+            public_drawings=author["public"],
+            private_drawings=author["private"],
+            last_update=now,
+            extent=extent,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("djeocad", "0017_dxf2csv"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AuthorSummary",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="drawing_summary",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Author",
+                    ),
+                ),
+                (
+                    "username",
+                    models.CharField(max_length=150, verbose_name="Username"),
+                ),
+                (
+                    "public_drawings",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Public drawings"
+                    ),
+                ),
+                (
+                    "private_drawings",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Private drawings"
+                    ),
+                ),
+                (
+                    "last_update",
+                    models.DateTimeField(null=True, verbose_name="Last update"),
+                ),
+                ("extent", models.JSONField(null=True, verbose_name="Extent")),
+            ],
+            options={
+                "verbose_name": "Author summary",
+                "verbose_name_plural": "Author summaries",
+                "ordering": ("username",),
+            },
+        ),
+        migrations.RunPython(populate_author_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1.1 on 2026-10-19 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0018_authorsummary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="map_version",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Map data version"
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.1 on 2026-10-19 11:26
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0019_drawing_map_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="modified",
+            field=models.DateTimeField(
+                auto_now=True,
+                default=django.utils.timezone.now,
+                verbose_name="Last modified",
+            ),
+            preserve_default=False,
+        ),
+    ]
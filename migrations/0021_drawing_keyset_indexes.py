@@ -0,0 +1,21 @@
+# Generated by Django 4.1.1 on 2026-10-19 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0020_drawing_modified"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="drawing",
+            index=models.Index(fields=["private", "id"], name="drawing_private_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="drawing",
+            index=models.Index(fields=["user", "id"], name="drawing_user_id_idx"),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 4.1.1 on 2026-10-19 13:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0021_drawing_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Imported"),
+                ),
+                (
+                    "duration",
+                    models.FloatField(default=0, verbose_name="Duration (s)"),
+                ),
+                (
+                    "file_size",
+                    models.PositiveBigIntegerField(
+                        null=True, verbose_name="File size (bytes)"
+                    ),
+                ),
+                (
+                    "timings",
+                    models.JSONField(default=dict, verbose_name="Stage timings (s)"),
+                ),
+                (
+                    "entities",
+                    models.JSONField(default=dict, verbose_name="Entities by type"),
+                ),
+                (
+                    "vertices",
+                    models.JSONField(default=dict, verbose_name="Vertices by type"),
+                ),
+                (
+                    "total_entities",
+                    models.PositiveIntegerField(default=0, verbose_name="Entities"),
+                ),
+                (
+                    "total_vertices",
+                    models.PositiveIntegerField(default=0, verbose_name="Vertices"),
+                ),
+                (
+                    "dropped_polygons",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Dropped invalid polygons"
+                    ),
+                ),
+                (
+                    "peak_memory",
+                    models.PositiveBigIntegerField(
+                        null=True, verbose_name="Peak memory (bytes)"
+                    ),
+                ),
+                (
+                    "drawing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="import_stats",
+                        to="djeocad.drawing",
+                        verbose_name="Drawing",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Import stats",
+                "verbose_name_plural": "Import stats",
+                "ordering": ("-created",),
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.1 on 2026-10-19 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0022_importstats"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="truncated",
+            field=models.BooleanField(
+                default=False, editable=False, verbose_name="Partially imported"
+            ),
+        ),
+        migrations.AddField(
+            model_name="drawing",
+            name="truncation_reason",
+            field=models.CharField(
+                editable=False,
+                max_length=200,
+                null=True,
+                verbose_name="Reason of partial import",
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.1 on 2026-10-19 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0023_drawing_truncated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="max_sagitta",
+            field=models.FloatField(
+                blank=True,
+                help_text=(
+                    "Maximum distance in meters between curves and their "
+                    "segments, leave blank for default"
+                ),
+                null=True,
+                verbose_name="Curve tolerance",
+            ),
+        ),
+    ]
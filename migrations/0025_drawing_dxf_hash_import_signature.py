@@ -0,0 +1,35 @@
+# Generated by Django 4.1.1 on 2026-10-19 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0024_drawing_max_sagitta"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="dxf_hash",
+            field=models.CharField(
+                db_index=True,
+                editable=False,
+                max_length=64,
+                null=True,
+                verbose_name="DXF file hash",
+            ),
+        ),
+        migrations.AddField(
+            model_name="drawing",
+            name="import_signature",
+            field=models.CharField(
+                db_index=True,
+                editable=False,
+                max_length=64,
+                null=True,
+                verbose_name="Import signature",
+            ),
+        ),
+    ]
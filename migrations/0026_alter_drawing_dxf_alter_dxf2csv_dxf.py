@@ -0,0 +1,48 @@
+# Generated by Django 4.1.1 on 2026-10-19 16:05
+
+import django.core.validators
+from django.db import migrations, models
+
+import djeocad.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0025_drawing_dxf_hash_import_signature"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="drawing",
+            name="dxf",
+            field=models.FileField(
+                help_text="ASCII or binary DXF, also gzip or zip compressed",
+                max_length=200,
+                upload_to="uploads/djeocad/dxf/",
+                validators=[
+                    django.core.validators.FileExtensionValidator(
+                        allowed_extensions=["dxf", "gz", "zip"]
+                    ),
+                    djeocad.utils.validate_dxf_file,
+                ],
+                verbose_name="DXF file",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="dxf2csv",
+            name="dxf",
+            field=models.FileField(
+                help_text="ASCII or binary DXF, also gzip or zip compressed",
+                max_length=200,
+                upload_to="uploads/djeocad/dxf/",
+                validators=[
+                    django.core.validators.FileExtensionValidator(
+                        allowed_extensions=["dxf", "gz", "zip"]
+                    ),
+                    djeocad.utils.validate_dxf_file,
+                ],
+                verbose_name="DXF file",
+            ),
+        ),
+    ]
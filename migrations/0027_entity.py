@@ -0,0 +1,159 @@
+# Generated by Django 4.1.1 on 2026-10-19 17:20
+
+import json
+
+import django.db.models.deletion
+import djgeojson.fields
+from django.db import migrations, models
+
+
+def iter_positions(coordinates):
+    if not coordinates:
+        return
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for c in coordinates:
+        yield from iter_positions(c)
+
+
+def get_geometry_positions(geometry):
+    if not geometry:
+        return
+    if geometry["type"] == "GeometryCollection":
+        for g in geometry["geometries"]:
+            yield from get_geometry_positions(g)
+        return
+    yield from iter_positions(geometry["coordinates"])
+
+
+def get_geometry_bounds(geometry):
+    # copied from djeocad.utils, migrations don't depend on current code
+    positions = [p[:2] for p in get_geometry_positions(geometry)]
+    if not positions:
+        return None
+    xs, ys = zip(*positions)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def split_layers(apps, schema_editor):
+    Layer = apps.get_model("djeocad", "Layer")
+    Entity = apps.get_model("djeocad", "Entity")
+    entities = []
+    for layer in Layer.objects.only("id", "geom").iterator(chunk_size=500):
+        geom = layer.geom
+        if isinstance(geom, str):
+            geom = json.loads(geom)
+        if not geom:
+            continue
+        for geometry in geom["geometries"]:
+            bounds = get_geometry_bounds(geometry) or (None, None, None, None)
+            entities.append(
+                Entity(
+                    layer_id=layer.id,
+                    geom=geometry,
+                    geom_type=geometry["type"],
+                    minx=bounds[0],
+                    miny=bounds[1],
+                    maxx=bounds[2],
+                    maxy=bounds[3],
+                )
+            )
+        if len(entities) >= 500:
+            Entity.objects.bulk_create(entities)
+            entities = []
+    Entity.objects.bulk_create(entities)
+
+
+def join_layers(apps, schema_editor):
+    Layer = apps.get_model("djeocad", "Layer")
+    Entity = apps.get_model("djeocad", "Entity")
+    for layer in Layer.objects.iterator(chunk_size=500):
+        entities = Entity.objects.filter(layer_id=layer.id).order_by("id")
+        layer.geom = {
+            "geometries": list(entities.values_list("geom", flat=True)),
+            "type": "GeometryCollection",
+        }
+        layer.save(update_fields=["geom"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0026_alter_drawing_dxf_alter_dxf2csv_dxf"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Entity",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("geom", djgeojson.fields.GeometryField(verbose_name="Geometry")),
+                (
+                    "geom_type",
+                    models.CharField(
+                        editable=False, max_length=20, verbose_name="Geometry type"
+                    ),
+                ),
+                (
+                    "handle",
+                    models.CharField(
+                        blank=True,
+                        editable=False,
+                        max_length=16,
+                        verbose_name="DXF handle",
+                    ),
+                ),
+                ("minx", models.FloatField(editable=False, null=True)),
+                ("miny", models.FloatField(editable=False, null=True)),
+                ("maxx", models.FloatField(editable=False, null=True)),
+                ("maxy", models.FloatField(editable=False, null=True)),
+                (
+                    "layer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="related_entities",
+                        to="djeocad.layer",
+                        verbose_name="Layer / block",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Entity",
+                "verbose_name_plural": "Entities",
+                "ordering": ("id",),
+                "indexes": [
+                    models.Index(
+                        fields=["layer", "geom_type"], name="entity_layer_type_idx"
+                    ),
+                    models.Index(
+                        fields=["layer", "handle"], name="entity_layer_handle_idx"
+                    ),
+                    models.Index(
+                        fields=["minx", "miny", "maxx", "maxy"], name="entity_bbox_idx"
+                    ),
+                ],
+            },
+        ),
+        # a default lets the field be added back when migrating backwards
+        migrations.AlterField(
+            model_name="layer",
+            name="geom",
+            field=djgeojson.fields.GeometryCollectionField(
+                default=dict, verbose_name="Entities"
+            ),
+        ),
+        migrations.RunPython(split_layers, join_layers),
+        migrations.RemoveField(
+            model_name="layer",
+            name="geom",
+        ),
+    ]
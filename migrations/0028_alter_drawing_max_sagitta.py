@@ -0,0 +1,28 @@
+# Generated by Django 4.1.1 on 2026-10-19 19:05
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djeocad", "0027_entity"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="drawing",
+            name="max_sagitta",
+            field=models.FloatField(
+                blank=True,
+                help_text=(
+                    "Maximum distance in meters between curves and their "
+                    "segments, leave blank for default"
+                ),
+                null=True,
+                validators=[django.core.validators.MinValueValidator(0.001)],
+                verbose_name="Curve tolerance",
+            ),
+        ),
+    ]
@@ -1,17 +1,27 @@
+import hashlib
 import json
+from io import StringIO
 from math import atan2, cos, degrees, radians, sin
 from pathlib import Path
+from time import perf_counter
 
 import ezdxf
+import numpy as np
+import shapely
 from colorfield.fields import ColorField
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.validators import FileExtensionValidator
-from django.db import IntegrityError, models
+from django.core.files.base import ContentFile
+from django.core.validators import FileExtensionValidator, MinValueValidator
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Max, Q
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from djgeojson.fields import GeometryCollectionField, PointField
+from djgeojson.fields import GeometryCollectionField, GeometryField, PointField
 from ezdxf.addons import geo
+from ezdxf.entities import GeoData
+from ezdxf.entities import Point as PointEntity
 from ezdxf.lldxf.const import InvalidGeoDataException
 from ezdxf.math import Vec3
 from filebrowser.base import FileObject
@@ -20,14 +30,54 @@ from PIL import ImageColor
 from pyproj import Transformer
 from pyproj.aoi import AreaOfInterest
 from pyproj.database import query_utm_crs_info
-from shapely.geometry import Point, shape
+from shapely.geometry import Point, mapping, shape
 from shapely.geometry.polygon import Polygon
 
-from .utils import cad2hex, check_wide_image
+from .documents import read_document
+from .geodata import read_geodata
+from .instrumentation import ExtractionStats, ImportBudgetExceeded, stage
+from .payloads import schedule_payload_files
+from .utils import (
+    cad2hex,
+    get_coordinate_precision,
+    get_geometry_bounds,
+    quantize_geometry,
+    schedule_image_versions,
+    transform_geometries,
+    unpack_dxf,
+    validate_dxf_file,
+    wait_image_versions,
+)
 
 User = get_user_model()
 
 
+class DrawingQuerySet(models.QuerySet):
+    def touch(self, **fields):
+        """Marks drawings as changed without loading them"""
+        return self.update(
+            map_version=F("map_version") + 1, modified=timezone.now(), **fields
+        )
+
+
+# compressed DXF files are accepted too
+DXF_EXTENSIONS = ["dxf", "gz", "zip"]
+
+# settings changing extracted geometries, part of import signature
+EXTRACTION_SETTINGS = [
+    "DJEOCAD_MAX_ENTITIES",
+    "DJEOCAD_MAX_SAGITTA",
+    "DJEOCAD_COORDINATE_PRECISION",
+    "DJEOCAD_INVALID_POLYGONS",
+]
+
+
+def delete_unreferenced_dxf(storage, name):
+    """Deletes stored DXF file unless a drawing refers to it"""
+    if not Drawing.objects.filter(dxf=name).exists():
+        storage.delete(name)
+
+
 class Drawing(models.Model):
 
     user = models.ForeignKey(
@@ -60,14 +110,19 @@ class Drawing(models.Model):
         _("DXF file"),
         max_length=200,
         upload_to="uploads/djeocad/dxf/",
+        help_text=_("ASCII or binary DXF, also gzip or zip compressed"),
         validators=[
-            FileExtensionValidator(
-                allowed_extensions=[
-                    "dxf",
-                ]
-            )
+            FileExtensionValidator(allowed_extensions=DXF_EXTENSIONS),
+            validate_dxf_file,
         ],
     )
+    dxf_hash = models.CharField(
+        _("DXF file hash"),
+        null=True,
+        max_length=64,
+        editable=False,
+        db_index=True,
+    )
     geom = PointField(_("Location"), null=True)
     designx = models.FloatField(
         _("Design point X..."),
@@ -81,6 +136,16 @@ class Drawing(models.Model):
         _("Rotation"),
         default=0,
     )
+    max_sagitta = models.FloatField(
+        _("Curve tolerance"),
+        null=True,
+        blank=True,
+        help_text=_(
+            "Maximum distance in meters between curves and their segments, "
+            "leave blank for default"
+        ),
+        validators=[MinValueValidator(0.001)],
+    )
     private = models.BooleanField(
         _("Private drawing"),
         default=False,
@@ -95,12 +160,42 @@ class Drawing(models.Model):
         null=True,
         editable=False,
     )
+    truncated = models.BooleanField(
+        _("Partially imported"),
+        default=False,
+        editable=False,
+    )
+    truncation_reason = models.CharField(
+        _("Reason of partial import"),
+        null=True,
+        max_length=200,
+        editable=False,
+    )
+    import_signature = models.CharField(
+        _("Import signature"),
+        null=True,
+        max_length=64,
+        editable=False,
+        db_index=True,
+    )
+    map_version = models.PositiveIntegerField(
+        _("Map data version"),
+        default=0,
+        editable=False,
+    )
+    modified = models.DateTimeField(
+        _("Last modified"),
+        auto_now=True,
+    )
+
+    objects = DrawingQuerySet.as_manager()
 
     __original_dxf = None
     __original_geom = None
     __original_designx = None
     __original_designy = None
     __original_rotation = None
+    __original_max_sagitta = None
     name_blacklist = ["*Model_Space", "DynamicInputDot"]
     entity_types = [
         "POINT",
@@ -118,6 +213,11 @@ class Drawing(models.Model):
     class Meta:
         verbose_name = _("Drawing")
         verbose_name_plural = _("Drawings")
+        indexes = [
+            # keyset pagination of list views
+            models.Index(fields=["private", "id"], name="drawing_private_id_idx"),
+            models.Index(fields=["user", "id"], name="drawing_user_id_idx"),
+        ]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -126,6 +226,7 @@ class Drawing(models.Model):
         self.__original_designx = self.designx
         self.__original_designy = self.designy
         self.__original_rotation = self.rotation
+        self.__original_max_sagitta = self.max_sagitta
 
     def __str__(self):
         return self.title
@@ -156,89 +257,328 @@ class Drawing(models.Model):
     def get_thumbnail_path(self):
         if not self.fb_image:
             return
+        wait_image_versions(self.fb_image)
         path = self.fb_image.version_generate("popup").path
         return settings.MEDIA_URL + path
 
     def save(self, *args, **kwargs):
-        # save and eventually upload image file
-        super(Drawing, self).save(*args, **kwargs)
+        # eventually upload image file
         if self.image:
+            if not self.image._committed:
+                self.image.save(self.image.name, self.image.file, save=False)
             # image is saved on the front end, passed to fb_image and deleted
             self.fb_image = FileObject(str(self.image))
             self.image = None
-            super(Drawing, self).save(*args, **kwargs)
-            check_wide_image(self.fb_image)
+            # versions are generated once drawing is committed
+            fb_image = self.fb_image
+            transaction.on_commit(lambda: schedule_image_versions(fb_image))
+        # identical files are stored once
+        if self.dxf and not self.dxf._committed:
+            self.store_dxf()
+        super(Drawing, self).save(*args, **kwargs)
         # check if we have coordinate system
         if not self.epsg:
-            # search for geodata in DXF
-            doc = ezdxf.readfile(Path(settings.MEDIA_ROOT).joinpath(str(self.dxf)))
-            msp = doc.modelspace()
-            geodata = msp.get_geodata()
-            if geodata:
-                # check if valid XML and axis order
-                try:
-                    self.epsg, axis = geodata.get_crs()
-                    if not axis:
-                        return
-                except InvalidGeoDataException:
-                    return
-                utm2world = Transformer.from_crs(self.epsg, 4326, always_xy=True)
-                world_point = utm2world.transform(
-                    geodata.dxf.reference_point[0], geodata.dxf.reference_point[1]
-                )
-                self.geom = {"type": "Point", "coordinates": world_point}
-                self.designx = geodata.dxf.design_point[0]
-                self.designy = geodata.dxf.design_point[1]
-                self.rotation = degrees(
-                    atan2(
-                        geodata.dxf.north_direction[0], geodata.dxf.north_direction[1]
-                    )
-                )
-                super(Drawing, self).save(*args, **kwargs)
-            else:
-                # can't find geodata in DXF, need manual insertion
-                # check if user has inserted origin on map
-                if self.geom:
-                    # following conditional for test to work
-                    if isinstance(self.geom, str):
-                        self.geom = json.loads(self.geom)
-                    # let's try to find proper UTM
-                    utm_crs_list = query_utm_crs_info(
-                        datum_name="WGS 84",
-                        area_of_interest=AreaOfInterest(
-                            west_lon_degree=self.geom["coordinates"][0],
-                            south_lat_degree=self.geom["coordinates"][1],
-                            east_lon_degree=self.geom["coordinates"][0],
-                            north_lat_degree=self.geom["coordinates"][1],
-                        ),
-                    )
-                    self.epsg = utm_crs_list[0].code
-                    super(Drawing, self).save(*args, **kwargs)
+            # search for geodata in DXF, without loading the whole file
+            geodata = read_geodata(Path(settings.MEDIA_ROOT).joinpath(str(self.dxf)))
+            if not self.georeference(geodata):
+                return
+            super(Drawing, self).save(*args, **kwargs)
         # without geom we can't extract DXF
         if self.geom:
-            if (
+            source_changed = (
                 self.__original_dxf != self.dxf
-                or self.__original_geom != self.geom
+                or self.__original_max_sagitta != self.max_sagitta
+            )
+            georeference_changed = (
+                self.__original_geom != self.geom
                 or self.__original_designx != self.designx
                 or self.__original_designy != self.designy
                 or self.__original_rotation != self.rotation
+            )
+            if (
+                georeference_changed
+                and not source_changed
+                and self.__original_geom
+                and self.related_layers.exists()
+                # entities were placed by GEODATA of the file, not by the
+                # georeference fields: they can't be moved back reliably
+                and read_geodata(Path(settings.MEDIA_ROOT).joinpath(str(self.dxf)))
+                is None
             ):
+                # same entities, just move stored geometries
+                previous = Drawing(
+                    geom=self.__original_geom,
+                    designx=self.__original_designx,
+                    designy=self.__original_designy,
+                    rotation=self.__original_rotation,
+                    epsg=self.epsg,
+                )
+                with stage("georeference"):
+                    self.transform_layers(previous)
+                if not self.needs_refresh:
+                    self.set_needs_refresh(True)
+            elif source_changed or georeference_changed:
                 self.related_layers.all().delete()
-                self.extract_dxf()
+                with stage("extract"):
+                    source = self.get_import_source()
+                    if source:
+                        self.clone_layers(source)
+                    else:
+                        self.extract_dxf()
                 # flag drawing as refreshable
                 if not self.needs_refresh:
-                    self.needs_refresh = True
-                    super(Drawing, self).save()
+                    self.set_needs_refresh(True)
+
+    def store_dxf(self):
+        """
+        Stores DXF file under its content hash, if same content is already
+        stored the file is reused
+        """
+        # compressed uploads are stored decompressed
+        self.dxf = unpack_dxf(self.dxf)
+        sha = hashlib.sha256()
+        for chunk in self.dxf.chunks():
+            sha.update(chunk)
+        self.dxf_hash = sha.hexdigest()
+        name = self.dxf.field.generate_filename(self, self.dxf_hash + ".dxf")
+        if self.dxf.storage.exists(name):
+            self.dxf.name = name
+            self.dxf._committed = True
+        else:
+            self.dxf.save(self.dxf_hash + ".dxf", self.dxf.file, save=False)
+
+    def get_import_signature(self):
+        """
+        Hash of DXF content and of everything extraction depends on, drawings
+        with the same signature have the same extracted layers
+        """
+        if not self.dxf_hash:
+            return None
+        geom = self.geom
+        if isinstance(geom, str):
+            geom = json.loads(geom)
+        data = [
+            self.dxf_hash,
+            geom,
+            self.designx,
+            self.designy,
+            self.rotation,
+            self.epsg,
+            self.private,
+            self.get_max_sagitta(),
+            ezdxf.__version__,
+        ]
+        data += [getattr(settings, name, None) for name in EXTRACTION_SETTINGS]
+        return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+    def get_import_source(self):
+        """Returns a drawing with same import signature and unedited layers"""
+        signature = self.get_import_signature()
+        if not signature:
+            return None
+        return (
+            Drawing.objects.filter(import_signature=signature, truncated=False)
+            .exclude(id=self.id)
+            .first()
+        )
 
-    def get_geo_proxy(self, entity, matrix, transformer):
-        geo_proxy = geo.proxy(entity)
-        if geo_proxy.geotype == "Polygon":
-            if not shape(geo_proxy).is_valid:
+    def clone_layers(self, source):
+        """Copies layers, blocks, entities and insertions extracted from source"""
+        stats = ExtractionStats()
+        stats.start()
+        with stats.timer("clone"):
+            layers = list(source.related_layers.all())
+            entities = list(Entity.objects.filter(layer__drawing_id=source.id))
+            insertions = list(Insertion.objects.filter(block__drawing_id=source.id))
+            names = {}
+            for layer in layers:
+                names[layer.id] = layer.name
+                layer.id = None
+                layer.drawing_id = self.id
+            Layer.objects.bulk_create(layers, batch_size=500)
+            # not every backend returns ids of bulk inserts
+            ids = dict(
+                Layer.objects.filter(drawing_id=self.id).values_list("name", "id")
+            )
+            for entity in entities:
+                entity.id = None
+                entity.layer_id = ids[names[entity.layer_id]]
+            Entity.objects.bulk_create(entities, batch_size=500)
+            for insertion in insertions:
+                insertion.id = None
+                insertion.block_id = ids[names[insertion.block_id]]
+                insertion.layer_id = ids[names[insertion.layer_id]]
+            Insertion.objects.bulk_create(insertions, batch_size=500)
+        stats.stop()
+        self.import_signature = source.import_signature
+        self.truncated = False
+        self.truncation_reason = None
+        # bulk inserts skip signals, cached map payloads must be invalidated
+        Drawing.objects.filter(id=self.id).touch(
+            import_signature=self.import_signature,
+            truncated=False,
+            truncation_reason=None,
+        )
+        schedule_payload_files([self.id])
+        previous = source.import_stats.first()
+        if previous:
+            stats.entities.update(previous.entities)
+            stats.vertices.update(previous.vertices)
+            stats.file_size = previous.file_size
+        ImportStats.from_extraction(self, stats).save()
+
+    def set_needs_refresh(self, needs_refresh):
+        """
+        Writes just the flag, saving the drawing would fire signals (author
+        summary, map version) for something that doesn't change the map
+        """
+        self.needs_refresh = needs_refresh
+        Drawing.objects.filter(id=self.id).update(needs_refresh=needs_refresh)
+
+    def georeference(self, geodata):
+        """
+        Sets CRS, location, design point and rotation from DXF geodata (None
+        if missing), or finds UTM CRS for location inserted by user. Returns
+        False if drawing can't be georeferenced. Doesn't touch the database.
+        """
+        if not geodata:
+            # can't find geodata in DXF, need manual insertion
+            # check if user has inserted origin on map
+            if not self.geom:
                 return False
-        geo_proxy.wcs_to_crs(matrix)
-        geo_proxy.apply(lambda v: Vec3(transformer.transform(v.x, v.y)))
+            # following conditional for test to work
+            if isinstance(self.geom, str):
+                self.geom = json.loads(self.geom)
+            # let's try to find proper UTM
+            utm_crs_list = query_utm_crs_info(
+                datum_name="WGS 84",
+                area_of_interest=AreaOfInterest(
+                    west_lon_degree=self.geom["coordinates"][0],
+                    south_lat_degree=self.geom["coordinates"][1],
+                    east_lon_degree=self.geom["coordinates"][0],
+                    north_lat_degree=self.geom["coordinates"][1],
+                ),
+            )
+            self.epsg = utm_crs_list[0].code
+            return True
+        # check if valid XML and axis order
+        try:
+            epsg, axis = geodata.get_crs()
+        except InvalidGeoDataException:
+            return False
+        if not axis:
+            return False
+        self.epsg = epsg
+        utm2world = Transformer.from_crs(self.epsg, 4326, always_xy=True)
+        world_point = utm2world.transform(
+            geodata.dxf.reference_point[0], geodata.dxf.reference_point[1]
+        )
+        self.geom = {"type": "Point", "coordinates": world_point}
+        self.designx = geodata.dxf.design_point[0]
+        self.designy = geodata.dxf.design_point[1]
+        self.rotation = degrees(
+            atan2(geodata.dxf.north_direction[0], geodata.dxf.north_direction[1])
+        )
+        return True
+
+    def get_geo_proxy(self, entity, matrix, transformer, stats=None):
+        if stats is None:
+            stats = ExtractionStats()
+        sagitta = self.get_max_sagitta()
+        stats.check_budgets(entity, sagitta)
+        with stats.timer("proxy"):
+            geo_proxy = geo.proxy(entity, distance=sagitta)
+        with stats.timer("reprojection"):
+            geo_proxy.wcs_to_crs(matrix)
+            geo_proxy.apply(lambda v: Vec3(transformer.transform(v.x, v.y)))
+        # decimals of exported coordinates, ezdxf defaults to 6
+        precision = get_coordinate_precision()
+        geo_proxy.places = 15 if precision is None else precision
+        stats.count(entity.dxftype(), geo_proxy.__geo_interface__)
         return geo_proxy
 
+    def get_max_sagitta(self):
+        """Maximum distance between curves and their flattened segments"""
+        # values saved before validation or set in settings, tinier ones
+        # explode vertex counts
+        if self.max_sagitta:
+            return max(self.max_sagitta, 0.001)
+        try:
+            return max(settings.DJEOCAD_MAX_SAGITTA, 0.001)
+        except AttributeError:
+            return 0.1
+
+    def validate_geometries(self, geometries, stats=None, handles=None):
+        """
+        Checks validity of all polygons in geometries with a single shapely
+        call, invalid ones are dropped or repaired according to
+        DJEOCAD_INVALID_POLYGONS ("drop" or "repair"). If DXF handles of
+        geometries are given, returns them too, filtered the same way.
+        """
+        if stats is None:
+            stats = ExtractionStats()
+        try:
+            policy = settings.DJEOCAD_INVALID_POLYGONS
+        except AttributeError:
+            policy = "drop"
+        if handles is None:
+            return self._validate_geometries(geometries, stats, policy)[0]
+        validated, indexes = self._validate_geometries(geometries, stats, policy)
+        return validated, [handles[i] for i in indexes]
+
+    def _validate_geometries(self, geometries, stats, policy):
+        """Returns validated geometries and index of their source geometry"""
+        candidates = [i for i, g in enumerate(geometries) if g["type"] == "Polygon"]
+        if not candidates:
+            return geometries, list(range(len(geometries)))
+        with stats.timer("validation"):
+            # rings with less than 4 positions can't even be built
+            degenerate = {
+                i
+                for i in candidates
+                if any(len(ring) < 4 for ring in geometries[i]["coordinates"])
+            }
+            candidates = [i for i in candidates if i not in degenerate]
+            rings = [ring for i in candidates for ring in geometries[i]["coordinates"]]
+            invalid = set(degenerate)
+            if rings:
+                coords = np.array(
+                    [position[:2] for ring in rings for position in ring], dtype=float
+                )
+                ring_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+                polygon_offsets = np.cumsum(
+                    [0] + [len(geometries[i]["coordinates"]) for i in candidates]
+                )
+                polygons = shapely.from_ragged_array(
+                    shapely.GeometryType.POLYGON,
+                    coords,
+                    (ring_offsets, polygon_offsets),
+                )
+                valid = shapely.is_valid(polygons)
+                invalid.update(i for i, ok in zip(candidates, valid) if not ok)
+            if not invalid:
+                return geometries, list(range(len(geometries)))
+            repaired = {}
+            if policy == "repair":
+                for i in invalid - degenerate:
+                    fixed = shapely.make_valid(shape(geometries[i]))
+                    # keep the collection flat
+                    parts = [fixed]
+                    if fixed.geom_type == "GeometryCollection":
+                        parts = shapely.get_parts(fixed)
+                    repaired[i] = [mapping(part) for part in parts if not part.is_empty]
+        stats.dropped_polygons += len(invalid) - len(repaired)
+        validated = []
+        indexes = []
+        for i, geometry in enumerate(geometries):
+            if i in repaired:
+                validated += repaired[i]
+                indexes += [i] * len(repaired[i])
+            elif i not in invalid:
+                validated.append(geometry)
+                indexes.append(i)
+        return validated, indexes
+
     def get_epsg_xml(self):
         xml = """<?xml version="1.0"
 encoding="UTF-16" standalone="no" ?>
@@ -282,7 +622,86 @@ encoding="UTF-16" standalone="no" ?>
         geodata.dxf.north_direction = (sin(rot), cos(rot))
         return geodata
 
+    def get_crs_matrix(self):
+        """Transformation matrix from WCS to CRS of (fake) geodata"""
+        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+        geodata = self.fake_geodata(GeoData.new(), utm_wcs, rot)
+        m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
+        return m
+
+    def transform_layers(self, previous):
+        """
+        Moves stored layers and insertions from georeference of previous
+        (an unsaved drawing with old location, design point and rotation)
+        to current one, without reading the DXF: positions go back to WCS
+        and forth to the new CRS in a single vectorized transformation, so
+        edits of layers and insertions are kept.
+        """
+        for drawing in (self, previous):
+            if isinstance(drawing.geom, str):
+                drawing.geom = json.loads(drawing.geom)
+        # WCS to previous CRS inverted, then WCS to current CRS
+        m = previous.get_crs_matrix()
+        m.inverse()
+        m = m @ self.get_crs_matrix()
+        rows = list(m.rows())
+        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+        precision = get_coordinate_precision()
+
+        def move(xs, ys):
+            xs, ys = world2utm.transform(xs, ys)
+            xs, ys = (
+                xs * rows[0][0] + ys * rows[1][0] + rows[3][0],
+                xs * rows[0][1] + ys * rows[1][1] + rows[3][1],
+            )
+            xs, ys = utm2world.transform(xs, ys)
+            if precision is not None:
+                xs, ys = np.round(xs, precision), np.round(ys, precision)
+            return xs, ys
+
+        entities = list(Entity.objects.filter(layer__drawing_id=self.id))
+        insertions = list(Insertion.objects.filter(block__drawing_id=self.id))
+        geometries = transform_geometries(
+            [entity.geom for entity in entities]
+            + [insertion.geom for insertion in insertions]
+            + [insertion.point for insertion in insertions],
+            move,
+        )
+        for entity, geom in zip(entities, geometries):
+            entity.set_geometry(geom)
+        count = len(entities)
+        for i, insertion in enumerate(insertions):
+            insertion.geom = geometries[count + i]
+            insertion.point = geometries[count + len(insertions) + i]
+        Entity.objects.bulk_update(
+            entities, ["geom", "minx", "miny", "maxx", "maxy"], batch_size=500
+        )
+        Insertion.objects.bulk_update(insertions, ["geom", "point"], batch_size=500)
+        # moved layers don't match a fresh extraction byte for byte
+        self.import_signature = None
+        Drawing.objects.filter(id=self.id).touch(import_signature=None)
+        schedule_payload_files([self.id])
+
     def extract_dxf(self):
+        stats = ExtractionStats()
+        stats.start()
+        # get DXF
+        path = Path(settings.MEDIA_ROOT).joinpath(str(self.dxf))
+        stats.file_size = path.stat().st_size
+        with stats.timer("read"):
+            doc = read_document(path)
+        data = self.parse_dxf(doc, stats)
+        stats.stop()
+        Drawing.persist_extracted([(self, data)])
+
+    def parse_dxf(self, doc, stats=None):
+        """
+        Transforms entities of DXF document into geographic geometries
+        without touching the database, so it can run in worker processes.
+        Returns layers, blocks, insertions and import stats as plain data.
+        """
+        if stats is None:
+            stats = ExtractionStats()
         # limit the number of entities for non private drawings
         try:
             max_ent = settings.DJEOCAD_MAX_ENTITIES
@@ -291,18 +710,16 @@ encoding="UTF-16" standalone="no" ?>
         # following conditional for test to work
         if isinstance(self.geom, str):
             self.geom = json.loads(self.geom)
-        # prepare transformers
-        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
-        # get DXF
-        doc = ezdxf.readfile(Path(settings.MEDIA_ROOT).joinpath(str(self.dxf)))
-        msp = doc.modelspace()
-        geodata = msp.get_geodata()
-        if not geodata:
-            # faking geodata
-            geodata = msp.new_geodata()
-            geodata = self.fake_geodata(geodata, utm_wcs, rot)
-        # get transform matrix from true or fake geodata
-        m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
+        with stats.timer("setup"):
+            # prepare transformers
+            world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+            msp = doc.modelspace()
+            geodata = msp.get_geodata()
+            if not geodata:
+                # faking geodata, out of the document (it may be cached)
+                geodata = self.fake_geodata(GeoData.new(), utm_wcs, rot)
+            # get transform matrix from true or fake geodata
+            m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
         # prepare layer table
         layer_table = {}
         for layer in doc.layers:
@@ -314,91 +731,199 @@ encoding="UTF-16" standalone="no" ?>
                 "color": color,
                 "linetype": layer.dxf.linetype,
                 "geometries": [],
+                "handles": [],
             }
-        for e_type in self.entity_types:
-            i = 0
-            # extract entities
-            for e in msp.query(e_type):
-                i += 1
-                if not self.private and i >= max_ent:
-                    break
-                geo_proxy = self.get_geo_proxy(e, m, utm2world)
-                if geo_proxy:
-                    layer_table[e.dxf.layer]["geometries"].append(
-                        geo_proxy.__geo_interface__
-                    )
-        # create Layers
-        for name, layer in layer_table.items():
-            if name == "0" or not layer["geometries"] == []:
-                Layer.objects.create(
-                    drawing_id=self.id,
-                    name=name,
-                    color_field=layer["color"],
-                    geom={
-                        "geometries": layer["geometries"],
-                        "type": "GeometryCollection",
-                    },
-                )
-        # handle blocks
-        for block in doc.blocks:
-            if block.name in self.name_blacklist:
-                continue
-            geometries = []
+        layers = None
+        blocks = {}
+        insertions = []
+        # on exceeded budget keep what has been extracted so far
+        try:
             for e_type in self.entity_types:
                 i = 0
                 # extract entities
-                for e in block.query(e_type):
+                for e in msp.query(e_type):
                     i += 1
                     if not self.private and i >= max_ent:
                         break
-                    geo_proxy = self.get_geo_proxy(e, m, utm2world)
+                    geo_proxy = self.get_geo_proxy(e, m, utm2world, stats)
                     if geo_proxy:
-                        geometries.append(geo_proxy.__geo_interface__)
-            # create block as Layer
-            if not geometries == []:
-                Layer.objects.create(
-                    drawing_id=self.id,
-                    name=block.name,
-                    geom={
+                        layer_table[e.dxf.layer]["geometries"].append(
+                            geo_proxy.__geo_interface__
+                        )
+                        layer_table[e.dxf.layer]["handles"].append(e.dxf.handle)
+            for layer in layer_table.values():
+                layer["geometries"], layer["handles"] = self.validate_geometries(
+                    layer["geometries"], stats, layer["handles"]
+                )
+            # keep layer 0 and layers with entities
+            layers = {
+                name: layer
+                for name, layer in layer_table.items()
+                if name == "0" or not layer["geometries"] == []
+            }
+            # handle blocks
+            for block in doc.blocks:
+                if block.name in self.name_blacklist:
+                    continue
+                geometries = []
+                handles = []
+                for e_type in self.entity_types:
+                    i = 0
+                    # extract entities
+                    for e in block.query(e_type):
+                        i += 1
+                        if not self.private and i >= max_ent:
+                            break
+                        geo_proxy = self.get_geo_proxy(e, m, utm2world, stats)
+                        if geo_proxy:
+                            geometries.append(geo_proxy.__geo_interface__)
+                            handles.append(e.dxf.handle)
+                geometries, handles = self.validate_geometries(
+                    geometries, stats, handles
+                )
+                # block names share namespace with layer names
+                if not geometries == [] and block.name not in layers:
+                    blocks[block.name] = {
+                        "geometries": geometries,
+                        "handles": handles,
+                    }
+            # extract insertions
+            for ins in msp.query("INSERT"):
+                if ins.dxf.name in self.name_blacklist:
+                    continue
+                if ins.dxf.layer not in layers or ins.dxf.name not in blocks:
+                    continue
+                # virtual point, document is left untouched
+                point = PointEntity.new(dxfattribs={"location": ins.dxf.insert})
+                geo_proxy = self.get_geo_proxy(point, m, utm2world, stats)
+                if geo_proxy:
+                    insertion_point = geo_proxy.__geo_interface__
+                geometries = []
+                # 'generator' object has no attribute 'query'
+                with stats.timer("explode"):
+                    virtual_entities = list(ins.virtual_entities())
+                for e in virtual_entities:
+                    if e.dxftype() in self.entity_types:
+                        # extract entity
+                        geo_proxy = self.get_geo_proxy(e, m, utm2world, stats)
+                        if geo_proxy:
+                            geometries.append(geo_proxy.__geo_interface__)
+                geometries = self.validate_geometries(geometries, stats)
+                insertions.append(
+                    {
+                        "block": ins.dxf.name,
+                        "layer": ins.dxf.layer,
+                        "point": insertion_point,
+                        "rotation": ins.dxf.rotation,
+                        "x_scale": ins.dxf.xscale,
+                        "y_scale": ins.dxf.yscale,
                         "geometries": geometries,
-                        "type": "GeometryCollection",
-                    },
-                    is_block=True,
+                    }
                 )
-        # extract insertions
-        for ins in msp.query("INSERT"):
-            if ins.dxf.name in self.name_blacklist:
-                continue
-            try:
-                layer = Layer.objects.get(drawing_id=self.id, name=ins.dxf.layer)
-                block = Layer.objects.get(drawing_id=self.id, name=ins.dxf.name)
-            except Layer.DoesNotExist:
-                continue
-            point = msp.add_point(ins.dxf.insert)
-            geo_proxy = self.get_geo_proxy(point, m, utm2world)
-            if geo_proxy:
-                insertion_point = geo_proxy.__geo_interface__
-            geometries = []
-            # 'generator' object has no attribute 'query'
-            for e in ins.virtual_entities():
-                if e.dxftype() in self.entity_types:
-                    # extract entity
-                    geo_proxy = self.get_geo_proxy(e, m, utm2world)
-                    if geo_proxy:
-                        geometries.append(geo_proxy.__geo_interface__)
-            # create Insertion
-            Insertion.objects.create(
-                block=block,
-                layer=layer,
-                point=insertion_point,
-                rotation=ins.dxf.rotation,
-                x_scale=ins.dxf.xscale,
-                y_scale=ins.dxf.yscale,
-                geom={
-                    "geometries": geometries,
-                    "type": "GeometryCollection",
-                },
-            )
+        except ImportBudgetExceeded as e:
+            stats.truncated = str(e)
+            if layers is None:
+                for layer in layer_table.values():
+                    (
+                        layer["geometries"],
+                        layer["handles"],
+                    ) = self.validate_geometries(
+                        layer["geometries"], stats, layer["handles"]
+                    )
+                layers = {
+                    name: layer
+                    for name, layer in layer_table.items()
+                    if name == "0" or not layer["geometries"] == []
+                }
+        return {
+            "layers": layers,
+            "blocks": blocks,
+            "insertions": insertions,
+            "stats": stats,
+            "signature": self.get_import_signature(),
+        }
+
+    @classmethod
+    def persist_extracted(cls, extracted):
+        """
+        Stores data returned by parse_dxf, a list of (drawing, data) tuples,
+        with one bulk insert per model, then marks drawings as changed and
+        records import stats.
+        """
+        start = perf_counter()
+        layers = []
+        for drawing, data in extracted:
+            for name, layer in data["layers"].items():
+                layers.append(
+                    Layer(
+                        drawing_id=drawing.id,
+                        name=name,
+                        color_field=layer["color"],
+                    )
+                )
+            # create blocks as Layers
+            for name in data["blocks"]:
+                layers.append(Layer(drawing_id=drawing.id, name=name, is_block=True))
+        Layer.objects.bulk_create(layers, batch_size=500)
+        drawing_ids = [drawing.id for drawing, data in extracted]
+        layer_ids = {
+            (drawing_id, name): id
+            for drawing_id, name, id in Layer.objects.filter(
+                drawing_id__in=drawing_ids
+            ).values_list("drawing_id", "name", "id")
+        }
+        entities = []
+        for drawing, data in extracted:
+            for name, layer in list(data["layers"].items()) + list(
+                data["blocks"].items()
+            ):
+                layer_id = layer_ids[(drawing.id, name)]
+                entities += [
+                    Entity.from_geometry(layer_id, geometry, handle)
+                    for geometry, handle in zip(layer["geometries"], layer["handles"])
+                ]
+        Entity.objects.bulk_create(entities, batch_size=500)
+        insertions = []
+        for drawing, data in extracted:
+            for ins in data["insertions"]:
+                insertions.append(
+                    Insertion(
+                        block_id=layer_ids[(drawing.id, ins["block"])],
+                        layer_id=layer_ids[(drawing.id, ins["layer"])],
+                        point=ins["point"],
+                        rotation=ins["rotation"],
+                        x_scale=ins["x_scale"],
+                        y_scale=ins["y_scale"],
+                        geom={
+                            "geometries": ins["geometries"],
+                            "type": "GeometryCollection",
+                        },
+                    )
+                )
+        Insertion.objects.bulk_create(insertions, batch_size=500)
+        # flag drawings cut short by import budgets
+        for drawing, data in extracted:
+            stats = data.get("stats")
+            drawing.truncation_reason = stats.truncated if stats else None
+            drawing.truncated = bool(drawing.truncation_reason)
+            # extracted layers may be cloned by identical imports
+            drawing.import_signature = data.get("signature")
+        cls.objects.bulk_update(
+            [drawing for drawing, data in extracted],
+            ["truncated", "truncation_reason", "import_signature"],
+        )
+        # bulk inserts skip signals, cached map payloads must be invalidated
+        cls.objects.filter(id__in=drawing_ids).touch()
+        schedule_payload_files(drawing_ids)
+        # time of bulk inserts is shared by drawings
+        persist = (perf_counter() - start) / len(extracted)
+        ImportStats.objects.bulk_create(
+            [
+                ImportStats.from_extraction(drawing, data["stats"], persist)
+                for drawing, data in extracted
+                if data.get("stats")
+            ]
+        )
 
     def get_file_to_download(self):
         # prepare transformers
@@ -411,8 +936,10 @@ encoding="UTF-16" standalone="no" ?>
         geodata = self.fake_geodata(geodata, utm_wcs, rot)
         # get transform matrix from fake geodata
         m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
+        # layers and blocks with their entities, in two queries
+        all_layers = list(self.related_layers.prefetch_related("related_entities"))
         # create layers and add entities
-        drw_layers = self.related_layers.filter(is_block=False)
+        drw_layers = [layer for layer in all_layers if not layer.is_block]
         for drw_layer in drw_layers:
             if drw_layer.name != "0":
                 doc_layer = doc.layers.add(drw_layer.name)
@@ -430,7 +957,7 @@ encoding="UTF-16" standalone="no" ?>
                 ):
                     msp.add_entity(entity)
         # create blocks and add entities
-        drw_blocks = self.related_layers.filter(is_block=True)
+        drw_blocks = [layer for layer in all_layers if layer.is_block]
         for drw_block in drw_blocks:
             block = doc.blocks.new(name=drw_block.name)
             geometries = drw_block.geom["geometries"]
@@ -441,28 +968,41 @@ encoding="UTF-16" standalone="no" ?>
                 for entity in geo_proxy.to_dxf_entities(dxfattribs={"layer": "0"}):
                     block.add_entity(entity)
         # add insertions
-        for drw_layer in drw_layers:
-            for insert in drw_layer.insertions.all():
-                geo_proxy = geo.GeoProxy.parse(insert.point)
-                geo_proxy.apply(lambda v: Vec3(world2utm.transform(v.x, v.y)))
-                geo_proxy.crs_to_wcs(m)
-                for entity in geo_proxy.to_dxf_entities():
-                    point = entity.dxf.location
-                msp.add_blockref(
-                    insert.block.name,
-                    point,
-                    dxfattribs={
-                        "xscale": insert.x_scale,
-                        "yscale": insert.y_scale,
-                        "rotation": insert.rotation,
-                        "layer": insert.layer.name,
-                    },
-                )
-        # replace stored DXF
-        doc.saveas(filename=self.dxf.path, encoding="utf-8", fmt="asc")
-        # flag drawing as refreshed and save it
+        insertions = Insertion.objects.filter(layer__in=drw_layers).select_related(
+            "layer", "block"
+        )
+        for insert in insertions:
+            geo_proxy = geo.GeoProxy.parse(insert.point)
+            geo_proxy.apply(lambda v: Vec3(world2utm.transform(v.x, v.y)))
+            geo_proxy.crs_to_wcs(m)
+            for entity in geo_proxy.to_dxf_entities():
+                point = entity.dxf.location
+            msp.add_blockref(
+                insert.block.name,
+                point,
+                dxfattribs={
+                    "xscale": insert.x_scale,
+                    "yscale": insert.y_scale,
+                    "rotation": insert.rotation,
+                    "layer": insert.layer.name,
+                },
+            )
+        # stored DXF may be shared by other drawings, store a new one
+        old_name = self.dxf.name
+        stream = StringIO()
+        doc.write(stream, fmt="asc")
+        self.dxf = ContentFile(stream.getvalue().encode("utf-8"), name="download.dxf")
+        self.store_dxf()
+        # flag drawing as refreshed, saving would extract the new file
         self.needs_refresh = False
-        super(Drawing, self).save()
+        Drawing.objects.filter(id=self.id).update(
+            dxf=self.dxf.name, dxf_hash=self.dxf_hash, needs_refresh=False
+        )
+        # previous file is removed if no longer referenced, once committed:
+        # uploads reusing it in the meantime are committed by then
+        if old_name and old_name != self.dxf.name:
+            storage = self.dxf.storage
+            transaction.on_commit(lambda: delete_unreferenced_dxf(storage, old_name))
 
 
 class Layer(models.Model):
@@ -482,7 +1022,6 @@ class Layer(models.Model):
         _("Continuous linetype"),
         default=True,
     )
-    geom = GeometryCollectionField(_("Entities"))
     is_block = models.BooleanField(
         _("Block definition"),
         default=False,
@@ -492,7 +1031,8 @@ class Layer(models.Model):
     __original_name = None
     __original_color_field = None
     __original_linetype = None
-    __original_geom = None
+    # geometries set on layer, stored as entities on save
+    _geometries = None
 
     class Meta:
         verbose_name = _("Layer")
@@ -513,13 +1053,32 @@ class Layer(models.Model):
         self.__original_name = self.__dict__.get("name")
         self.__original_color_field = self.__dict__.get("color_field")
         self.__original_linetype = self.__dict__.get("linetype")
-        self.__original_geom = self.__dict__.get("geom")
 
     def __str__(self):
         if self.is_block:
             return "block-" + self.name + "-" + str(self.id)
         return self.name + "-" + str(self.id)
 
+    @property
+    def geom(self):
+        """
+        Entities of layer as GeoJSON geometry collection, assembled on
+        demand: prefetch related_entities when serializing many layers
+        """
+        if self._geometries is not None:
+            geometries = self._geometries
+        elif self.pk:
+            geometries = [entity.geom for entity in self.related_entities.all()]
+        else:
+            geometries = []
+        return {"geometries": geometries, "type": "GeometryCollection"}
+
+    @geom.setter
+    def geom(self, value):
+        if isinstance(value, str):
+            value = json.loads(value)
+        self._geometries = list(value["geometries"]) if value else []
+
     def transform_to_block(self):
         # layer "0" can't be transformed in block
         if self.name == "0":
@@ -543,8 +1102,7 @@ class Layer(models.Model):
         super(Layer, self).save()
         # flag drawing as refreshable
         if not self.drawing.needs_refresh:
-            self.drawing.needs_refresh = True
-            super(Drawing, self.drawing).save()
+            self.drawing.set_needs_refresh(True)
 
     @property
     def popupContent(self):
@@ -575,71 +1133,203 @@ class Layer(models.Model):
         except IntegrityError:
             self.name = self.__original_name
             super(Layer, self).save(*args, **kwargs)
+        # edited geometries are stored entity by entity
+        if self._geometries is not None:
+            geometries = self._geometries
+            self._geometries = None
+            if self.save_entities(geometries):
+                # drawing is touched once, below
+                self.update_from_entities(touch=False)
         # flag drawing as refreshable if something changed
         if (
             self.__original_name != self.name
             or self.__original_color_field != self.color_field
             or self.__original_linetype != self.linetype
-            or self.__original_geom != self.geom
         ):
             if not self.drawing.needs_refresh:
-                self.drawing.needs_refresh = True
-                super(Drawing, self.drawing).save()
-        # if block geom changed, need to update instance geom
-        if self.is_block and self.__original_geom != self.geom:
-            # we will use a fake DXF to help us
-            # prepare transformers
-            world2utm, utm2world, utm_wcs, rot = self.drawing.prepare_transformers()
-            # start fake DXF
-            doc = ezdxf.new()
-            msp = doc.modelspace()
-            # we fake geodata
-            geodata = msp.new_geodata()
-            geodata = self.drawing.fake_geodata(geodata, utm_wcs, rot)
-            # get transform matrix from fake geodata
-            m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
-            # add block to fake DXF
-            block = doc.blocks.new(name=self.name)
-            geometries = self.geom["geometries"]
-            for geom in geometries:
-                geo_proxy = geo.GeoProxy.parse(geom)
-                geo_proxy.apply(lambda v: Vec3(world2utm.transform(v.x, v.y)))
-                geo_proxy.crs_to_wcs(m)
-                for entity in geo_proxy.to_dxf_entities(dxfattribs={"layer": "0"}):
-                    block.add_entity(entity)
-            # handle instances
-            for insert in self.instances.all():
-                # add instance in fake DXF
-                geo_proxy = geo.GeoProxy.parse(insert.point)
-                geo_proxy.apply(lambda v: Vec3(world2utm.transform(v.x, v.y)))
-                geo_proxy.crs_to_wcs(m)
-                for entity in geo_proxy.to_dxf_entities():
-                    point = entity.dxf.location
-                instance = msp.add_blockref(
-                    insert.block.name,
-                    point,
-                    dxfattribs={
-                        "xscale": insert.x_scale,
-                        "yscale": insert.y_scale,
-                        "rotation": insert.rotation,
-                        "layer": insert.layer.name,
-                    },
-                )
-                # use fake instance to generate new geometries
-                geometries = []
-                # 'generator' object has no attribute 'query'
-                for e in instance.virtual_entities():
-                    if e.dxftype() in self.drawing.entity_types:
-                        # extract entity
-                        geo_proxy = self.drawing.get_geo_proxy(e, m, utm2world)
-                        if geo_proxy:
-                            geometries.append(geo_proxy.__geo_interface__)
-                # update Insertion
-                insert.geom = {
-                    "geometries": geometries,
-                    "type": "GeometryCollection",
-                }
-                super(Insertion, insert).save()
+                self.drawing.set_needs_refresh(True)
+        # edited layers can't be cloned by identical imports, touched after
+        # entities are written so payloads of new map version are current
+        Drawing.objects.filter(id=self.drawing_id).touch(import_signature=None)
+        schedule_payload_files([self.drawing_id])
+
+    def save_entities(self, geometries):
+        """
+        Stores GeoJSON geometries as entities of layer: unchanged entities
+        are kept with their DXF handle, the others are deleted or added.
+        Returns True if something changed.
+        """
+        kept = {}
+        for id, geom in self.related_entities.values_list("id", "geom"):
+            kept.setdefault(json.dumps(geom, sort_keys=True), []).append(id)
+        added = []
+        for geometry in geometries:
+            # edited geometries get the same precision as extracted ones
+            geometry = quantize_geometry(geometry)
+            ids = kept.get(json.dumps(geometry, sort_keys=True))
+            if ids:
+                ids.pop()
+            else:
+                added.append(Entity.from_geometry(self.id, geometry))
+        removed = [id for ids in kept.values() for id in ids]
+        if removed:
+            Entity.objects.filter(id__in=removed).delete()
+        Entity.objects.bulk_create(added, batch_size=500)
+        # prefetched entities are stale now
+        getattr(self, "_prefetched_objects_cache", {}).pop("related_entities", None)
+        return bool(removed or added)
+
+    def update_from_entities(self, touch=True):
+        """
+        Marks drawing as changed after entities of layer were written, if
+        layer is a block its instances are updated. Drawing map version is
+        bumped unless touch is False.
+        """
+        if not self.drawing.needs_refresh:
+            self.drawing.set_needs_refresh(True)
+        if touch:
+            # edited layers can't be cloned by identical imports
+            Drawing.objects.filter(id=self.drawing_id).touch(import_signature=None)
+            schedule_payload_files([self.drawing_id])
+        if self.is_block:
+            self.update_instances()
+
+    def update_instances(self):
+        """Updates geometries of block instances with entities of block"""
+        # we will use a fake DXF to help us
+        # prepare transformers
+        world2utm, utm2world, utm_wcs, rot = self.drawing.prepare_transformers()
+        # start fake DXF
+        doc = ezdxf.new()
+        msp = doc.modelspace()
+        # we fake geodata
+        geodata = msp.new_geodata()
+        geodata = self.drawing.fake_geodata(geodata, utm_wcs, rot)
+        # get transform matrix from fake geodata
+        m, epsg = geodata.get_crs_transformation(no_checks=True)  # noqa
+        # add block to fake DXF
+        block = doc.blocks.new(name=self.name)
+        geometries = self.geom["geometries"]
+        for geom in geometries:
+            geo_proxy = geo.GeoProxy.parse(geom)
+            geo_proxy.apply(lambda v: Vec3(world2utm.transform(v.x, v.y)))
+            geo_proxy.crs_to_wcs(m)
+            for entity in geo_proxy.to_dxf_entities(dxfattribs={"layer": "0"}):
+                block.add_entity(entity)
+        # handle instances
+        for insert in self.instances.select_related("layer"):
+            # add instance in fake DXF
+            geo_proxy = geo.GeoProxy.parse(insert.point)
+            geo_proxy.apply(lambda v: Vec3(world2utm.transform(v.x, v.y)))
+            geo_proxy.crs_to_wcs(m)
+            for entity in geo_proxy.to_dxf_entities():
+                point = entity.dxf.location
+            instance = msp.add_blockref(
+                insert.block.name,
+                point,
+                dxfattribs={
+                    "xscale": insert.x_scale,
+                    "yscale": insert.y_scale,
+                    "rotation": insert.rotation,
+                    "layer": insert.layer.name,
+                },
+            )
+            # use fake instance to generate new geometries
+            geometries = []
+            # 'generator' object has no attribute 'query'
+            for e in instance.virtual_entities():
+                if e.dxftype() in self.drawing.entity_types:
+                    # extract entity
+                    geo_proxy = self.drawing.get_geo_proxy(e, m, utm2world)
+                    if geo_proxy:
+                        geometries.append(geo_proxy.__geo_interface__)
+            geometries = self.drawing.validate_geometries(geometries)
+            # update Insertion
+            insert.geom = {
+                "geometries": geometries,
+                "type": "GeometryCollection",
+            }
+            super(Insertion, insert).save()
+
+
+class Entity(models.Model):
+
+    layer = models.ForeignKey(
+        Layer,
+        on_delete=models.CASCADE,
+        related_name="related_entities",
+        verbose_name=_("Layer / block"),
+    )
+    geom = GeometryField(_("Geometry"))
+    geom_type = models.CharField(
+        _("Geometry type"),
+        max_length=20,
+        editable=False,
+    )
+    handle = models.CharField(
+        _("DXF handle"),
+        max_length=16,
+        blank=True,
+        editable=False,
+    )
+    # bounding box of geometry
+    minx = models.FloatField(null=True, editable=False)
+    miny = models.FloatField(null=True, editable=False)
+    maxx = models.FloatField(null=True, editable=False)
+    maxy = models.FloatField(null=True, editable=False)
+
+    __original_geom = None
+
+    class Meta:
+        verbose_name = _("Entity")
+        verbose_name_plural = _("Entities")
+        ordering = ("id",)
+        indexes = [
+            models.Index(fields=["layer", "geom_type"], name="entity_layer_type_idx"),
+            models.Index(fields=["layer", "handle"], name="entity_layer_handle_idx"),
+            models.Index(
+                fields=["minx", "miny", "maxx", "maxy"], name="entity_bbox_idx"
+            ),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_geom = self.__dict__.get("geom")
+
+    def __str__(self):
+        return self.geom_type + "-" + str(self.id)
+
+    @classmethod
+    def from_geometry(cls, layer_id, geometry, handle=""):
+        """Unsaved entity of layer, ready for bulk inserts"""
+        entity = cls(layer_id=layer_id, handle=handle or "")
+        entity.set_geometry(geometry)
+        return entity
+
+    def set_geometry(self, geometry):
+        """Sets geometry with its type and bounding box"""
+        if isinstance(geometry, str):
+            geometry = json.loads(geometry)
+        self.geom = geometry
+        self.geom_type = geometry["type"]
+        bounds = get_geometry_bounds(geometry) or (None, None, None, None)
+        self.minx, self.miny, self.maxx, self.maxy = bounds
+
+    def save(self, *args, **kwargs):
+        changed = self._state.adding or self.__original_geom != self.geom
+        if changed:
+            # edited geometries get the same precision as extracted ones
+            self.set_geometry(quantize_geometry(self.geom))
+        super(Entity, self).save(*args, **kwargs)
+        self.__original_geom = self.geom
+        if changed:
+            self.layer.update_from_entities()
+
+    def delete(self, *args, **kwargs):
+        result = super(Entity, self).delete(*args, **kwargs)
+        # not a post_delete receiver, so deleting layers is a fast delete
+        self.layer.update_from_entities()
+        return result
 
 
 class Insertion(models.Model):
@@ -707,16 +1397,19 @@ class Insertion(models.Model):
         }
 
     def explode_instance(self):
-        self.layer.geom["geometries"] = (
-            self.layer.geom["geometries"] + self.geom["geometries"]
+        # just the entities of instance are written
+        Entity.objects.bulk_create(
+            [
+                Entity.from_geometry(self.layer_id, geometry)
+                for geometry in self.geom["geometries"]
+            ],
+            batch_size=500,
         )
-        super(Layer, self.layer).save()
-        # flag drawing as refreshable
-        if not self.layer.drawing.needs_refresh:
-            self.layer.drawing.needs_refresh = True
-            super(Drawing, self.layer.drawing).save()
+        self.layer.update_from_entities()
 
     def save(self, *args, **kwargs):
+        if self._state.adding or self.__original_point != self.point:
+            self.point = quantize_geometry(self.point)
         # check if insertion has changed
         if (
             self.__original_point != self.point
@@ -770,6 +1463,7 @@ class Insertion(models.Model):
                     geo_proxy = drawing.get_geo_proxy(e, m, utm2world)
                     if geo_proxy:
                         geometries.append(geo_proxy.__geo_interface__)
+            geometries = drawing.validate_geometries(geometries)
             # update Insertion
             self.geom = {
                 "geometries": geometries,
@@ -777,23 +1471,189 @@ class Insertion(models.Model):
             }
             # flag drawing as refreshable
             if not drawing.needs_refresh:
-                drawing.needs_refresh = True
-                super(Drawing, drawing).save()
+                drawing.set_needs_refresh(True)
         super(Insertion, self).save(*args, **kwargs)
 
 
+class ImportStats(models.Model):
+
+    drawing = models.ForeignKey(
+        Drawing,
+        on_delete=models.CASCADE,
+        related_name="import_stats",
+        verbose_name=_("Drawing"),
+    )
+    created = models.DateTimeField(
+        _("Imported"),
+        auto_now_add=True,
+    )
+    duration = models.FloatField(
+        _("Duration (s)"),
+        default=0,
+    )
+    file_size = models.PositiveBigIntegerField(
+        _("File size (bytes)"),
+        null=True,
+    )
+    # seconds by stage: read, setup, proxy, validation, reprojection, explode,
+    # persist and total
+    timings = models.JSONField(
+        _("Stage timings (s)"),
+        default=dict,
+    )
+    entities = models.JSONField(
+        _("Entities by type"),
+        default=dict,
+    )
+    vertices = models.JSONField(
+        _("Vertices by type"),
+        default=dict,
+    )
+    total_entities = models.PositiveIntegerField(
+        _("Entities"),
+        default=0,
+    )
+    total_vertices = models.PositiveIntegerField(
+        _("Vertices"),
+        default=0,
+    )
+    dropped_polygons = models.PositiveIntegerField(
+        _("Dropped invalid polygons"),
+        default=0,
+    )
+    peak_memory = models.PositiveBigIntegerField(
+        _("Peak memory (bytes)"),
+        null=True,
+    )
+
+    class Meta:
+        verbose_name = _("Import stats")
+        verbose_name_plural = _("Import stats")
+        ordering = ("-created",)
+
+    def __str__(self):
+        return "%(drawing)s-%(id)d" % {"drawing": self.drawing_id, "id": self.id}
+
+    @classmethod
+    def from_extraction(cls, drawing, stats, persist=0):
+        timings = dict(stats.timings)
+        timings["persist"] = persist
+        timings["total"] = timings.get("total", 0) + persist
+        return cls(
+            drawing_id=drawing.id,
+            duration=timings["total"],
+            file_size=stats.file_size,
+            timings={name: round(t, 4) for name, t in timings.items()},
+            entities=dict(stats.entities),
+            vertices=dict(stats.vertices),
+            total_entities=sum(stats.entities.values()),
+            total_vertices=sum(stats.vertices.values()),
+            dropped_polygons=stats.dropped_polygons,
+            peak_memory=stats.peak_memory,
+        )
+
+
+class AuthorSummary(models.Model):
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="drawing_summary",
+        verbose_name=_("Author"),
+    )
+    username = models.CharField(
+        _("Username"),
+        max_length=150,
+    )
+    public_drawings = models.PositiveIntegerField(
+        _("Public drawings"),
+        default=0,
+    )
+    private_drawings = models.PositiveIntegerField(
+        _("Private drawings"),
+        default=0,
+    )
+    last_update = models.DateTimeField(
+        _("Last update"),
+        null=True,
+    )
+    # [west, south, east, north] of drawing locations
+    extent = models.JSONField(
+        _("Extent"),
+        null=True,
+    )
+
+    class Meta:
+        verbose_name = _("Author summary")
+        verbose_name_plural = _("Author summaries")
+        ordering = ("username",)
+
+    def __str__(self):
+        return self.username
+
+    @classmethod
+    def refresh_for(cls, user_id):
+        """
+        Recomputes summary of user's drawings inside a transaction, summary is
+        locked (created first if missing, so there is a row to lock) and
+        concurrent saves and deletes can't overwrite each other. Authors
+        without drawings have no summary.
+        """
+        username = (
+            User.objects.filter(pk=user_id).values_list("username", flat=True).first()
+        )
+        if username is None:
+            # author is being deleted, summary goes with it
+            return
+        with transaction.atomic():
+            summary, created = cls.objects.select_for_update().get_or_create(
+                user_id=user_id, defaults={"username": username}
+            )
+            drawings = Drawing.objects.filter(user_id=user_id)
+            counts = drawings.aggregate(
+                public=Count("id", filter=Q(private=False)),
+                private=Count("id", filter=Q(private=True)),
+                modified=Max("modified"),
+            )
+            if not counts["public"] and not counts["private"]:
+                summary.delete()
+                return
+            summary.username = username
+            summary.public_drawings = counts["public"]
+            summary.private_drawings = counts["private"]
+            summary.last_update = counts["modified"]
+            summary.extent = None
+            for geom in drawings.exclude(geom=None).values_list("geom", flat=True):
+                # following conditional for test to work
+                if isinstance(geom, str):
+                    geom = json.loads(geom)
+                if not geom:
+                    continue
+                lon, lat = geom["coordinates"][0], geom["coordinates"][1]
+                if not summary.extent:
+                    summary.extent = [lon, lat, lon, lat]
+                    continue
+                summary.extent = [
+                    min(summary.extent[0], lon),
+                    min(summary.extent[1], lat),
+                    max(summary.extent[2], lon),
+                    max(summary.extent[3], lat),
+                ]
+            summary.save()
+        return summary
+
+
 class Dxf2Csv(models.Model):
 
     dxf = models.FileField(
         _("DXF file"),
         max_length=200,
         upload_to="uploads/djeocad/dxf/",
+        help_text=_("ASCII or binary DXF, also gzip or zip compressed"),
         validators=[
-            FileExtensionValidator(
-                allowed_extensions=[
-                    "dxf",
-                ]
-            )
+            FileExtensionValidator(allowed_extensions=DXF_EXTENSIONS),
+            validate_dxf_file,
         ],
     )
     intro = models.CharField(_("Notes"), null=True, max_length=200)
@@ -806,9 +1666,15 @@ class Dxf2Csv(models.Model):
         name = self.dxf.name.replace("uploads/djeocad/dxf/", "")
         return name.replace(".dxf", "")
 
+    def save(self, *args, **kwargs):
+        # compressed uploads are stored decompressed
+        if self.dxf and not self.dxf._committed:
+            self.dxf = unpack_dxf(self.dxf)
+        super(Dxf2Csv, self).save(*args, **kwargs)
+
     def extract_data(self):
         # get DXF
-        doc = ezdxf.readfile(Path(settings.MEDIA_ROOT).joinpath(str(self.dxf)))
+        doc = read_document(Path(settings.MEDIA_ROOT).joinpath(str(self.dxf)))
         msp = doc.modelspace()
         # entity types
         entity_types = [
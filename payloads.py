@@ -0,0 +1,327 @@
+import atexit
+import gzip
+import json
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import translation
+from django.utils.translation import get_language
+from djgeojson.templatetags.geojson_tags import geojsonfeature
+
+from .instrumentation import stage
+from .topology import encode_topology
+from .utils import get_coordinate_precision
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+    Serialized map data of drawings, cached under drawing map version or
+    written to precompressed files when drawings change
+"""
+
+logger = logging.getLogger("djeocad.payloads")
+
+_payload_executor = None
+
+
+def get_cache():
+    try:
+        alias = settings.DJEOCAD_CACHE
+    except AttributeError:
+        alias = "default"
+    return caches[alias]
+
+
+def get_cache_timeout():
+    try:
+        return settings.DJEOCAD_CACHE_TIMEOUT
+    except AttributeError:
+        return 60 * 60 * 24
+
+
+def use_delta_encoding():
+    try:
+        return settings.DJEOCAD_DELTA_ENCODING
+    except AttributeError:
+        return False
+
+
+def delta_encode_coordinates(coordinates, scale):
+    """
+    Positions become integers (coordinates times scale), in a sequence of
+    positions each one is the difference from the previous one
+    """
+    if isinstance(coordinates[0], (int, float)):
+        return [round(c * scale) for c in coordinates]
+    if not isinstance(coordinates[0][0], (int, float)):
+        return [delta_encode_coordinates(c, scale) for c in coordinates]
+    encoded = []
+    previous = [0] * len(coordinates[0])
+    for position in coordinates:
+        current = [round(c * scale) for c in position]
+        encoded.append([c - p for c, p in zip(current, previous)])
+        previous = current
+    return encoded
+
+
+def delta_encode_geometry(geometry, scale):
+    if geometry is None:
+        return None
+    if geometry["type"] == "GeometryCollection":
+        return dict(
+            geometry,
+            geometries=[
+                delta_encode_geometry(g, scale) for g in geometry["geometries"]
+            ],
+        )
+    if not geometry["coordinates"]:
+        return geometry
+    return dict(
+        geometry,
+        coordinates=delta_encode_coordinates(geometry["coordinates"], scale),
+    )
+
+
+def delta_encode_collection(collection, precision=None):
+    """
+    Encodes a GeoJSON feature collection (dict) with integer delta
+    coordinates, decoded by decodeCollection() in base_list.js
+    """
+    if precision is None:
+        precision = get_coordinate_precision() or 7
+    scale = 10**precision
+    return dict(
+        collection,
+        encoding={"type": "delta", "precision": precision},
+        features=[
+            dict(feature, geometry=delta_encode_geometry(feature["geometry"], scale))
+            for feature in collection["features"]
+        ],
+    )
+
+
+def encode_feature_collection(serialized):
+    """Delta encodes serialized collection if DJEOCAD_DELTA_ENCODING is True"""
+    if not use_delta_encoding():
+        return serialized
+    collection = delta_encode_collection(json.loads(serialized))
+    return json.dumps(collection, separators=(",", ":"))
+
+
+def use_topojson():
+    try:
+        return settings.DJEOCAD_TOPOJSON
+    except AttributeError:
+        return False
+
+
+def get_map_payload_key(drawing):
+    # popup contents are translated, so is the payload
+    return "djeocad-map-%(id)d-%(lang)s" % {
+        "id": drawing.id,
+        "lang": get_language(),
+    }
+
+
+def build_map_payload(drawing):
+    from .models import Insertion
+
+    lines = drawing.related_layers.filter(is_block=False).prefetch_related(
+        "related_entities"
+    )
+    insertions = Insertion.objects.filter(layer__in=lines).select_related(
+        "layer", "block"
+    )
+    marker_data = encode_feature_collection(geojsonfeature(drawing, "popupContent"))
+    if use_topojson():
+        # lines and blocks share arcs in a single topology
+        topology = encode_topology(
+            {
+                "line_data": json.loads(geojsonfeature(lines, "popupContent")),
+                "block_data": json.loads(geojsonfeature(insertions, "popupContent")),
+            }
+        )
+        return {
+            "marker_data": marker_data,
+            "line_data": "null",
+            "block_data": "null",
+            "topology_data": json.dumps(topology, separators=(",", ":")),
+        }
+    return {
+        "marker_data": marker_data,
+        "line_data": encode_feature_collection(geojsonfeature(lines, "popupContent")),
+        "block_data": encode_feature_collection(
+            geojsonfeature(insertions, "popupContent")
+        ),
+    }
+
+
+def get_map_payload(drawing):
+    """
+    Returns serialized marker, line and block data of drawing. Payload is
+    rebuilt only if drawing map version changed since last call.
+    """
+    cache = get_cache()
+    key = get_map_payload_key(drawing)
+    payload = cache.get(key, version=drawing.map_version)
+    if payload is None:
+        with stage("serialize"):
+            payload = build_map_payload(drawing)
+        cache.set(
+            key, payload, timeout=get_cache_timeout(), version=drawing.map_version
+        )
+    return payload
+
+
+def use_payload_files():
+    try:
+        return settings.DJEOCAD_PRECOMPRESSED_PAYLOADS
+    except AttributeError:
+        return False
+
+
+def get_payload_dir():
+    return Path(settings.MEDIA_ROOT).joinpath("djeocad/payloads")
+
+
+def get_payload_path(drawing_id, map_version, language):
+    return get_payload_dir().joinpath(
+        "%(id)d-%(version)d-%(lang)s.json"
+        % {"id": drawing_id, "version": map_version, "lang": language}
+    )
+
+
+def write_payload_files(drawing, languages=None):
+    """
+    Writes map payload of drawing in every language, plain, gzip and
+    brotli compressed (if brotli is installed). Files of older map
+    versions are removed, newer ones may be written concurrently.
+    """
+    if languages is None:
+        languages = [language for language, name in settings.LANGUAGES]
+    directory = get_payload_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    for language in languages:
+        path = get_payload_path(drawing.id, drawing.map_version, language)
+        if path.exists():
+            continue
+        with translation.override(language), stage("serialize"):
+            payload = build_map_payload(drawing)
+        # payload values are serialized already
+        content = (
+            "{"
+            + ",".join('"%s":%s' % (key, value) for key, value in payload.items())
+            + "}"
+        ).encode()
+        files = [(path, content)]
+        files.append((Path(str(path) + ".gz"), gzip.compress(content, mtime=0)))
+        if brotli:
+            files.append((Path(str(path) + ".br"), brotli.compress(content)))
+        for file_path, data in files:
+            write_atomic(file_path, data)
+    for path in directory.glob("%d-*" % drawing.id):
+        if get_payload_version(path) < drawing.map_version:
+            path.unlink(missing_ok=True)
+
+
+def write_atomic(path, data):
+    """
+    Writes data to a temporary file of its own, then renames it to path:
+    readers never get partial files, concurrent writers don't collide
+    """
+    # leading dot keeps temporary files out of "<id>-*" globs
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix="." + path.name, suffix=".tmp", delete=False
+    ) as temp:
+        temp.write(data)
+    try:
+        Path(temp.name).replace(path)
+    except OSError:
+        Path(temp.name).unlink(missing_ok=True)
+        raise
+
+
+def get_payload_version(path):
+    """Map version from "<id>-<version>-<language>.json[.gz|.br]" """
+    try:
+        return int(path.name.split("-")[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def delete_payload_files(drawing_id):
+    for path in get_payload_dir().glob("%d-*" % drawing_id):
+        path.unlink(missing_ok=True)
+
+
+def refresh_payload_files(drawing_ids):
+    from .models import Drawing
+
+    for drawing in Drawing.objects.filter(id__in=drawing_ids).select_related("user"):
+        write_payload_files(drawing)
+
+
+def refresh_payload_files_background(drawing_ids):
+    try:
+        refresh_payload_files(drawing_ids)
+    finally:
+        # worker thread has a connection of its own
+        connection.close()
+
+
+def get_payload_executor():
+    global _payload_executor
+    if _payload_executor is None:
+        _payload_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="djeocad-payloads"
+        )
+        # on graceful exit queued payloads are written before leaving
+        atexit.register(_payload_executor.shutdown, wait=True)
+    return _payload_executor
+
+
+def payload_files_done(drawing_ids, future):
+    if future.exception() is not None:
+        logger.error(
+            "Payload files of drawings %s not written",
+            drawing_ids,
+            exc_info=future.exception(),
+        )
+
+
+def submit_payload_files(drawing_ids):
+    """
+    Writes payload files out of the request, in a background thread,
+    unless DJEOCAD_ASYNC_PAYLOADS is False. Files missing when requested
+    are written by the map view, in the language of the request.
+    """
+    try:
+        background = settings.DJEOCAD_ASYNC_PAYLOADS
+    except AttributeError:
+        background = True
+    if not background:
+        refresh_payload_files(drawing_ids)
+        return
+    future = get_payload_executor().submit(
+        refresh_payload_files_background, drawing_ids
+    )
+    future.add_done_callback(lambda f: payload_files_done(drawing_ids, f))
+
+
+def schedule_payload_files(drawing_ids):
+    """
+    Writes payload files of changed drawings once transaction is committed,
+    if DJEOCAD_PRECOMPRESSED_PAYLOADS is True
+    """
+    if not use_payload_files():
+        return
+    drawing_ids = list(drawing_ids)
+    transaction.on_commit(lambda: submit_payload_files(drawing_ids))
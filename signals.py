@@ -0,0 +1,94 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .downloads import delete_downloads
+from .exports import delete_exports
+from .models import AuthorSummary, Drawing, Insertion, Layer
+from .payloads import delete_payload_files, schedule_payload_files, use_payload_files
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=Drawing)
+@receiver(post_delete, sender=Drawing)
+def update_author_summary(sender, instance, **kwargs):
+    AuthorSummary.refresh_for(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def update_author_username(sender, instance, created, **kwargs):
+    if created:
+        return
+    renamed = (
+        AuthorSummary.objects.filter(user_id=instance.pk)
+        .exclude(username=instance.username)
+        .update(username=instance.username)
+    )
+    if renamed:
+        # map payloads show author username
+        drawings = Drawing.objects.filter(user=instance)
+        drawings.touch()
+        if use_payload_files():
+            schedule_payload_files(drawings.values_list("id", flat=True))
+
+
+@receiver(pre_save, sender=Drawing)
+def bump_drawing_version(sender, instance, **kwargs):
+    # increment in database, stale instances can't roll version back
+    if not instance._state.adding:
+        instance.map_version = F("map_version") + 1
+
+
+@receiver(post_save, sender=Drawing)
+def reload_drawing_version(sender, instance, created, **kwargs):
+    # refresh_from_db() would build a deferred instance (bug #31435)
+    if not created:
+        instance.map_version = (
+            Drawing.objects.filter(id=instance.id)
+            .values_list("map_version", flat=True)
+            .get()
+        )
+
+
+@receiver(post_save, sender=Drawing)
+def write_drawing_payload_files(sender, instance, **kwargs):
+    schedule_payload_files([instance.id])
+
+
+@receiver(post_delete, sender=Drawing)
+def delete_drawing_payload_files(sender, instance, **kwargs):
+    if use_payload_files():
+        id = instance.id
+        transaction.on_commit(lambda: delete_payload_files(id))
+
+
+@receiver(post_delete, sender=Drawing)
+def delete_drawing_downloads(sender, instance, **kwargs):
+    id = instance.id
+    transaction.on_commit(lambda: delete_downloads(id))
+
+
+@receiver(post_delete, sender=Drawing)
+def delete_drawing_exports(sender, instance, **kwargs):
+    id = instance.id
+    transaction.on_commit(lambda: delete_exports(id))
+
+
+@receiver(post_delete, sender=Layer)
+def touch_layer_drawing(sender, instance, **kwargs):
+    # edited layers can't be cloned by identical imports, saved ones touch
+    # drawing in Layer.save
+    Drawing.objects.filter(id=instance.drawing_id).touch(import_signature=None)
+    schedule_payload_files([instance.drawing_id])
+
+
+@receiver(post_save, sender=Insertion)
+@receiver(post_delete, sender=Insertion)
+def touch_insertion_drawing(sender, instance, **kwargs):
+    drawings = Drawing.objects.filter(related_layers__id=instance.layer_id)
+    drawings.touch(import_signature=None)
+    if use_payload_files():
+        schedule_payload_files(drawings.values_list("id", flat=True))
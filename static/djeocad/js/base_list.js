@@ -14,6 +14,123 @@ function map_init(map, options) {
     }
   }
 
+  function decodeCoordinates(coordinates, scale) {
+    // a position
+    if (typeof coordinates[0] === "number") {
+      return coordinates.map(c => c / scale);
+    }
+    // nested sequences of positions
+    if (typeof coordinates[0][0] !== "number") {
+      return coordinates.map(c => decodeCoordinates(c, scale));
+    }
+    // a sequence of positions, each one relative to the previous
+    let previous = coordinates[0].map(() => 0);
+    return coordinates.map(function (position) {
+      previous = position.map((c, i) => c + previous[i]);
+      return previous.map(c => c / scale);
+    });
+  }
+
+  function decodeGeometry(geometry, scale) {
+    if (geometry === null) {
+      return geometry;
+    }
+    if (geometry.type === "GeometryCollection") {
+      geometry.geometries = geometry.geometries.map(g => decodeGeometry(g, scale));
+    } else if (geometry.coordinates.length) {
+      geometry.coordinates = decodeCoordinates(geometry.coordinates, scale);
+    }
+    return geometry;
+  }
+
+  function decodeCollection(collection) {
+    // collections with delta encoded integer coordinates, see payloads.py
+    if (collection === null || !collection.encoding) {
+      return collection;
+    }
+    const scale = Math.pow(10, collection.encoding.precision);
+    for (const feature of collection.features) {
+      feature.geometry = decodeGeometry(feature.geometry, scale);
+    }
+    delete collection.encoding;
+    return collection;
+  }
+
+  function decodeTopology(topology) {
+    // TopoJSON topology to GeoJSON feature collections, see topology.py
+    const scale = topology.transform.scale;
+    const translate = topology.transform.translate;
+    const arcs = topology.arcs.map(function (arc) {
+      let x = 0, y = 0;
+      return arc.map(function (delta) {
+        x += delta[0];
+        y += delta[1];
+        return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+      });
+    });
+
+    function position(point) {
+      return [point[0] * scale[0] + translate[0], point[1] * scale[1] + translate[1]];
+    }
+
+    function line(indexes) {
+      // joined arcs share end and start positions
+      let positions = [];
+      for (const index of indexes) {
+        let arc = index < 0 ? arcs[~index].slice().reverse() : arcs[index];
+        positions = positions.concat(positions.length ? arc.slice(1) : arc);
+      }
+      return positions;
+    }
+
+    function geometry(object) {
+      switch (object.type) {
+        case "GeometryCollection":
+          return {"type": object.type, "geometries": object.geometries.map(geometry)};
+        case "Point":
+          return {"type": object.type, "coordinates": position(object.coordinates)};
+        case "MultiPoint":
+          return {"type": object.type, "coordinates": object.coordinates.map(position)};
+        case "LineString":
+          return {"type": object.type, "coordinates": line(object.arcs)};
+        case "MultiLineString":
+        case "Polygon":
+          return {"type": object.type, "coordinates": object.arcs.map(line)};
+        case "MultiPolygon":
+          return {"type": object.type, "coordinates": object.arcs.map(p => p.map(line))};
+      }
+      return null;
+    }
+
+    let collections = {};
+    for (const [name, object] of Object.entries(topology.objects)) {
+      collections[name] = {
+        "type": "FeatureCollection",
+        "features": object.geometries.map(function (g) {
+          return {"type": "Feature", "properties": g.properties, "geometry": geometry(g)};
+        }),
+      };
+    }
+    return collections;
+  }
+
+  function getTopology() {
+    // line and block data may come in a single topology
+    const element = document.getElementById("topology_data");
+    if (element === null) {
+      return {};
+    }
+    const topology = JSON.parse(element.textContent);
+    return topology === null ? {} : decodeTopology(topology);
+  }
+
+  function getCollection(name, topology) {
+    if (name in topology) {
+      return topology[name];
+    }
+    return decodeCollection(JSON.parse(document.getElementById(name).textContent));
+  }
+
   const base_map = L.tileLayer("https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
     {
       attribution: 'Map data &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors',
@@ -61,31 +178,78 @@ function map_init(map, options) {
       }
     }
     // add objects to layers
-    collection = JSON.parse(document.getElementById("marker_data").textContent);
+    collection = decodeCollection(JSON.parse(document.getElementById("marker_data").textContent));
     for (marker of collection.features) {
       let author = marker.properties.popupContent.layer
       L.geoJson(marker, {onEachFeature: onEachFeature}).addTo(window[author]);
     }
     map.fitBounds(L.geoJson(collection).getBounds(), {padding: [30,30]});
-    collection = JSON.parse(document.getElementById("line_data").textContent);
-    if (collection !== null) {
-      for (line of collection.features) {
+    const map_url = document.getElementById("map_url");
+    if (map_url === null) {
+      addInlineShapes();
+      return;
+    }
+    // lines and blocks come from precompressed payload
+    fetch(JSON.parse(map_url.textContent))
+      .then(function (response) {
+        if (!response.ok) {
+          throw new Error("Map payload not loaded: " + response.status);
+        }
+        return response.json();
+      })
+      .then(function (data) {
+        const topology = data.topology_data ? decodeTopology(data.topology_data) : {};
+        addShapes(
+          topology.line_data || decodeCollection(data.line_data),
+          topology.block_data || decodeCollection(data.block_data)
+        );
+      })
+      .catch(function (error) {
+        // fall back to data embedded in page
+        console.error(error);
+        addInlineShapes();
+      });
+  }
+
+  function addInlineShapes() {
+    const topology = getTopology();
+    addShapes(getCollection("line_data", topology), getCollection("block_data", topology));
+  }
+
+  function addShapes(line_data, block_data) {
+    if (line_data !== null) {
+      for (line of line_data.features) {
         let name = line.properties.popupContent.layer
         L.geoJson(line, {style: setLineStyle, onEachFeature: onEachFeature}).addTo(window[name]);
       }
     }
-    collection = JSON.parse(document.getElementById("block_data").textContent);
-    if (collection !== null) {
-      for (block of collection.features) {
+    if (block_data !== null) {
+      for (block of block_data.features) {
         let name = block.properties.popupContent.layer
         L.geoJson(block, {style: setLineStyle, onEachFeature: onEachFeature}).addTo(window[name]);
       }
     }
   }
 
+  function loadMarkers() {
+    // add markers of following pages, then discard page data
+    for (const page of document.querySelectorAll(".marker-page")) {
+      let collection = decodeCollection(JSON.parse(page.textContent));
+      for (const marker of collection.features) {
+        let author = marker.properties.popupContent.layer
+        L.geoJson(marker, {onEachFeature: onEachFeature}).addTo(window[author]);
+      }
+      page.remove();
+    }
+  }
+
   getCollections()
 
   addEventListener("refreshCollections", function(evt){
     getCollections();
   })
+
+  addEventListener("loadMarkers", function(evt){
+    loadMarkers();
+  })
 }
@@ -0,0 +1,155 @@
+import json
+import shutil
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from djeocad.models import AuthorSummary, Drawing, Layer
+
+User = get_user_model()
+
+
+@override_settings(
+    USE_I18N=False, MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("temp")
+)
+class DjeocadCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        print("\nTest djeocad commands")
+        # Set up non-modified objects used by all test methods
+        User.objects.create(
+            username="andy.war65",
+            password="P4s5W0r6",
+            email="andy@war.com",
+        )
+
+    def tearDown(self):
+        """Checks existing files, then removes them"""
+        path = Path(settings.MEDIA_ROOT).joinpath("uploads/djeocad/dxf/")
+        list = [e for e in path.iterdir() if e.is_file()]
+        for file in list:
+            Path(file).unlink()
+
+    def test_import_manifest(self):
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        with TemporaryDirectory() as tmp:
+            shutil.copy(dxf_path, Path(tmp).joinpath("a.dxf"))
+            shutil.copy(dxf_path, Path(tmp).joinpath("b.dxf"))
+            manifest = Path(tmp).joinpath("manifest.csv")
+            manifest.write_text(
+                "file,title,owner,lon,lat,designx,designy,rotation\n"
+                "a.dxf,Foo,andy.war65,12.493652,41.866288,0,0,0\n"
+                "b.dxf,Bar,andy.war65,12.493652,41.866288,0,0,30\n"
+                "c.dxf,Baz,andy.war65,12.493652,41.866288,0,0,0\n"
+            )
+            out = StringIO()
+            call_command(
+                "djeocad_import",
+                str(manifest),
+                workers=1,
+                batch_size=1,
+                stdout=out,
+                stderr=StringIO(),
+            )
+        self.assertIn("Imported 2 drawings (1 failed)", out.getvalue())
+        d = Drawing.objects.get(title="Foo")
+        self.assertEquals(d.epsg, 32633)
+        self.assertTrue(d.related_layers.filter(name="0").exists())
+        self.assertGreater(d.map_version, 0)
+        d2 = Drawing.objects.get(title="Bar")
+        self.assertEquals(d2.rotation, 30)
+        self.assertEquals(
+            d.related_layers.count(),
+            d2.related_layers.count(),
+        )
+        print("\n-Tested import from manifest")
+        s = AuthorSummary.objects.get(username="andy.war65")
+        self.assertEquals(s.public_drawings, 2)
+        print("\n-Tested author summary after import")
+
+    def test_reextract_resumable(self):
+        u = User.objects.get(username="andy.war65")
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        with open(dxf_path, "rb") as file:
+            content = file.read()
+        d = Drawing(
+            user_id=u.uuid,
+            title="Foo",
+            geom='{"type": "Point","coordinates": [12.493652,41.866288]}',
+            dxf=SimpleUploadedFile("test.dxf", content, "file/dxf"),
+        )
+        d.save()
+        names = set(d.related_layers.values_list("name", flat=True))
+        Layer.objects.filter(drawing_id=d.id).exclude(name="0").delete()
+        with TemporaryDirectory() as tmp:
+            state = Path(tmp).joinpath("state.txt")
+            out = StringIO()
+            call_command("djeocad_reextract", d.id, dry_run=True, workers=1, stdout=out)
+            self.assertIn("1 drawings would be extracted", out.getvalue())
+            self.assertEquals(d.related_layers.count(), 1)
+            print("\n-Tested re-extraction dry run")
+            call_command(
+                "djeocad_reextract",
+                d.id,
+                state_file=str(state),
+                workers=1,
+                stdout=StringIO(),
+            )
+            self.assertEquals(
+                set(d.related_layers.values_list("name", flat=True)), names
+            )
+            self.assertEquals(state.read_text(), "%d\n" % d.id)
+            print("\n-Tested re-extraction")
+            out = StringIO()
+            call_command(
+                "djeocad_reextract",
+                d.id,
+                state_file=str(state),
+                workers=1,
+                stdout=out,
+            )
+            self.assertIn("Extracted 0 drawings", out.getvalue())
+            print("\n-Tested re-extraction resumed")
+
+    def test_benchmark_results(self):
+        with TemporaryDirectory() as tmp:
+            output = Path(tmp).joinpath("benchmark.json")
+            call_command(
+                "djeocad_benchmark",
+                lines=5,
+                polylines=2,
+                arcs=2,
+                hatches=1,
+                blocks=1,
+                instances=2,
+                rooms=2,
+                repeat=1,
+                output=str(output),
+                stdout=StringIO(),
+            )
+            results = json.loads(output.read_text())
+        self.assertEquals(
+            set(results["cases"]["custom"]["results"]),
+            {
+                "extract_dxf",
+                "get_file_to_download",
+                "layer_save_block",
+                "insertion_save",
+                "dxf2csv_extract_data",
+            },
+        )
+        vertices = [
+            size["vertices"] for size in results["cases"]["custom"]["flattening"]
+        ]
+        self.assertEquals(vertices, sorted(vertices, reverse=True))
+        self.assertGreater(vertices[0], vertices[-1])
+        for size in results["cases"]["custom"]["encoding"]:
+            self.assertLess(size["delta_kb"], size["payload_kb"])
+        self.assertFalse(User.objects.filter(username__startswith="djeocad").exists())
+        print("\n-Tested benchmark results")
@@ -0,0 +1,249 @@
+import os
+from pathlib import Path
+from statistics import median, quantiles
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from djeocad.models import AuthorSummary, Drawing, Entity, Insertion, Layer
+
+User = get_user_model()
+
+# queries, 95th percentile milliseconds and response kilobytes per view,
+# override them with DJEOCAD_VIEW_BUDGETS = {"view": {"queries": 10}},
+# milliseconds are checked only if DJEOCAD_CHECK_LATENCY is set
+BUDGETS = {
+    "base_list": {"queries": 6, "p95_ms": 500, "kb": 200},
+    "author_list": {"queries": 6, "p95_ms": 500, "kb": 200},
+    "drawing_list_json": {"queries": 4, "p95_ms": 300, "kb": 200},
+    "drawing_detail": {"queries": 12, "p95_ms": 1000, "kb": 500},
+    "drawing_download": {"queries": 7, "p95_ms": 2000, "kb": 1000},
+    "drawing_update": {"queries": 10, "p95_ms": 1000, "kb": 500},
+    "layer_update": {"queries": 8, "p95_ms": 1000, "kb": 500},
+    "layer_update_post": {"queries": 11, "p95_ms": 2000, "kb": 10},
+    "insert_update": {"queries": 9, "p95_ms": 1000, "kb": 500},
+    "insert_update_post": {"queries": 14, "p95_ms": 2000, "kb": 10},
+}
+AUTHORS = 10
+DRAWINGS = 5
+LAYERS = 20
+BLOCKS = 5
+INSTANCES = 10
+REPEAT = 5
+
+
+def get_budgets():
+    try:
+        custom = settings.DJEOCAD_VIEW_BUDGETS
+    except AttributeError:
+        custom = {}
+    return {
+        name: dict(budget, **custom.get(name, {})) for name, budget in BUDGETS.items()
+    }
+
+
+def check_latency():
+    """
+    Latency depends on the machine, it's checked only if
+    DJEOCAD_CHECK_LATENCY (setting or environment variable) is set
+    """
+    try:
+        return settings.DJEOCAD_CHECK_LATENCY
+    except AttributeError:
+        return bool(os.environ.get("DJEOCAD_CHECK_LATENCY"))
+
+
+def line(x):
+    return {
+        "type": "LineString",
+        "coordinates": [[12.47 + x / 1000, 41.90], [12.48 + x / 1000, 41.91]],
+    }
+
+
+@override_settings(
+    USE_I18N=False, MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("temp")
+)
+class DjeocadLoadTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        print("\nTest djeocad view load")
+        # Set up non-modified objects used by all test methods
+        point = {"type": "Point", "coordinates": [12.493652, 41.866288]}
+        for a in range(AUTHORS):
+            u = User.objects.create(username="author%d" % a, email="a%d@war.com" % a)
+            Drawing.objects.bulk_create(
+                [
+                    Drawing(user=u, title="Drawing %d" % d, geom=point, epsg=32633)
+                    for d in range(DRAWINGS)
+                ]
+            )
+            AuthorSummary.refresh_for(u.pk)
+        u = User.objects.get(username="author0")
+        u.user_permissions.set(
+            Permission.objects.filter(content_type__app_label="djeocad")
+        )
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        with open(dxf_path, "rb") as file:
+            content = file.read()
+        d = Drawing(
+            user=u,
+            title="Foo",
+            geom='{"type": "Point","coordinates": [12.493652,41.866288]}',
+            dxf=SimpleUploadedFile("test.dxf", content, "file/dxf"),
+        )
+        d.save()
+        zero = Layer.objects.get(drawing=d, name="0")
+        Layer.objects.bulk_create(
+            [Layer(drawing=d, name="Layer %d" % i) for i in range(LAYERS)]
+            + [
+                Layer(drawing=d, name="Block %d" % i, is_block=True)
+                for i in range(BLOCKS)
+            ]
+        )
+        # geometries of layers are stored as entities
+        Entity.objects.bulk_create(
+            [
+                Entity.from_geometry(layer.id, line(int(layer.name.split()[1])))
+                for layer in Layer.objects.filter(
+                    drawing=d, name__regex=r"^(Layer|Block) \d+$"
+                )
+            ]
+        )
+        Insertion.objects.bulk_create(
+            [
+                Insertion(
+                    block=block,
+                    layer=zero,
+                    point=point,
+                    geom={"type": "GeometryCollection", "geometries": [line(i)]},
+                )
+                for block in Layer.objects.filter(drawing=d, name__startswith="Block")
+                for i in range(INSTANCES)
+            ]
+        )
+
+    def setUp(self):
+        self.client.force_login(User.objects.get(username="author0"))
+
+    def tearDown(self):
+        """Checks existing files, then removes them"""
+        path = Path(settings.MEDIA_ROOT).joinpath("uploads/djeocad/dxf/")
+        list = [e for e in path.iterdir() if e.is_file()]
+        for file in list:
+            Path(file).unlink()
+
+    def drive(self, name, url, data=None, **extra):
+        """
+        Requests url REPEAT times and checks view budget, queries are the most
+        issued by a single request (first one may have more work to do)
+        """
+        timings = []
+        counts = []
+        for i in range(REPEAT):
+            with CaptureQueriesContext(connection) as queries:
+                start = perf_counter()
+                if data is None:
+                    response = self.client.get(url, **extra)
+                else:
+                    response = self.client.post(url, data, **extra)
+                timings.append((perf_counter() - start) * 1000)
+            counts.append(len(queries))
+            self.assertLess(response.status_code, 400)
+        stats = {
+            "queries": max(counts),
+            "p50_ms": median(timings),
+            "p95_ms": quantiles(timings, n=20)[18],
+            "kb": len(
+                b"".join(response.streaming_content)
+                if response.streaming
+                else response.content
+            )
+            / 1024,
+        }
+        print(
+            "\n-%(name)s: %(queries)d queries, p50 %(p50).1f ms, p95 %(p95).1f ms, "
+            "%(kb).1f KiB"
+            % {
+                "name": name,
+                "queries": stats["queries"],
+                "p50": stats["p50_ms"],
+                "p95": stats["p95_ms"],
+                "kb": stats["kb"],
+            }
+        )
+        budget = get_budgets()[name]
+        if not check_latency():
+            budget.pop("p95_ms", None)
+        for key, limit in budget.items():
+            self.assertLessEqual(
+                stats[key], limit, "%s exceeds %s budget" % (name, key)
+            )
+        return response
+
+    def test_list_views_budget(self):
+        self.drive("base_list", reverse("djeocad:base_list"))
+        self.drive(
+            "author_list",
+            reverse("djeocad:author_list", kwargs={"username": "author1"}),
+        )
+        self.drive("drawing_list_json", reverse("djeocad:drawing_list_json"))
+        print("\n-Tested list views budget")
+
+    def test_drawing_views_budget(self):
+        d = Drawing.objects.get(title="Foo")
+        kwargs = {"username": "author0", "pk": d.id}
+        self.drive("drawing_detail", reverse("djeocad:drawing_detail", kwargs=kwargs))
+        self.drive(
+            "drawing_download",
+            reverse("djeocad:drawing_download", kwargs={"pk": d.id}),
+        )
+        self.drive("drawing_update", reverse("djeocad:drawing_update", kwargs=kwargs))
+        print("\n-Tested drawing views budget")
+
+    def test_layer_insertion_views_budget(self):
+        d = Drawing.objects.get(title="Foo")
+        block = Layer.objects.filter(drawing=d, is_block=True).first()
+        layer = Layer.objects.get(drawing=d, name="Layer 0")
+        insert = block.instances.first()
+        self.drive(
+            "layer_update",
+            reverse(
+                "djeocad:layer_update", kwargs={"username": "author0", "pk": block.id}
+            ),
+        )
+        url = reverse(
+            "djeocad:layer_update", kwargs={"username": "author0", "pk": layer.id}
+        )
+        self.drive(
+            "layer_update_post",
+            url,
+            {
+                "name": layer.name,
+                "color_field": "#FF0000",
+                "linetype": True,
+                "geom": '{"type": "GeometryCollection", "geometries": []}',
+            },
+        )
+        url = reverse(
+            "djeocad:insert_update", kwargs={"username": "author0", "pk": insert.id}
+        )
+        self.drive("insert_update", url)
+        self.drive(
+            "insert_update_post",
+            url,
+            {
+                "layer": insert.layer_id,
+                "point": '{"type": "Point", "coordinates": [12.49, 41.86]}',
+                "rotation": 45,
+                "x_scale": 1,
+                "y_scale": 1,
+            },
+        )
+        print("\n-Tested layer and insertion views budget")
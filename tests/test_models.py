@@ -1,11 +1,36 @@
+import gzip
+import json
+import zipfile
+from io import BytesIO, StringIO
+from math import radians
 from pathlib import Path
 
+import ezdxf
+import numpy as np
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
+from ezdxf.addons import geo
+from filebrowser.base import FileObject
+from PIL import Image
 
-from djeocad.models import Drawing, Layer
+from djeocad.documents import clear_documents, read_document
+from djeocad.geodata import read_geodata
+from djeocad.instrumentation import (
+    ExtractionStats,
+    ImportBudgetExceeded,
+    count_vertices,
+    estimate_vertices,
+)
+from djeocad.models import AuthorSummary, Drawing, Entity, ImportStats, Layer
+from djeocad.utils import (
+    get_image_executor,
+    quantize_geometry,
+    schedule_image_versions,
+    unpack_dxf,
+)
 
 User = get_user_model()
 
@@ -73,6 +98,406 @@ class DjeocadModelTest(TestCase):
         for file in list:
             Path(file).unlink()
 
+    def test_import_stats(self):
+        d = Drawing.objects.get(title="Foo")
+        stats = ImportStats.objects.get(drawing_id=d.id)
+        self.assertGreater(stats.total_entities, 0)
+        self.assertEquals(stats.total_entities, sum(stats.entities.values()))
+        self.assertGreaterEqual(stats.total_vertices, stats.total_entities)
+        for stage in ["read", "proxy", "reprojection", "persist", "total"]:
+            self.assertIn(stage, stats.timings)
+        self.assertIsNone(stats.peak_memory)
+        print("\n-Tested import stats of drawing")
+
+    @override_settings(DJEOCAD_IMPORT_MAX_VERTICES=3)
+    def test_import_budget_truncates(self):
+        u = User.objects.get(username="andy.war65")
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        with open(dxf_path, "rb") as file:
+            content = file.read()
+        d = Drawing(
+            user_id=u.uuid,
+            title="Truncated",
+            geom='{"type": "Point","coordinates": [12.493652,41.866288]}',
+            dxf=SimpleUploadedFile("test.dxf", content, "file/dxf"),
+        )
+        d.save()
+        d2 = Drawing.objects.get(title="Truncated")
+        self.assertTrue(d2.truncated)
+        self.assertEquals(d2.truncation_reason, "limit of 3 vertices exceeded")
+        self.assertTrue(d2.related_layers.filter(name="0").exists())
+        stats = ImportStats.objects.filter(drawing_id=d.id).first()
+        self.assertLessEqual(stats.total_entities, 2)
+        print("\n-Tested import truncated by vertex budget")
+
+    def test_import_budget_estimate(self):
+        doc = ezdxf.new()
+        msp = doc.modelspace()
+        circle = msp.add_circle((0, 0), radius=1000)
+        spline = msp.add_spline_control_frame([(0, 0), (10, 10), (20, 0), (30, 10)])
+        hatch = msp.add_hatch()
+        hatch.paths.add_polyline_path([(0, 0, 1), (10, 0, 0), (0, 0, 0)])
+        stats = ExtractionStats()
+        stats.start()
+        stats.check_budgets(circle, 0.001)
+        print("\n-Tested import budgets unlimited by default")
+        with self.settings(DJEOCAD_IMPORT_MAX_VERTICES=1000):
+            stats = ExtractionStats()
+            stats.start()
+            with self.assertRaises(ImportBudgetExceeded):
+                stats.check_budgets(circle, 0.001)
+            stats.check_budgets(circle, 0.1)
+            stats.check_budgets(spline, 0.001)
+            stats.check_budgets(hatch, 0.001)
+            stats.stop()
+        print("\n-Tested vertex budget checked before flattening")
+        for entity in [circle, spline, hatch]:
+            actual = count_vertices(geo.proxy(entity, distance=0.1).__geo_interface__)
+            estimate = estimate_vertices(entity, 0.1)
+            self.assertLess(abs(estimate - actual), max(actual, 10) * 0.5)
+        print("\n-Tested estimate of flattened vertices")
+        d = Drawing.objects.get(title="Foo")
+        d.max_sagitta = -1
+        with self.assertRaises(ValidationError):
+            d.full_clean(exclude=["intro", "fb_image"])
+        self.assertEquals(d.get_max_sagitta(), 0.001)
+        d.max_sagitta = None
+        with self.settings(DJEOCAD_MAX_SAGITTA=0):
+            self.assertEquals(d.get_max_sagitta(), 0.001)
+        print("\n-Tested curve tolerance floor")
+
+    def test_validate_geometries(self):
+        d = Drawing.objects.get(title="Foo")
+        square = {
+            "type": "Polygon",
+            "coordinates": [[(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]],
+        }
+        bowtie = {
+            "type": "Polygon",
+            "coordinates": [[(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)]],
+        }
+        line = {"type": "LineString", "coordinates": [(0, 0), (1, 1)]}
+        stats = ExtractionStats()
+        geometries = d.validate_geometries([square, bowtie, line], stats)
+        self.assertEquals(geometries, [square, line])
+        self.assertEquals(stats.dropped_polygons, 1)
+        print("\n-Tested invalid polygons dropped")
+        with self.settings(DJEOCAD_INVALID_POLYGONS="repair"):
+            stats = ExtractionStats()
+            geometries = d.validate_geometries([square, bowtie, line], stats)
+        self.assertEquals(len(geometries), 3)
+        self.assertEquals(geometries[1]["type"], "MultiPolygon")
+        self.assertEquals(stats.dropped_polygons, 0)
+        print("\n-Tested invalid polygons repaired")
+
+    def test_quantized_coordinates(self):
+        y = Layer.objects.get(name="Layer")
+        self.assertEquals(
+            y.geom["geometries"][0]["coordinates"][0], [12.4760422, 41.9061409]
+        )
+        print("\n-Tested layer geometry quantized on save")
+        d = Drawing.objects.get(title="Foo")
+        for y in d.related_layers.exclude(name="Layer"):
+            for geometry in y.geom["geometries"]:
+                coords = json.dumps(geometry["coordinates"])
+                self.assertNotRegex(coords, r"\.\d{8}")
+        print("\n-Tested extracted geometries quantized")
+        polygon = {"type": "Polygon", "coordinates": [[], [[1.123456789, 2, 3]]]}
+        self.assertEquals(
+            quantize_geometry(polygon, 2)["coordinates"], [[], [[1.12, 2, 3]]]
+        )
+        print("\n-Tested empty parts kept when quantizing")
+
+    def test_identical_import_cloned(self):
+        d = Drawing.objects.get(title="Foo")
+        self.assertEquals(d.dxf.name, "uploads/djeocad/dxf/%s.dxf" % d.dxf_hash)
+        self.assertIsNone(d.import_signature)
+        print("\n-Tested DXF stored by content hash")
+        u = User.objects.get(username="andy.war65")
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        with open(dxf_path, "rb") as file:
+            content = file.read()
+        point = '{"type": "Point","coordinates": [12.493652,41.866288]}'
+        first = Drawing(
+            user_id=u.uuid,
+            title="First",
+            geom=point,
+            dxf=SimpleUploadedFile("test.dxf", content, "file/dxf"),
+        )
+        first.save()
+        second = Drawing(
+            user_id=u.uuid,
+            title="Second",
+            geom=point,
+            dxf=SimpleUploadedFile("copy.dxf", content, "file/dxf"),
+        )
+        second.save()
+        self.assertEquals(second.dxf.name, d.dxf.name)
+        self.assertEquals(second.import_signature, first.import_signature)
+        self.assertIn("clone", second.import_stats.first().timings)
+        self.assertEquals(
+            [(layer.name, layer.geom) for layer in first.related_layers.all()],
+            [(layer.name, layer.geom) for layer in second.related_layers.all()],
+        )
+        print("\n-Tested identical import cloned")
+        # edited layers are not cloned
+        first.related_layers.get(name="0").save()
+        self.assertTrue(
+            Drawing.objects.filter(id=first.id, import_signature=None).exists()
+        )
+        second.get_file_to_download()
+        self.assertNotEquals(second.dxf.name, d.dxf.name)
+        self.assertTrue(Path(d.dxf.path).exists())
+        print("\n-Tested download doesn't overwrite shared DXF")
+        previous = Path(second.dxf.path)
+        Layer.objects.filter(drawing_id=second.id, name="0").update(
+            color_field="#FF0000"
+        )
+        with self.captureOnCommitCallbacks() as callbacks:
+            second.get_file_to_download()
+        self.assertTrue(Path(second.dxf.path).exists())
+        self.assertTrue(previous.exists())
+        # an upload reusing the file before commit keeps it
+        Drawing.objects.filter(id=first.id).update(
+            dxf=str(previous.relative_to(settings.MEDIA_ROOT))
+        )
+        callbacks[0]()
+        self.assertTrue(previous.exists())
+        Drawing.objects.filter(id=first.id).update(dxf=d.dxf.name)
+        callbacks[0]()
+        self.assertFalse(previous.exists())
+        print("\n-Tested unreferenced DXF removed once committed")
+
+    def test_read_document_cached(self):
+        clear_documents()
+        d = Drawing.objects.get(title="Foo")
+        path = Path(settings.MEDIA_ROOT).joinpath("uploads/djeocad/dxf/cached.dxf")
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        path.write_bytes(dxf_path.read_bytes())
+        doc = read_document(path)
+        self.assertIs(read_document(path), doc)
+        print("\n-Tested parsed document cached")
+        entities = len(doc.modelspace())
+        d.parse_dxf(doc)
+        self.assertEquals(len(doc.modelspace()), entities)
+        self.assertIsNone(doc.modelspace().get_geodata())
+        print("\n-Tested cached document left untouched by extraction")
+        path.write_bytes(dxf_path.read_bytes() + b"\n")
+        self.assertIsNot(read_document(path), doc)
+        with self.settings(DJEOCAD_DOCUMENT_CACHE_MB=0):
+            clear_documents()
+            self.assertIsNot(read_document(path), read_document(path))
+        print("\n-Tested changed files parsed again")
+
+    def test_read_geodata(self):
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        self.assertIsNone(read_geodata(dxf_path))
+        print("\n-Tested missing geodata")
+        d = Drawing.objects.get(title="Foo")
+        doc = ezdxf.readfile(dxf_path)
+        world2utm, utm2world, utm_wcs, rot = d.prepare_transformers()
+        d.fake_geodata(doc.modelspace().new_geodata(), utm_wcs, radians(30))
+        path = Path(settings.MEDIA_ROOT).joinpath("uploads/djeocad/dxf/geo.dxf")
+        doc.saveas(path)
+        expected = ezdxf.readfile(path).modelspace().get_geodata()
+        geodata = read_geodata(path)
+        for name in ["design_point", "reference_point", "north_direction"]:
+            self.assertEquals(geodata.dxf.get(name), expected.dxf.get(name))
+        self.assertEquals(
+            geodata.coordinate_system_definition,
+            expected.coordinate_system_definition,
+        )
+        self.assertEquals(geodata.get_crs(), expected.get_crs())
+        print("\n-Tested geodata scanned from DXF")
+        clear_documents()
+        binary = path.with_name("geo_bin.dxf")
+        doc.saveas(binary, fmt="bin")
+        geodata = read_geodata(binary)
+        self.assertEquals(geodata.dxf.design_point, expected.dxf.design_point)
+        self.assertIs(read_document(binary).modelspace().get_geodata(), geodata)
+        print("\n-Tested geodata of binary DXF through document cache")
+        doc = ezdxf.readfile(dxf_path)
+        record = doc.blocks.new("Geo").block_record
+        xdict = record.new_extension_dict()
+        block_geodata = doc.objects.add_geodata(owner=xdict.dictionary.dxf.handle)
+        block_geodata.dxf.design_point = (5, 5, 0)
+        xdict["ACAD_GEOGRAPHICDATA"] = block_geodata
+        path = path.with_name("geo_block.dxf")
+        doc.saveas(path)
+        self.assertIsNone(read_geodata(path))
+        d.fake_geodata(doc.modelspace().new_geodata(), utm_wcs, radians(30))
+        doc.saveas(path)
+        geodata = read_geodata(path)
+        self.assertEquals(geodata.dxf.design_point, expected.dxf.design_point)
+        print("\n-Tested geodata of other blocks skipped")
+
+    def test_regeoreference_keeps_edits(self):
+        u = User.objects.get(username="andy.war65")
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        with open(dxf_path, "rb") as file:
+            content = file.read()
+        point = '{"type": "Point","coordinates": [12.493652,41.866288]}'
+        moved = Drawing(
+            user_id=u.uuid,
+            title="Moved",
+            geom=point,
+            private=True,
+            dxf=SimpleUploadedFile("test.dxf", content, "file/dxf"),
+        )
+        moved.save()
+        zero = moved.related_layers.get(name="0")
+        zero.color_field = "#123456"
+        zero.save()
+        moved.rotation = 30
+        moved.designx = 5
+        moved.save()
+        self.assertEquals(moved.import_stats.count(), 1)
+        self.assertEquals(moved.related_layers.get(name="0").color_field, "#123456")
+        print("\n-Tested georeference change keeps edits")
+        rotated = Drawing(
+            user_id=u.uuid,
+            title="Rotated",
+            geom=point,
+            private=True,
+            rotation=30,
+            designx=5,
+            dxf=SimpleUploadedFile("test.dxf", content, "file/dxf"),
+        )
+        rotated.save()
+        for layer in rotated.related_layers.all():
+            geom = layer.geom
+            other = moved.related_layers.get(name=layer.name).geom
+            self.assertEquals(len(geom["geometries"]), len(other["geometries"]))
+            for a, b in zip(geom["geometries"], other["geometries"]):
+                self.assertEquals(a["type"], b["type"])
+                self.assertTrue(
+                    np.allclose(a["coordinates"], b["coordinates"], atol=1e-6)
+                )
+        print("\n-Tested moved layers match extraction")
+        doc = ezdxf.readfile(dxf_path)
+        world2utm, utm2world, utm_wcs, rot = moved.prepare_transformers()
+        moved.fake_geodata(doc.modelspace().new_geodata(), utm_wcs, radians(30))
+        stream = StringIO()
+        doc.write(stream)
+        located = Drawing(
+            user_id=u.uuid,
+            title="Geo",
+            geom=point,
+            private=True,
+            dxf=SimpleUploadedFile("geo.dxf", stream.getvalue().encode(), "file/dxf"),
+        )
+        located.save()
+        located.rotation = 10
+        located.save()
+        self.assertEquals(located.import_stats.count(), 2)
+        print("\n-Tested drawing with GEODATA extracted again")
+
+    def test_upload_compressed_and_binary(self):
+        u = User.objects.get(username="andy.war65")
+        dxf_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/test.dxf")
+        content = dxf_path.read_bytes()
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as z:
+            z.writestr("folder/test.dxf", content)
+        binary = BytesIO()
+        ezdxf.readfile(dxf_path).write(binary, fmt="bin")
+        point = '{"type": "Point","coordinates": [12.493652,41.866288]}'
+        uploads = [
+            ("gzip", "test.dxf.gz", gzip.compress(content)),
+            ("zip", "test.zip", archive.getvalue()),
+        ]
+        drawings = []
+        for title, name, data in uploads:
+            d = Drawing(
+                user_id=u.uuid,
+                title=title,
+                geom=point,
+                dxf=SimpleUploadedFile(name, data, "application/octet-stream"),
+            )
+            d.full_clean(exclude=["intro", "fb_image"])
+            d.save()
+            drawings.append(d)
+        self.assertEquals(drawings[0].dxf.read(), content)
+        self.assertEquals(drawings[0].dxf_hash, drawings[1].dxf_hash)
+        print("\n-Tested compressed uploads stored decompressed")
+        d = Drawing(
+            user_id=u.uuid,
+            title="binary",
+            geom=point,
+            dxf=SimpleUploadedFile("test.dxf", binary.getvalue(), "file/dxf"),
+        )
+        d.save()
+        self.assertEquals(
+            list(d.related_layers.order_by("name").values_list("name", flat=True)),
+            list(
+                drawings[0]
+                .related_layers.order_by("name")
+                .values_list("name", flat=True)
+            ),
+        )
+        print("\n-Tested binary upload extracted")
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w") as z:
+            z.writestr("readme.txt", "no drawings here")
+        d.dxf = SimpleUploadedFile("empty.zip", archive.getvalue(), "application/zip")
+        with self.assertRaises(ValidationError):
+            d.full_clean(exclude=["intro", "fb_image"])
+        for data in [archive.getvalue(), b"PK\x03\x04 corrupt"]:
+            with self.assertRaises(ValidationError):
+                unpack_dxf(SimpleUploadedFile("bad.zip", data))
+        print("\n-Tested zip without DXF rejected")
+        with self.settings(DJEOCAD_MAX_DXF_SIZE=0.01):
+            for title, name, data in uploads:
+                d.dxf = SimpleUploadedFile(name, data, "application/octet-stream")
+                with self.assertRaises(ValidationError):
+                    d.full_clean(exclude=["intro", "fb_image"])
+                with self.assertRaises(ValidationError):
+                    unpack_dxf(SimpleUploadedFile(name, data))
+        print("\n-Tested decompressed size ceiling")
+
+    def test_layer_entities(self):
+        d = Drawing.objects.get(title="Foo")
+        y = Layer.objects.get(name="Layer")
+        entity = y.related_entities.get()
+        self.assertEquals(entity.geom_type, "LineString")
+        self.assertEquals(entity.handle, "")
+        self.assertAlmostEquals(entity.minx, 12.4760422)
+        self.assertAlmostEquals(entity.maxy, 41.9061409)
+        self.assertEquals(y.geom["geometries"], [entity.geom])
+        print("\n-Tested entity type, bounding box and layer geometry")
+        extracted = Entity.objects.filter(layer__drawing_id=d.id).exclude(layer=y)
+        self.assertTrue(extracted.exists())
+        self.assertFalse(extracted.filter(handle="").exists())
+        print("\n-Tested extracted entities keep DXF handles")
+        line = {
+            "type": "LineString",
+            "coordinates": [[12.47, 41.9], [12.48, 41.91]],
+        }
+        y.geom = {
+            "type": "GeometryCollection",
+            "geometries": y.geom["geometries"] + [line],
+        }
+        version = Drawing.objects.get(id=d.id).map_version
+        y.save()
+        self.assertEquals(Drawing.objects.get(id=d.id).map_version, version + 1)
+        self.assertEquals(y.related_entities.count(), 2)
+        self.assertTrue(y.related_entities.filter(id=entity.id).exists())
+        print("\n-Tested layer save keeps unchanged entities")
+        version = Drawing.objects.get(id=d.id).map_version
+        added = y.related_entities.last()
+        added.geom = {
+            "type": "LineString",
+            "coordinates": [[12.47, 41.9], [12.49, 41.92]],
+        }
+        added.save()
+        self.assertEquals(Entity.objects.get(id=added.id).maxx, 12.49)
+        self.assertEquals(Layer.objects.get(id=y.id).geom["geometries"][1], added.geom)
+        self.assertGreater(Drawing.objects.get(id=d.id).map_version, version)
+        self.assertTrue(Drawing.objects.get(id=d.id).needs_refresh)
+        added.delete()
+        self.assertEquals(Layer.objects.get(id=y.id).geom["geometries"], [entity.geom])
+        print("\n-Tested single entity edit and delete")
+
     def test_model__str__(self):
         d = Drawing.objects.get(title="Foo")
         self.assertEquals(d.__str__(), "Foo")
@@ -110,3 +535,73 @@ class DjeocadModelTest(TestCase):
             },
         )
         print("\n-Tested layer popupContent")
+
+    def test_summary_on_drawing_save_delete(self):
+        u = User.objects.get(username="andy.war65")
+        s = AuthorSummary.objects.get(user_id=u.uuid)
+        self.assertEquals(s.username, "andy.war65")
+        self.assertEquals(s.public_drawings, 1)
+        self.assertEquals(s.private_drawings, 0)
+        self.assertEquals(s.extent, [12.493652, 41.866288, 12.493652, 41.866288])
+        print("\n-Tested author summary on drawing save")
+        s.delete()
+        AuthorSummary.refresh_for(u.uuid)
+        s = AuthorSummary.objects.get(user_id=u.uuid)
+        self.assertEquals(s.public_drawings, 1)
+        d = Drawing.objects.get(title="Foo")
+        self.assertEquals(s.last_update, d.modified)
+        print("\n-Tested missing author summary created")
+        u.username = "andy.war66"
+        u.save()
+        s.refresh_from_db()
+        self.assertEquals(s.username, "andy.war66")
+        self.assertGreater(Drawing.objects.get(title="Foo").map_version, d.map_version)
+        print("\n-Tested author rename touches drawings")
+        d.refresh_from_db()
+        d.private = True
+        d.save()
+        s.refresh_from_db()
+        self.assertEquals(s.public_drawings, 0)
+        self.assertEquals(s.private_drawings, 1)
+        d.delete()
+        self.assertFalse(AuthorSummary.objects.filter(user_id=u.uuid).exists())
+        print("\n-Tested author summary on drawing delete")
+
+    def test_image_versions_background(self):
+        with self.assertLogs("djeocad.images", "ERROR"):
+            schedule_image_versions(FileObject("uploads/images/drawing/no.jpg"))
+            # single worker, done callbacks of previous task have run
+            get_image_executor().submit(int).result()
+        print("\n-Tested failed image versions logged")
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        img_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/image.jpg")
+        with open(img_path, "rb") as file:
+            content = file.read()
+        d2 = Drawing(user_id=u.uuid, title="Baz", geom=d.geom, dxf=d.dxf, epsg=d.epsg)
+        d2.image = SimpleUploadedFile("image3.jpg", content, "image/jpg")
+        with self.captureOnCommitCallbacks(execute=True):
+            d2.save()
+        self.assertTrue(d2.get_thumbnail_path().endswith("image3_popup.jpg"))
+        # wide version is generated in background only
+        path = Path(settings.MEDIA_ROOT).joinpath(d2.fb_image.version_path("wide"))
+        self.assertTrue(path.exists())
+        self.assertFalse(list(path.parent.glob(".*")))
+        print("\n-Tested popup waits for background versions")
+
+    @override_settings(DJEOCAD_ASYNC_IMAGES=False)
+    def test_wide_image_version(self):
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        img_path = Path(settings.STATIC_ROOT).joinpath("djeocad/tests/image.jpg")
+        with open(img_path, "rb") as file:
+            content = file.read()
+        d2 = Drawing(user_id=u.uuid, title="Bar", geom=d.geom, dxf=d.dxf, epsg=d.epsg)
+        d2.image = SimpleUploadedFile("image2.jpg", content, "image/jpg")
+        with self.captureOnCommitCallbacks(execute=True):
+            d2.save()
+        self.assertEquals(str(d2.fb_image), "uploads/images/drawing/image2.jpg")
+        path = Path(settings.MEDIA_ROOT).joinpath(d2.fb_image.version_path("wide"))
+        with Image.open(path) as img:
+            self.assertEquals(img.size, (1600, 800))
+        print("\n-Tested image versions generated after commit")
@@ -1,16 +1,85 @@
+import gzip
+import json
+import sqlite3
+import struct
+import zipfile
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
 from django.urls import reverse
 
-from djeocad.models import Drawing
+from djeocad.downloads import delete_downloads, get_download
+from djeocad.exports import NODE, delete_exports, get_export
+from djeocad.models import Drawing, Layer
+from djeocad.payloads import (
+    delete_payload_files,
+    get_cache,
+    get_map_payload,
+    get_payload_path,
+    write_payload_files,
+)
+from djeocad.topology import encode_topology
 
 User = get_user_model()
 
 
+def read_table(buf, position=0):
+    """Field reader of FlatBuffers table at position (root if 0)"""
+    if not position:
+        position = struct.unpack_from("<I", buf)[0]
+    vtable = position - struct.unpack_from("<i", buf, position)[0]
+    size = struct.unpack_from("<H", buf, vtable)[0]
+
+    def field(i, kind):
+        offset = struct.unpack_from("<H", buf, vtable + 4 + 2 * i)[0]
+        if 4 + 2 * i >= size or not offset:
+            return None
+        slot = position + offset
+        if kind == "table":
+            return read_table(buf, slot + struct.unpack_from("<I", buf, slot)[0])
+        if kind in ("string", "[double]"):
+            start = slot + struct.unpack_from("<I", buf, slot)[0]
+            length = struct.unpack_from("<I", buf, start)[0]
+            if kind == "string":
+                return buf[start + 4 : start + 4 + length].decode()
+            return np.frombuffer(buf, "<f8", length, start + 4)
+        return struct.unpack_from(kind, buf, slot)[0]
+
+    return field
+
+
+def search_packed_rtree(nodes, node_size, count, box):
+    """Offsets of features whose boxes intersect box, root to leaves"""
+    levels = [count]
+    while levels[-1] > 1:
+        levels.append(-(-levels[-1] // node_size))
+    ends = list(np.cumsum(levels[::-1]))
+    found = []
+    pending = [0]
+    while pending:
+        i = pending.pop()
+        node = nodes[i]
+        if (
+            node["minx"] > box[2]
+            or node["miny"] > box[3]
+            or node["maxx"] < box[0]
+            or node["maxy"] < box[1]
+        ):
+            continue
+        if i >= ends[-2]:
+            found.append(int(node["offset"]))
+            continue
+        first = int(node["offset"])
+        end = min(e for e in ends if e > first)
+        pending.extend(range(first, min(first + node_size, end)))
+    return found
+
+
 @override_settings(
     USE_I18N=False, MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("temp")
 )
@@ -139,3 +208,321 @@ class DjeocadViewTest(TestCase):
         )
         self.assertTemplateUsed(response, "djeocad/drawing_detail.html")
         print("\n-Tested drawing detail template")
+
+    def test_map_payload_follows_drawing_version(self):
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        url = reverse(
+            "djeocad:drawing_detail", kwargs={"username": u.username, "pk": d.id}
+        )
+        self.client.get(url)
+        layer = Layer.objects.filter(drawing_id=d.id, is_block=False).last()
+        layer.name = "Renamed"
+        layer.save()
+        d2 = Drawing.objects.get(title="Foo")
+        self.assertGreater(d2.map_version, d.map_version)
+        print("\n-Tested drawing version bumped by layer change")
+        response = self.client.get(url)
+        self.assertContains(response, "Renamed")
+        print("\n-Tested map payload refreshed on new version")
+
+    def test_conditional_get_not_modified(self):
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        url = reverse(
+            "djeocad:drawing_detail", kwargs={"username": u.username, "pk": d.id}
+        )
+        response = self.client.get(url)
+        etag = response["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        print("\n-Tested drawing detail not modified")
+        layer = Layer.objects.filter(drawing_id=d.id, is_block=False).last()
+        layer.color_field = "#FF0000"
+        layer.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        print("\n-Tested drawing detail modified by layer change")
+        response = self.client.get(reverse("djeocad:base_list"))
+        etag = response["ETag"]
+        response = self.client.get(
+            reverse("djeocad:base_list"), HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+        print("\n-Tested base list not modified")
+
+    def test_conditional_get_private_drawing(self):
+        d = Drawing.objects.get(title="Bar")
+        url = reverse(
+            "djeocad:drawing_detail", kwargs={"username": "andy.war65", "pk": d.id}
+        )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 403)
+        print("\n-Tested private drawing not revalidated by not author")
+
+    def test_download_formats(self):
+        d = Drawing.objects.get(title="Foo")
+        url = reverse("djeocad:drawing_download", kwargs={"pk": d.id})
+        response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "text/plain")
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"SECTION", content[:20])
+        print("\n-Tested ASCII download")
+        d = Drawing.objects.get(title="Foo")
+        response = self.client.get(url + "?format=bin")
+        self.assertTrue(
+            b"".join(response.streaming_content).startswith(b"AutoCAD Binary DXF")
+        )
+        path = get_download(d, "bin")
+        modified = path.stat().st_mtime_ns
+        self.client.get(url + "?format=bin")
+        self.assertEqual(path.stat().st_mtime_ns, modified)
+        print("\n-Tested binary download written once")
+        response = self.client.get(url + "?format=gzip")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="Foo.dxf.gz"'
+        )
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), content)
+        response = self.client.get(url + "?format=zip")
+        archive = zipfile.ZipFile(BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(archive.read("Foo.dxf"), content)
+        self.assertFalse(list(path.parent.glob(".*.tmp")))
+        print("\n-Tested compressed downloads")
+        response = self.client.get(url + "?format=dwg")
+        self.assertEqual(response.status_code, 404)
+        print("\n-Tested unknown download format")
+        delete_downloads(d.id)
+
+    def test_export_formats(self):
+        d = Drawing.objects.get(title="Foo")
+        url = reverse("djeocad:drawing_export", kwargs={"pk": d.id})
+        response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "application/geo+json-seq")
+        lines = b"".join(response.streaming_content).decode().split("\n")[:-1]
+        self.assertTrue(lines)
+        feature = json.loads(lines[0].lstrip("\x1e"))
+        self.assertEqual(
+            list(feature["properties"]), ["layer", "block", "color", "linetype"]
+        )
+        print("\n-Tested GeoJSON sequence export")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="Foo.geojsonl"'
+        )
+        response = self.client.get(url + "?format=gpkg")
+        self.assertIn("Foo.gpkg", response["Content-Disposition"])
+        path = get_export(d, "gpkg")
+        db = sqlite3.connect(path)
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM entities").fetchone()[0], len(lines)
+        )
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM rtree_entities_geom").fetchone()[0],
+            len(lines),
+        )
+        db.close()
+        print("\n-Tested GeoPackage export")
+        response = self.client.get(url + "?format=fgb")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="Foo.fgb"'
+        )
+        content = b"".join(response.streaming_content)
+        self.assertTrue(content.startswith(b"fgb\x03fgb"))
+        size = struct.unpack_from("<I", content, 8)[0]
+        header = read_table(content[12 : 12 + size])
+        self.assertEqual(header(0, "string"), "Foo")
+        count = header(8, "<Q")
+        self.assertEqual(count, len(lines))
+        self.assertEqual(header(10, "table")(1, "<i"), 4326)
+        print("\n-Tested FlatGeobuf header")
+        node_size = header(9, "<H")
+        total = count
+        n = count
+        while n > 1:
+            n = -(-n // node_size)
+            total += n
+        nodes = np.frombuffer(content, NODE, total, 12 + size)
+        data = 12 + size + total * NODE.itemsize
+        for line in lines:
+            geometry = json.loads(line.lstrip("\x1e"))["geometry"]
+            if geometry["type"] == "LineString":
+                break
+        xs, ys = zip(*[p[:2] for p in geometry["coordinates"]])
+        box = (min(xs), min(ys), max(xs), max(ys))
+        matches = []
+        for offset in search_packed_rtree(nodes, node_size, count, box):
+            feature_size = struct.unpack_from("<I", content, data + offset)[0]
+            feature = read_table(content[data + offset + 4 :][:feature_size])
+            xy = feature(0, "table")(1, "[double]")
+            if xy is not None:
+                matches.append(list(xy))
+        self.assertIn([c for p in zip(xs, ys) for c in p], matches)
+        print("\n-Tested FlatGeobuf index search")
+        response = self.client.get(url + "?format=shp")
+        self.assertEqual(response.status_code, 404)
+        dp = Drawing.objects.get(title="Bar")
+        response = self.client.get(
+            reverse("djeocad:drawing_export", kwargs={"pk": dp.id})
+        )
+        self.assertEqual(response.status_code, 403)
+        print("\n-Tested unknown format and private drawing export")
+        delete_exports(d.id)
+
+    @override_settings(DJEOCAD_PAGE_SIZE=1)
+    def test_keyset_pagination(self):
+        u = User.objects.get(username="andy.war65")
+        point = {"type": "Point", "coordinates": [12.493652, 41.866288]}
+        Drawing.objects.bulk_create(
+            [Drawing(user_id=u.uuid, title="Baz", geom=point, epsg=32633)]
+        )
+        response = self.client.get(reverse("djeocad:drawing_list_json"))
+        first = response.json()
+        self.assertEqual(len(first["features"]), 1)
+        self.assertIsNotNone(first["next"])
+        response = self.client.get(
+            reverse("djeocad:drawing_list_json"), {"after": first["next"]}
+        )
+        second = response.json()
+        self.assertEqual(len(second["features"]), 1)
+        self.assertIsNone(second["next"])
+        self.assertNotEqual(
+            first["features"][0]["properties"], second["features"][0]["properties"]
+        )
+        print("\n-Tested drawing list JSON pages")
+        response = self.client.get(
+            reverse("djeocad:author_list", kwargs={"username": u.username}),
+            {"after": first["next"]},
+            HTTP_HX_REQUEST="true",
+        )
+        self.assertTemplateUsed(response, "djeocad/htmx/drawing_page.html")
+        self.assertContains(response, "Baz")
+        self.assertNotContains(response, "Foo")
+        print("\n-Tested author list htmx next page")
+
+    def test_delta_encoding(self):
+        response = self.client.get(
+            reverse("djeocad:drawing_list_json"), {"encoding": "delta"}
+        )
+        collection = response.json()
+        self.assertEqual(collection["encoding"], {"type": "delta", "precision": 7})
+        self.assertEqual(
+            collection["features"][0]["geometry"]["coordinates"],
+            [124936520, 418662880],
+        )
+        print("\n-Tested delta encoded drawing list JSON")
+        d = Drawing.objects.get(title="Foo")
+        get_cache().clear()
+        with self.settings(DJEOCAD_DELTA_ENCODING=True):
+            payload = get_map_payload(d)
+        lines = json.loads(payload["line_data"])
+        self.assertEqual(lines["encoding"]["type"], "delta")
+        get_cache().clear()
+        print("\n-Tested delta encoded map payload")
+
+    def test_topojson_payload(self):
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        get_cache().clear()
+        with self.settings(DJEOCAD_TOPOJSON=True):
+            response = self.client.get(
+                reverse(
+                    "djeocad:drawing_detail",
+                    kwargs={"username": u.username, "pk": d.id},
+                )
+            )
+        self.assertContains(response, 'id="topology_data"')
+        topology = json.loads(response.context["map_data"]["topology_data"])
+        self.assertEqual(topology["type"], "Topology")
+        self.assertEqual(
+            len(topology["objects"]["line_data"]["geometries"]),
+            d.related_layers.filter(is_block=False).count(),
+        )
+        get_cache().clear()
+        print("\n-Tested TopoJSON map payload")
+        rooms = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "properties": {},
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [
+                            [[x, 0], [x + 1, 0], [x + 1, 1], [x, 1], [x, 0]]
+                        ],
+                    },
+                }
+                for x in (0, 1)
+            ],
+        }
+        topology = encode_topology({"rooms": rooms}, precision=0)
+        first, second = topology["objects"]["rooms"]["geometries"]
+        # the wall between rooms is a single arc, reversed in second room
+        shared = set(first["arcs"][0]) & {~i for i in second["arcs"][0]}
+        self.assertEqual(len(shared), 1)
+        self.assertEqual(len(topology["arcs"]), 3)
+        print("\n-Tested TopoJSON shared arcs")
+
+    @override_settings(
+        DJEOCAD_PRECOMPRESSED_PAYLOADS=True, DJEOCAD_ASYNC_PAYLOADS=False
+    )
+    def test_precompressed_payload(self):
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        layer = d.related_layers.get(name="0")
+        with self.captureOnCommitCallbacks(execute=True):
+            layer.save()
+        version = Drawing.objects.values_list("map_version", flat=True).get(id=d.id)
+        path = get_payload_path(d.id, version, "en")
+        self.assertTrue(Path(str(path) + ".gz").exists())
+        print("\n-Tested payload files written on layer change")
+        response = self.client.get(
+            reverse(
+                "djeocad:drawing_detail", kwargs={"username": u.username, "pk": d.id}
+            )
+        )
+        url = reverse("djeocad:drawing_map_json", kwargs={"pk": d.id})
+        self.assertContains(response, url)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        payload = json.loads(gzip.decompress(b"".join(response.streaming_content)))
+        self.assertEqual(payload["line_data"]["type"], "FeatureCollection")
+        response = self.client.get(url)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), payload)
+        print("\n-Tested precompressed payload served")
+        stale = Drawing.objects.get(id=d.id)
+        stale.map_version = version - 1
+        write_payload_files(stale, ["en"])
+        self.assertTrue(path.exists())
+        self.assertFalse(list(path.parent.glob(".*.tmp")))
+        print("\n-Tested stale writer keeps newer payload files")
+        delete_payload_files(d.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(list(path.parent.glob("%d-%d-*" % (d.id, version))))
+        print("\n-Tested missing payload file rewritten")
+        delete_payload_files(d.id)
+
+    @override_settings(
+        DJEOCAD_INSTRUMENTATION=True,
+        MIDDLEWARE=settings.MIDDLEWARE + ["djeocad.instrumentation.TimingMiddleware"],
+    )
+    def test_server_timing_header(self):
+        u = User.objects.get(username="andy.war65")
+        d = Drawing.objects.get(title="Foo")
+        url = reverse(
+            "djeocad:drawing_detail", kwargs={"username": u.username, "pk": d.id}
+        )
+        # payload must be serialized again
+        get_cache().clear()
+        with self.assertLogs("djeocad.instrumentation", level="INFO") as logs:
+            response = self.client.get(url)
+        self.assertIn("sql;dur=", response["Server-Timing"])
+        self.assertIn("serialize;dur=", response["Server-Timing"])
+        self.assertIn('"view": "djeocad:drawing_detail"', logs.output[0])
+        print("\n-Tested server timing of drawing detail")
+        with self.settings(DJEOCAD_INSTRUMENTATION_SAMPLE_RATE=0):
+            response = self.client.get(url)
+        self.assertFalse(response.has_header("Server-Timing"))
+        print("\n-Tested server timing not sampled")
@@ -0,0 +1,224 @@
+from .utils import get_coordinate_precision
+
+"""
+    TopoJSON encoding of GeoJSON feature collections: coordinates are
+    quantized on a grid, lines and rings are cut where they meet and every
+    arc is stored once, then referenced by the geometries sharing it.
+    Decoded by decodeTopology() in base_list.js
+"""
+
+
+class TopologyBuilder:
+    def __init__(self, scale, translate):
+        self.scale = scale
+        self.translate = translate
+        self.lines = []
+        self.neighbors = {}
+        self.endpoints = set()
+        self.arcs = []
+        self.arc_index = {}
+
+    def quantize(self, position):
+        return (
+            round((position[0] - self.translate[0]) / self.scale[0]),
+            round((position[1] - self.translate[1]) / self.scale[1]),
+        )
+
+    def add_sequence(self, coordinates, closed):
+        """Stores a quantized line or ring, returns its index in lines"""
+        points = []
+        for position in coordinates:
+            point = self.quantize(position)
+            if not points or points[-1] != point:
+                points.append(point)
+        if closed and len(points) > 1 and points[0] == points[-1]:
+            points.pop()
+        if len(points) == 1 and not closed:
+            # collapsed line, keep it drawable
+            points.append(points[0])
+        if not closed:
+            self.endpoints.update([points[0], points[-1]])
+        count = len(points)
+        for i, point in enumerate(points):
+            neighbors = self.neighbors.setdefault(point, set())
+            if closed:
+                neighbors.add(points[i - 1])
+                neighbors.add(points[(i + 1) % count])
+            else:
+                if i > 0:
+                    neighbors.add(points[i - 1])
+                if i < count - 1:
+                    neighbors.add(points[i + 1])
+        self.lines.append((points, closed))
+        return len(self.lines) - 1
+
+    def is_junction(self, point):
+        """Lines branch or end here"""
+        return point in self.endpoints or len(self.neighbors[point]) > 2
+
+    def get_arc(self, points):
+        """Returns index of arc, negative (one's complement) if reversed"""
+        key = tuple(points)
+        if key in self.arc_index:
+            return self.arc_index[key]
+        reverse = key[::-1]
+        if reverse in self.arc_index:
+            return ~self.arc_index[reverse]
+        self.arcs.append(points)
+        self.arc_index[key] = len(self.arcs) - 1
+        return len(self.arcs) - 1
+
+    def cut(self, index):
+        """Splits stored line or ring at junctions, returns arc indexes"""
+        points, closed = self.lines[index]
+        if closed:
+            junctions = [i for i, p in enumerate(points) if self.is_junction(p)]
+            if junctions:
+                start = junctions[0]
+            else:
+                # same ring drawn from another vertex is the same arc
+                start = points.index(min(points))
+            points = points[start:] + points[:start] + [points[start]]
+        arcs = []
+        arc = [points[0]]
+        for i, point in enumerate(points[1:], start=1):
+            arc.append(point)
+            if i < len(points) - 1 and self.is_junction(point):
+                arcs.append(self.get_arc(arc))
+                arc = [point]
+        arcs.append(self.get_arc(arc))
+        return arcs
+
+    def encode_arcs(self):
+        """Arc positions after the first are relative to the previous one"""
+        encoded = []
+        for arc in self.arcs:
+            x0, y0 = 0, 0
+            deltas = []
+            for x, y in arc:
+                deltas.append([x - x0, y - y0])
+                x0, y0 = x, y
+            encoded.append(deltas)
+        return encoded
+
+
+def iter_positions(geometry):
+    if geometry is None:
+        return
+    if geometry["type"] == "GeometryCollection":
+        for g in geometry["geometries"]:
+            yield from iter_positions(g)
+        return
+    stack = [geometry["coordinates"]]
+    while stack:
+        coordinates = stack.pop()
+        if not coordinates:
+            continue
+        if isinstance(coordinates[0], (int, float)):
+            yield coordinates
+        else:
+            stack.extend(coordinates)
+
+
+def collect(builder, geometry):
+    """First pass: stores lines and rings, returns a geometry skeleton"""
+    if geometry is None:
+        return None
+    kind = geometry["type"]
+    if kind == "GeometryCollection":
+        return {
+            "type": kind,
+            "geometries": [collect(builder, g) for g in geometry["geometries"]],
+        }
+    coordinates = geometry["coordinates"]
+    if not coordinates:
+        return {"type": None}
+    if kind == "Point":
+        return {"type": kind, "coordinates": list(builder.quantize(coordinates))}
+    if kind == "MultiPoint":
+        return {
+            "type": kind,
+            "coordinates": [list(builder.quantize(p)) for p in coordinates],
+        }
+    if kind == "LineString":
+        return {"type": kind, "lines": builder.add_sequence(coordinates, False)}
+    if kind == "MultiLineString":
+        return {
+            "type": kind,
+            "lines": [builder.add_sequence(line, False) for line in coordinates],
+        }
+    if kind == "Polygon":
+        return {
+            "type": kind,
+            "lines": [builder.add_sequence(ring, True) for ring in coordinates],
+        }
+    return {
+        "type": kind,
+        "lines": [
+            [builder.add_sequence(ring, True) for ring in polygon]
+            for polygon in coordinates
+        ],
+    }
+
+
+def link(builder, skeleton):
+    """Second pass: replaces stored lines with arc indexes"""
+    if skeleton is None or skeleton["type"] is None:
+        return skeleton
+    if skeleton["type"] == "GeometryCollection":
+        skeleton["geometries"] = [link(builder, g) for g in skeleton["geometries"]]
+        return skeleton
+    if "lines" not in skeleton:
+        return skeleton
+    lines = skeleton.pop("lines")
+    if skeleton["type"] == "LineString":
+        skeleton["arcs"] = builder.cut(lines)
+    elif skeleton["type"] in ("MultiLineString", "Polygon"):
+        skeleton["arcs"] = [builder.cut(line) for line in lines]
+    else:
+        skeleton["arcs"] = [[builder.cut(ring) for ring in p] for p in lines]
+    return skeleton
+
+
+def encode_topology(collections, precision=None):
+    """
+    Encodes a dict of GeoJSON feature collections (as dicts) in a single
+    TopoJSON topology, one object for each collection. Grid step is
+    10 ** -precision degrees, by default DJEOCAD_COORDINATE_PRECISION.
+    """
+    if precision is None:
+        precision = get_coordinate_precision() or 7
+    xs = []
+    ys = []
+    for collection in collections.values():
+        for feature in collection["features"]:
+            for position in iter_positions(feature["geometry"]):
+                xs.append(position[0])
+                ys.append(position[1])
+    step = 10**-precision
+    translate = [min(xs, default=0), min(ys, default=0)]
+    builder = TopologyBuilder([step, step], translate)
+    skeletons = {
+        name: [
+            (feature, collect(builder, feature["geometry"]))
+            for feature in collection["features"]
+        ]
+        for name, collection in collections.items()
+    }
+    objects = {}
+    for name, features in skeletons.items():
+        geometries = []
+        for feature, skeleton in features:
+            geometry = link(builder, skeleton) or {"type": None}
+            if "properties" in feature:
+                geometry["properties"] = feature["properties"]
+            if "id" in feature:
+                geometry["id"] = feature["id"]
+            geometries.append(geometry)
+        objects[name] = {"type": "GeometryCollection", "geometries": geometries}
+    return {
+        "type": "Topology",
+        "transform": {"scale": builder.scale, "translate": translate},
+        "objects": objects,
+        "arcs": builder.encode_arcs(),
+    }
@@ -26,6 +26,9 @@ from .views import (
     LayerUpdateView,
     csv_download,
     drawing_download,
+    drawing_export,
+    drawing_list_json,
+    drawing_map_json,
 )
 
 app_name = "djeocad"
@@ -108,6 +111,19 @@ urlpatterns = [
         name="insert_explode",
     ),
     path(_("drawing/<pk>/download/"), drawing_download, name="drawing_download"),
+    path(_("drawing/<pk>/export/"), drawing_export, name="drawing_export"),
+    # JSON API
+    path("api/drawings/", drawing_list_json, name="drawing_list_json"),
+    path(
+        "api/drawings/<int:pk>/map/",
+        drawing_map_json,
+        name="drawing_map_json",
+    ),
+    path(
+        "api/<username>/drawings/",
+        drawing_list_json,
+        name="author_drawing_list_json",
+    ),
     # Inlines
     path(
         "layer/<pk>/delete/",
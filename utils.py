@@ -1,13 +1,35 @@
+import atexit
+import gzip
+import json
+import logging
+import tempfile
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
+import numpy as np
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.utils.translation import gettext_lazy as _
 from ezdxf import colors
+from filebrowser.settings import VERSION_QUALITY, VERSIONS
+from filebrowser.utils import process_image
 from PIL import Image
 
 """
     Collection of utilities
 """
 
+logger = logging.getLogger("djeocad.images")
+
+_image_executor = None
+# futures of image versions being generated, by image path
+_image_futures = {}
+_image_lock = threading.Lock()
+
 
 def cad2hex(color):
     if isinstance(color, tuple):
@@ -16,20 +38,357 @@ def cad2hex(color):
     return "#{:06X}".format(rgb24)
 
 
-def check_wide_image(fb_image):
+def get_coordinate_precision():
+    """Decimals kept in stored lon/lat, None keeps full precision"""
+    try:
+        return settings.DJEOCAD_COORDINATE_PRECISION
+    except AttributeError:
+        return 7
+
+
+def quantize_coordinates(coordinates, precision):
+    """Rounds GeoJSON coordinates of any depth"""
+    if not coordinates:
+        return coordinates
+    if isinstance(coordinates[0], (int, float)):
+        return [round(c, precision) for c in coordinates]
+    return [quantize_coordinates(c, precision) for c in coordinates]
+
+
+def quantize_geometry(geometry, precision=None):
     """
-    Checks if image is suitable for wide version. Performs 'version_generate',
-    then controls dimensions. If small, pastes the image on a 1600x800 black
-    background replacing original wide version. fb_image is a Fileobject.
+    Returns GeoJSON geometry rounded to precision decimals (seven give
+    about 1 cm), by default DJEOCAD_COORDINATE_PRECISION
     """
-    img = fb_image.version_generate("wide")
-    if img.width < 1600 or img.height < 800:
-        path = Path(settings.MEDIA_ROOT).joinpath(fb_image.version_path("wide"))
-        img = Image.open(path)
-        back = Image.new(img.mode, (1600, 800))
-        position = (
-            int((back.width - img.width) / 2),
-            int((back.height - img.height) / 2),
+    if precision is None:
+        precision = get_coordinate_precision()
+    if precision is None or not geometry:
+        return geometry
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+    if geometry["type"] == "GeometryCollection":
+        return dict(
+            geometry,
+            geometries=[
+                quantize_geometry(g, precision) for g in geometry["geometries"]
+            ],
+        )
+    if not geometry["coordinates"]:
+        return geometry
+    return dict(
+        geometry, coordinates=quantize_coordinates(geometry["coordinates"], precision)
+    )
+
+
+def iter_positions(coordinates):
+    """Yields positions of GeoJSON coordinates of any depth"""
+    if not coordinates:
+        return
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for c in coordinates:
+        yield from iter_positions(c)
+
+
+def replace_positions(coordinates, positions):
+    """Rebuilds GeoJSON coordinates taking positions from an iterator"""
+    if not coordinates:
+        return coordinates
+    if isinstance(coordinates[0], (int, float)):
+        return list(next(positions))
+    return [replace_positions(c, positions) for c in coordinates]
+
+
+def get_geometry_positions(geometry):
+    if not geometry:
+        return
+    if geometry["type"] == "GeometryCollection":
+        for g in geometry["geometries"]:
+            yield from get_geometry_positions(g)
+        return
+    yield from iter_positions(geometry["coordinates"])
+
+
+def set_geometry_positions(geometry, positions):
+    if not geometry:
+        return geometry
+    if geometry["type"] == "GeometryCollection":
+        return dict(
+            geometry,
+            geometries=[
+                set_geometry_positions(g, positions) for g in geometry["geometries"]
+            ],
         )
-        back.paste(img, position)
-        back.save(path)
+    return dict(
+        geometry, coordinates=replace_positions(geometry["coordinates"], positions)
+    )
+
+
+def get_geometry_bounds(geometry):
+    """Returns (minx, miny, maxx, maxy) of GeoJSON geometry, None if empty"""
+    positions = [p[:2] for p in get_geometry_positions(geometry)]
+    if not positions:
+        return None
+    xs, ys = zip(*positions)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def transform_geometries(geometries, func):
+    """
+    Returns GeoJSON geometries with positions transformed all at once:
+    func takes arrays of x and y and returns the transformed arrays
+    """
+    geometries = [json.loads(g) if isinstance(g, str) else g for g in geometries]
+    positions = [p[:2] for g in geometries for p in get_geometry_positions(g)]
+    if not positions:
+        return geometries
+    array = np.array(positions, dtype=float)
+    xs, ys = func(array[:, 0], array[:, 1])
+    positions = zip(np.asarray(xs).tolist(), np.asarray(ys).tolist())
+    return [set_geometry_positions(g, positions) for g in geometries]
+
+
+def get_compression(file):
+    """Returns "gzip", "zip" or None, reading first bytes of file"""
+    file.seek(0)
+    magic = file.read(4)
+    file.seek(0)
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    if magic == b"PK\x03\x04":
+        return "zip"
+    return None
+
+
+def get_zipped_dxf(archive):
+    """Returns info of the only DXF in zip archive, None if not just one"""
+    members = [
+        info
+        for info in archive.infolist()
+        if not info.is_dir() and info.filename.lower().endswith(".dxf")
+    ]
+    if len(members) != 1:
+        return None
+    return members[0]
+
+
+def get_max_dxf_size():
+    """Ceiling of (decompressed) DXF size in bytes"""
+    try:
+        megabytes = settings.DJEOCAD_MAX_DXF_SIZE
+    except AttributeError:
+        megabytes = 200
+    return int(megabytes * 1024 * 1024)
+
+
+def get_size_error(limit):
+    return ValidationError(
+        _("DXF file exceeds %(size)g MB once decompressed")
+        % {"size": limit / (1024 * 1024)}
+    )
+
+
+def copy_limited(source, target, limit, chunk_size=1024 * 1024):
+    """
+    Copies source to target (if not None) in chunks, raises ValidationError
+    as soon as more than limit bytes are read
+    """
+    size = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return size
+        size += len(chunk)
+        if size > limit:
+            raise get_size_error(limit)
+        if target is not None:
+            target.write(chunk)
+
+
+def validate_dxf_file(file):
+    """
+    Checks gzip and zip uploads and size of (decompressed) DXF, ASCII and
+    binary DXF are left to ezdxf
+    """
+    if getattr(file, "_committed", False):
+        return
+    limit = get_max_dxf_size()
+    compression = get_compression(file)
+    if compression == "zip":
+        try:
+            with zipfile.ZipFile(file) as archive:
+                member = get_zipped_dxf(archive)
+        except zipfile.BadZipFile:
+            member = None
+        file.seek(0)
+        if member is None:
+            raise ValidationError(_("ZIP archive must contain a single DXF file"))
+        # declared size, actual size is checked again while unpacking
+        if member.file_size > limit:
+            raise get_size_error(limit)
+    elif compression == "gzip":
+        # gzip has no reliable declared size, decompress without storing
+        try:
+            with gzip.GzipFile(fileobj=file) as source:
+                copy_limited(source, None, limit)
+        except (OSError, EOFError, zlib.error):
+            raise ValidationError(_("Invalid gzip file"))
+        finally:
+            file.seek(0)
+    elif file.size > limit:
+        raise get_size_error(limit)
+
+
+def unpack_dxf(file):
+    """
+    Returns file unchanged if it's a DXF (ASCII or binary), else a File
+    with the DXF decompressed in chunks from gzip or zip archive into a
+    temporary file. Raises ValidationError if decompressed DXF exceeds
+    DJEOCAD_MAX_DXF_SIZE or zip archive isn't valid or doesn't hold a
+    single DXF.
+    """
+    compression = get_compression(file)
+    if not compression:
+        return file
+    limit = get_max_dxf_size()
+    temp = tempfile.TemporaryFile()
+    try:
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=file) as source:
+                copy_limited(source, temp, limit)
+            # "name.dxf.gz" or "name.gz"
+            name = Path(Path(file.name).name).stem
+        else:
+            error = ValidationError(_("ZIP archive must contain a single DXF file"))
+            try:
+                archive = zipfile.ZipFile(file)
+            except zipfile.BadZipFile:
+                raise error
+            with archive:
+                member = get_zipped_dxf(archive)
+                if member is None:
+                    raise error
+                with archive.open(member) as source:
+                    copy_limited(source, temp, limit)
+            name = Path(member.filename).name
+    except ValidationError:
+        temp.close()
+        raise
+    if not name.lower().endswith(".dxf"):
+        name += ".dxf"
+    temp.seek(0)
+    return File(temp, name=name)
+
+
+def pad_wide_image(img):
+    """
+    If image is smaller than wide version, pastes it on a 1600x800 black
+    background.
+    """
+    if img.width >= 1600 and img.height >= 800:
+        return img
+    back = Image.new(img.mode, (1600, 800))
+    position = (
+        int((back.width - img.width) / 2),
+        int((back.height - img.height) / 2),
+    )
+    back.paste(img, position)
+    return back
+
+
+def generate_image_versions(fb_image):
+    """
+    Generates all filebrowser versions of fb_image (a FileObject) decoding the
+    original once. Big JPEGs are decoded in draft mode, at the smallest scale
+    still larger than every version. Versions are stored where
+    'version_generate' looks for them, so they won't be generated again.
+    """
+    path = Path(settings.MEDIA_ROOT).joinpath(fb_image.path)
+    box = [1, 1]
+    for options in VERSIONS.values():
+        box[0] = max(box[0], int(options.get("width") or 0))
+        box[1] = max(box[1], int(options.get("height") or 0))
+    with Image.open(path) as img:
+        img.draft("RGB", tuple(box))
+        img.load()
+        for suffix, options in VERSIONS.items():
+            version = process_image(img, options)
+            for method in options.get("methods", []):
+                if callable(method):
+                    version = method(version)
+            if suffix == "wide":
+                version = pad_wide_image(version)
+            version_path = Path(settings.MEDIA_ROOT).joinpath(
+                fb_image.version_path(suffix)
+            )
+            version_path.parent.mkdir(parents=True, exist_ok=True)
+            # written aside and renamed, 'version_generate' never finds
+            # partial files
+            with tempfile.NamedTemporaryFile(
+                dir=version_path.parent,
+                prefix="." + version_path.stem,
+                suffix=version_path.suffix,
+                delete=False,
+            ) as temp:
+                if version_path.suffix.lower() in [".jpg", ".jpeg"]:
+                    if version.mode not in ("L", "RGB"):
+                        version = version.convert("RGB")
+                    version.save(temp, quality=VERSION_QUALITY, optimize=True)
+                else:
+                    version.save(temp)
+            Path(temp.name).replace(version_path)
+
+
+def get_image_executor():
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="djeocad-images"
+        )
+        # on graceful exit queued images are generated before leaving
+        atexit.register(_image_executor.shutdown, wait=True)
+    return _image_executor
+
+
+def image_versions_done(path, future):
+    with _image_lock:
+        if _image_futures.get(path) is future:
+            del _image_futures[path]
+    if future.exception() is not None:
+        logger.error(
+            "Image versions of %s not generated",
+            path,
+            exc_info=future.exception(),
+        )
+
+
+def schedule_image_versions(fb_image):
+    """
+    Generates image versions out of the request, in a background thread,
+    unless DJEOCAD_ASYNC_IMAGES is False. Versions lost to a killed worker
+    are generated on demand by 'version_generate'.
+    """
+    try:
+        background = settings.DJEOCAD_ASYNC_IMAGES
+    except AttributeError:
+        background = True
+    if not background:
+        generate_image_versions(fb_image)
+        return
+    path = fb_image.path
+    with _image_lock:
+        future = get_image_executor().submit(generate_image_versions, fb_image)
+        _image_futures[path] = future
+    future.add_done_callback(lambda f: image_versions_done(path, f))
+
+
+def wait_image_versions(fb_image):
+    """
+    Waits for versions of fb_image being generated in background, so that
+    'version_generate' doesn't generate them again at the same time
+    """
+    with _image_lock:
+        future = _image_futures.get(fb_image.path)
+    if future is not None:
+        wait([future])
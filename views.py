@@ -1,5 +1,7 @@
 import csv
+import hashlib
 import json
+from pathlib import Path
 
 from django.conf import settings
 from django.contrib import messages
@@ -7,10 +9,20 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.db.models import Count, Max, Q, Sum
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+)
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.translation import get_language
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import condition
 from django.views.generic import (
     CreateView,
     DeleteView,
@@ -20,7 +32,12 @@ from django.views.generic import (
     TemplateView,
     UpdateView,
 )
+from djgeojson.templatetags.geojson_tags import geojsonfeature
 
+from .downloads import FORMATS as DOWNLOAD_FORMATS
+from .downloads import get_download
+from .exports import FORMATS as EXPORT_FORMATS
+from .exports import get_export, iter_geojsonseq
 from .forms import (
     DrawingCreateForm,
     DrawingGeoDataForm,
@@ -30,7 +47,15 @@ from .forms import (
     InsertionCreateForm,
     LayerCreateForm,
 )
-from .models import Drawing, Dxf2Csv, Insertion, Layer
+from .instrumentation import stage
+from .models import AuthorSummary, Drawing, Dxf2Csv, Insertion, Layer
+from .payloads import (
+    delta_encode_collection,
+    get_map_payload,
+    get_payload_path,
+    use_payload_files,
+    write_payload_files,
+)
 
 User = get_user_model()
 
@@ -44,35 +69,155 @@ class HxPageTemplateMixin:
         return [self.template_name]
 
 
-class BaseListView(HxPageTemplateMixin, ListView):
+def get_page_size():
+    try:
+        return settings.DJEOCAD_PAGE_SIZE
+    except AttributeError:
+        return 100
+
+
+def get_visible_drawings(user, author=None):
+    """Public drawings, plus private ones if user is their author"""
+    visible = Q(private=False)
+    if user.is_authenticated:
+        visible |= Q(user_id=user.uuid, private=True)
+    qs = Drawing.objects.filter(visible)
+    if author:
+        qs = qs.filter(user_id=author.uuid)
+    return qs.select_related("user")
+
+
+def paginate_keyset(queryset, after=None):
+    """
+    Seek pagination on drawing id: each page is an indexed range query, so
+    cost doesn't grow with the number of previous pages. Returns page and
+    cursor of next page (None on last page).
+    """
+    if after:
+        try:
+            queryset = queryset.filter(id__gt=int(after))
+        except ValueError:
+            raise Http404(_("Invalid page cursor"))
+    size = get_page_size()
+    page = list(queryset.order_by("id")[: size + 1])
+    if len(page) > size:
+        return page[:size], page[size - 1].id
+    return page, None
+
+
+class KeysetPaginationMixin:
+    """
+    Paginates drawings with paginate_keyset. Htmx requests for following
+    pages get just new drawings and the next 'load more' button.
+    """
+
+    page_template_name = "djeocad/htmx/drawing_page.html"
+
+    def is_next_page(self):
+        return self.request.htmx and "after" in self.request.GET
+
+    def get_template_names(self):
+        if self.is_next_page():
+            return [self.page_template_name]
+        return super().get_template_names()
+
+    def get_context_data(self, **kwargs):
+        page, next_cursor = paginate_keyset(
+            self.object_list, self.request.GET.get("after")
+        )
+        context = super().get_context_data(object_list=page, **kwargs)
+        context["next_cursor"] = next_cursor
+        return context
+
+
+class ConditionalGetMixin:
+    """
+    Answers conditional GET requests with 304 if validators did not change.
+    Views return validators from get_etag_data and get_last_modified, pages
+    vary by user and htmx request, so the ETag does too.
+    """
+
+    def get_etag_data(self, request, *args, **kwargs):
+        return None
+
+    def get_last_modified(self, request, *args, **kwargs):
+        return None
+
+    def get_etag(self, request, *args, **kwargs):
+        data = self.get_etag_data(request, *args, **kwargs)
+        if data is None:
+            return None
+        parts = [
+            str(request.user.pk) if request.user.is_authenticated else "anonymous",
+            "htmx" if request.htmx else "page",
+            get_language() or "",
+            request.GET.urlencode(),
+        ] + [str(d) for d in data]
+        return hashlib.md5("|".join(parts).encode()).hexdigest()
+
+    def dispatch(self, request, *args, **kwargs):
+        view = condition(
+            etag_func=self.get_etag, last_modified_func=self.get_last_modified
+        )(super().dispatch)
+        response = view(request, *args, **kwargs)
+        patch_vary_headers(response, ["Cookie", "HX-Request"])
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True, no_cache=True)
+        else:
+            patch_cache_control(response, no_cache=True)
+        return response
+
+
+class BaseListView(
+    ConditionalGetMixin, KeysetPaginationMixin, HxPageTemplateMixin, ListView
+):
     model = Drawing
     context_object_name = "drawings"
     template_name = "djeocad/htmx/base_list.html"
 
     def get_queryset(self):
-        qs = Drawing.objects.filter(private=False).prefetch_related("user")
-        if self.request.user.is_authenticated:
-            qs2 = Drawing.objects.filter(user_id=self.request.user.uuid, private=True)
-            qs = qs | qs2
-        return qs
+        return get_visible_drawings(self.request.user)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        authors = Drawing.objects.values_list("user__username", flat=True)
-        context["authors"] = list(dict.fromkeys(authors))
-        context["author_list"] = [_("Author - ") + s for s in context["authors"]]
+        context["authors"] = AuthorSummary.objects.all()
+        context["author_list"] = [
+            _("Author - ") + s.username for s in context["authors"]
+        ]
         context["mapbox_token"] = settings.MAPBOX_TOKEN
         return context
 
+    def get_summary_validators(self):
+        # summaries are refreshed on any drawing save or delete
+        if not hasattr(self, "summary_validators"):
+            self.summary_validators = AuthorSummary.objects.aggregate(
+                Max("last_update"),
+                Count("user"),
+                Sum("public_drawings"),
+                Sum("private_drawings"),
+            )
+        return self.summary_validators
+
+    def get_last_modified(self, request, *args, **kwargs):
+        return self.get_summary_validators()["last_update__max"]
+
+    def get_etag_data(self, request, *args, **kwargs):
+        return self.get_summary_validators().values()
+
     def dispatch(self, request, *args, **kwargs):
         response = super(BaseListView, self).dispatch(request, *args, **kwargs)
-        if request.htmx:
+        if self.is_next_page():
+            dict = {"loadMarkers": True}
+            response["HX-Trigger-After-Swap"] = json.dumps(dict)
+        elif request.htmx:
             dict = {"refreshCollections": True}
             response["HX-Trigger-After-Swap"] = json.dumps(dict)
         return response
 
 
-class AuthorListView(HxPageTemplateMixin, ListView):
+class AuthorListView(
+    ConditionalGetMixin, KeysetPaginationMixin, HxPageTemplateMixin, ListView
+):
     model = Drawing
     context_object_name = "drawings"
     template_name = "djeocad/htmx/author_list.html"
@@ -80,35 +225,47 @@ class AuthorListView(HxPageTemplateMixin, ListView):
     def setup(self, request, *args, **kwargs):
         super(AuthorListView, self).setup(request, *args, **kwargs)
         self.author = get_object_or_404(User, username=self.kwargs["username"])
+        self.summary = AuthorSummary.objects.filter(user_id=self.author.uuid).first()
 
     def get_queryset(self):
-        self.qs = Drawing.objects.filter(
-            user_id=self.author.uuid, private=False
-        ).select_related("user")
-        if self.request.user == self.author:
-            qs2 = Drawing.objects.filter(user_id=self.author.uuid, private=True)
-            self.qs = self.qs | qs2
-        return self.qs.order_by(
-            "id",
-        )
+        return get_visible_drawings(self.request.user, author=self.author)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["author"] = self.author
+        context["summary"] = self.summary
         context["author_list"] = [_("Author - ") + self.author.username]
         context["mapbox_token"] = settings.MAPBOX_TOKEN
         return context
 
+    def get_last_modified(self, request, *args, **kwargs):
+        if self.summary:
+            return self.summary.last_update
+        return None
+
+    def get_etag_data(self, request, *args, **kwargs):
+        if not self.summary:
+            return None
+        return [
+            self.summary.last_update,
+            self.summary.public_drawings,
+            self.summary.private_drawings,
+        ]
+
     def dispatch(self, request, *args, **kwargs):
         response = super(AuthorListView, self).dispatch(request, *args, **kwargs)
-        if request.htmx:
+        if self.is_next_page():
+            dict = {"loadMarkers": True}
+            response["HX-Trigger-After-Swap"] = json.dumps(dict)
+        elif request.htmx:
             dict = {"refreshCollections": True}
             response["HX-Trigger-After-Swap"] = json.dumps(dict)
         return response
 
 
-class DrawingDetailView(HxPageTemplateMixin, DetailView):
+class DrawingDetailView(ConditionalGetMixin, HxPageTemplateMixin, DetailView):
     model = Drawing
+    queryset = Drawing.objects.select_related("user")
     template_name = "djeocad/htmx/drawing_detail.html"
 
     def get_object(self, queryset=None):
@@ -124,16 +281,59 @@ class DrawingDetailView(HxPageTemplateMixin, DetailView):
         context = super().get_context_data(**kwargs)
         context["mapbox_token"] = settings.MAPBOX_TOKEN
         context["lines"] = self.object.related_layers.filter(is_block=False)
-        context["blocks"] = self.object.related_layers.filter(is_block=True)
-        id_list = context["lines"].values_list("id", flat=True)
-        context["insertions"] = Insertion.objects.filter(layer_id__in=id_list)
-        context["drawings"] = self.object
+        context["blocks"] = self.object.related_layers.filter(
+            is_block=True
+        ).prefetch_related("instances")
+        if use_payload_files():
+            # lines and blocks are fetched from precompressed files
+            context["map_data"] = {
+                "marker_data": geojsonfeature(self.object, "popupContent"),
+                "line_data": "null",
+                "block_data": "null",
+            }
+            context["map_url"] = reverse(
+                "djeocad:drawing_map_json", kwargs={"pk": self.object.id}
+            )
+        else:
+            context["map_data"] = get_map_payload(self.object)
         context["author_list"] = [_("Author - ") + self.object.user.username]
         name_list = context["lines"].values_list("name", flat=True)
         context["layer_list"] = list(dict.fromkeys(name_list))
         context["layer_list"] = [_("Layer - ") + s for s in context["layer_list"]]
         return context
 
+    def get_drawing_validators(self, request, *args, **kwargs):
+        """
+        Returns modification data of visible drawing, None lets get_object
+        raise the appropriate error
+        """
+        if not hasattr(self, "drawing_validators"):
+            self.drawing_validators = (
+                Drawing.objects.filter(id=kwargs["pk"])
+                .values(
+                    "modified", "map_version", "private", "user_id", "user__username"
+                )
+                .first()
+            )
+        drawing = self.drawing_validators
+        if not drawing or drawing["user__username"] != kwargs["username"]:
+            return None
+        if drawing["private"] and drawing["user_id"] != request.user.pk:
+            return None
+        return drawing
+
+    def get_last_modified(self, request, *args, **kwargs):
+        drawing = self.get_drawing_validators(request, *args, **kwargs)
+        if drawing:
+            return drawing["modified"]
+        return None
+
+    def get_etag_data(self, request, *args, **kwargs):
+        drawing = self.get_drawing_validators(request, *args, **kwargs)
+        if drawing:
+            return [drawing["modified"], drawing["map_version"]]
+        return None
+
     def dispatch(self, request, *args, **kwargs):
         response = super(DrawingDetailView, self).dispatch(request, *args, **kwargs)
         if request.htmx:
@@ -295,6 +495,7 @@ class LayerCreateView(PermissionRequiredMixin, CreateView):
 class LayerUpdateView(PermissionRequiredMixin, UpdateView):
     permission_required = "djeocad.change_layer"
     model = Layer
+    queryset = Layer.objects.select_related("drawing__user")
     form_class = LayerCreateForm
     template_name = "djeocad/includes/layer_update.html"
 
@@ -308,6 +509,11 @@ class LayerUpdateView(PermissionRequiredMixin, UpdateView):
             raise PermissionDenied
         return self.object
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["instances"] = self.object.instances.select_related("layer")
+        return context
+
     def get_success_url(self):
         return reverse(
             "djeocad:drawing_detail",
@@ -425,6 +631,7 @@ class InsertionCreateView(PermissionRequiredMixin, CreateView):
 class InsertionUpdateView(PermissionRequiredMixin, UpdateView):
     permission_required = "djeocad.change_insertion"
     model = Insertion
+    queryset = Insertion.objects.select_related("block__drawing__user", "layer")
     form_class = InsertionCreateForm
     template_name = "djeocad/includes/insertion_update.html"
 
@@ -511,18 +718,120 @@ class InsertionExplodeInlineView(PermissionRequiredMixin, TemplateView):
 
 
 def drawing_download(request, pk):
+    """
+    DXF file of drawing, ?format= asc (default), bin, gzip or zip. Every
+    format is written once, until drawing changes
+    """
     drawing = get_object_or_404(Drawing, id=pk)
     if drawing.private:
         if request.user != drawing.user:
             raise PermissionDenied
-    if drawing.needs_refresh:
-        drawing.get_file_to_download()
-    response = HttpResponse(drawing.dxf, content_type="text/plain")
-    response["Content-Disposition"] = "attachment; filename=%s.dxf" % drawing.title
+    fmt = request.GET.get("format", "asc")
+    if fmt not in DOWNLOAD_FORMATS:
+        raise Http404(_("Unknown download format"))
+    with stage("download"):
+        if drawing.needs_refresh:
+            drawing.get_file_to_download()
+        path = get_download(drawing, fmt)
+    suffix, content_type = DOWNLOAD_FORMATS[fmt]
+    return FileResponse(
+        open(path, "rb"),
+        as_attachment=True,
+        filename=drawing.title + suffix,
+        content_type=content_type,
+    )
 
+
+def drawing_export(request, pk):
+    """
+    Entities of drawing as GeoJSON text sequence (streamed), GeoPackage or
+    FlatGeobuf, ?format= geojsonseq, gpkg or fgb. Files are written once
+    for every map version
+    """
+    drawing = get_object_or_404(Drawing, id=pk)
+    if drawing.private:
+        if request.user != drawing.user:
+            raise PermissionDenied
+    fmt = request.GET.get("format", "geojsonseq")
+    if fmt not in EXPORT_FORMATS:
+        raise Http404(_("Unknown export format"))
+    suffix, content_type = EXPORT_FORMATS[fmt]
+    if fmt == "geojsonseq":
+        response = FileResponse(
+            iter_geojsonseq(drawing),
+            as_attachment=True,
+            filename=drawing.title + suffix,
+            content_type=content_type,
+        )
+        # headers are set from files only, streamed features have none
+        response.set_headers(None)
+        return response
+    with stage("export"):
+        path = get_export(drawing, fmt)
+    return FileResponse(
+        open(path, "rb"),
+        as_attachment=True,
+        filename=drawing.title + suffix,
+        content_type=content_type,
+    )
+
+
+def drawing_map_json(request, pk):
+    """
+    Map payload of drawing, served from files written when drawing changed,
+    brotli or gzip compressed if accepted by client
+    """
+    drawing = get_object_or_404(Drawing.objects.select_related("user"), id=pk)
+    if drawing.private:
+        if request.user != drawing.user:
+            raise PermissionDenied
+    path = get_payload_path(drawing.id, drawing.map_version, get_language())
+    if not path.exists():
+        write_payload_files(drawing, [get_language()])
+    accepted = {
+        value.split(";")[0].strip()
+        for value in request.META.get("HTTP_ACCEPT_ENCODING", "").split(",")
+        if value.replace(" ", "").split(";")[-1] not in ("q=0", "q=0.0")
+    }
+    encoding = None
+    for name, suffix in [("br", ".br"), ("gzip", ".gz")]:
+        compressed = Path(str(path) + suffix)
+        if name in accepted and compressed.exists():
+            path = compressed
+            encoding = name
+            break
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        # drawing changed meanwhile and files of newer version replaced these
+        return HttpResponseRedirect(request.get_full_path())
+    response = FileResponse(file, content_type="application/json")
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ["Accept-Encoding"])
     return response
 
 
+def drawing_list_json(request, username=None):
+    """
+    Drawings as a GeoJSON feature collection, one keyset page at a time.
+    Next page is requested with ?after=<next> until next is null. With
+    ?encoding=delta coordinates are delta encoded integers.
+    """
+    author = None
+    if username:
+        author = get_object_or_404(User, username=username)
+    page, next_cursor = paginate_keyset(
+        get_visible_drawings(request.user, author=author), request.GET.get("after")
+    )
+    with stage("serialize"):
+        collection = json.loads(geojsonfeature(page, "popupContent"))
+        if request.GET.get("encoding") == "delta":
+            collection = delta_encode_collection(collection)
+    collection["next"] = next_cursor
+    return JsonResponse(collection)
+
+
 class Dxf2CsvCreateView(PermissionRequiredMixin, HxPageTemplateMixin, CreateView):
     permission_required = "djeocad.add_dxf2csv"
     model = Dxf2Csv